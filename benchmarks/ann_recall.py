@@ -0,0 +1,122 @@
+""".. include:: README.md
+
+Compare the recall@k, latency and memory of the IVF and quantized indexes with the exact search.
+
+usage (from the repo's root):
+python -m benchmarks.ann_recall --vector-store data/ada3_1200len --k 20
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from core.vectorstore.embedding_store import load_vector_store
+from core.vectorstore.ivf_index import IvfIndex
+from core.vectorstore.quantization import QUANTIZATION_MODES, QuantizedIndex
+from core.vectorstore.search_index import ExactSearchIndex, SearchIndex
+
+N_PROBES = [1, 2, 4, 8, 16, 32]
+RESCORE_FACTORS = [1, 4, 10]
+
+
+def synthetic_embeddings(
+    n_rows: int = 100_000, dim: int = 256, n_clusters: int = 200, seed: int = 0
+) -> np.ndarray:
+    """Clustered gaussian embeddings, a rough proxy of text embeddings."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    labels = rng.integers(n_clusters, size=n_rows)
+    return centers[labels] + rng.normal(size=(n_rows, dim))
+
+
+def recall_at_k(exact_indices: np.ndarray, approx_indices: np.ndarray) -> float:
+    """Mean fraction of the exact top-k found by the approximate top-k."""
+    hits = [
+        len(np.intersect1d(exact, approx)) / len(exact)
+        for exact, approx in zip(exact_indices, approx_indices, strict=True)
+    ]
+    return float(np.mean(hits))
+
+
+def time_queries(index: SearchIndex, queries: np.ndarray, k: int) -> tuple[np.ndarray, float]:
+    """Run the queries one by one (as the RAG does) and return results and mean latency in ms."""
+    start = time.perf_counter()
+    indices = [index.search(query, k)[0][0] for query in queries]
+    latency = (time.perf_counter() - start) / len(queries) * 1000
+    return np.stack(indices), latency
+
+
+def run_benchmark(
+    embeddings: np.ndarray,
+    k: int = 20,
+    n_queries: int = 200,
+    n_probes: list[int] = N_PROBES,
+    rescore_factors: list[int] = RESCORE_FACTORS,
+) -> list[dict]:
+    """Benchmark the exact, IVF and quantized searches on queries close to the stored embeddings.
+
+    The reported memory is the memory the index needs to scan the store: the float matrix for
+    the exact and IVF searches, the codes only for the quantized searches.
+    """
+    rng = np.random.default_rng(1)
+    queries = embeddings[rng.choice(len(embeddings), size=n_queries, replace=False)]
+    queries = queries + 0.1 * rng.normal(size=queries.shape) * queries.std()
+
+    exact = ExactSearchIndex(embeddings)
+    exact_indices, exact_latency = time_queries(exact, queries, k)
+    results = [_result("exact", "", 1.0, exact_latency, exact.matrix.nbytes)]
+
+    start = time.perf_counter()
+    ivf = IvfIndex.build(exact.matrix, normalized=True)
+    build_time = time.perf_counter() - start
+    print(f"IVF index: {ivf.n_lists} lists, built in {build_time:.2f}s")  # noqa: T201
+    for n_probe in n_probes:
+        ivf.n_probe = n_probe
+        ivf_indices, ivf_latency = time_queries(ivf, queries, k)
+        recall = recall_at_k(exact_indices, ivf_indices)
+        memory = exact.matrix.nbytes + ivf.centroids.nbytes + ivf.row_ids.nbytes
+        results.append(_result("ivf", f"n_probe={n_probe}", recall, ivf_latency, memory))
+
+    for mode in QUANTIZATION_MODES:
+        quantized = QuantizedIndex.build(exact.matrix, mode)
+        for rescore_factor in rescore_factors:
+            quantized.rescore_factor = rescore_factor
+            quantized_indices, quantized_latency = time_queries(quantized, queries, k)
+            recall = recall_at_k(exact_indices, quantized_indices)
+            setting = f"rescore={rescore_factor}"
+            memory = quantized.codes.nbytes
+            results.append(_result(mode, setting, recall, quantized_latency, memory))
+    return results
+
+
+def _result(index: str, setting: str, recall: float, latency: float, memory: int) -> dict:
+    """Format a benchmark result."""
+    return {
+        "index": index,
+        "setting": setting,
+        "recall": recall,
+        "latency_ms": latency,
+        "memory_mb": memory / 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--vector-store", default=None, help="vector store (synthetic if None)")
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--n-rows", type=int, default=100_000, help="synthetic store size")
+    args = parser.parse_args()
+
+    if args.vector_store:
+        _, _embeddings = load_vector_store(args.vector_store)
+    else:
+        _embeddings = synthetic_embeddings(n_rows=args.n_rows)
+
+    print(f"{len(_embeddings)} vectors of dimension {_embeddings.shape[1]}, k={args.k}")  # noqa: T201
+    for _result_row in run_benchmark(_embeddings, k=args.k):
+        print(  # noqa: T201
+            f"{_result_row['index']:>6} | {_result_row['setting']:>11} | "
+            f"recall@{args.k}={_result_row['recall']:.3f} | "
+            f"{_result_row['latency_ms']:.3f} ms/query | {_result_row['memory_mb']:.1f} MB"
+        )
@@ -0,0 +1,139 @@
+""".. include:: README.md
+
+Measure the coverage, accuracy and latency of the keyword fast path of the router.
+
+usage (from the repo's root):
+python -m benchmarks.router_accuracy --llm
+"""
+
+import argparse
+import re
+import time
+
+from core.llmbackend.llm_backend import LlmBackend
+from core.llmbackend.prompts.routing_prompts import ROUTING_PROMPT
+from core.services.keyword_router import (
+    DATA_ENGINEERING,
+    DATA_VISUALIZATION,
+    FINANCIAL_CONSULTING,
+    KeywordRouter,
+)
+from core.services.router_service import RouterService
+from core.utils import are_similar
+from data.test_queries import QUERIES_DATAVIZ, QUERIES_DE, QUERIES_RAG, QUERIES_TRASH
+
+SPAM = "Spam"
+# labelled query sets: the test queries, and the examples of the routing prompt
+QUERY_SETS = {
+    SPAM: QUERIES_TRASH,
+    DATA_ENGINEERING: QUERIES_DE,
+    DATA_VISUALIZATION: QUERIES_DATAVIZ,
+    FINANCIAL_CONSULTING: QUERIES_RAG,
+}
+PROMPT_EXAMPLE_PATTERN = re.compile(r"Question: (.+?)\nResponse: (.+?)\n", re.DOTALL)
+N_REPEATS = 1_000
+
+
+def labelled_queries() -> list[tuple[str, str, str]]:
+    """(query set, query, expected pipeline) of the test queries and of the prompt examples."""
+    queries = [
+        (f"test_queries/{label}", query, label)
+        for label, set_queries in QUERY_SETS.items()
+        for query in set_queries
+    ]
+    queries += [
+        ("routing_prompt", " ".join(query.split()), label.strip())
+        for query, label in PROMPT_EXAMPLE_PATTERN.findall(ROUTING_PROMPT)
+    ]
+    return queries
+
+
+def run_benchmark(
+    queries: list[tuple[str, str, str]],
+    router: KeywordRouter,
+    llm: LlmBackend | None = None,
+    n_repeats: int = N_REPEATS,
+) -> list[dict]:
+    """Route the labelled queries with the keyword router, and with the llm if given.
+
+    Returns one result per query set:
+    - coverage: share of the queries routed by the keyword router
+    - fast_accuracy: accuracy of these routes
+    - fast_latency_us: mean latency of the keyword router over n_repeats runs, in microseconds
+    With an llm, the tiered router (RouterService with the keyword router) and the llm router
+    (RouterService without it) are also compared: accuracy and mean latency in ms.
+    """
+    tiered_router = RouterService(llm, fast_router=router)
+    llm_router = RouterService(llm)
+    rows = {}
+    for query_set, query, label in queries:
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            route = router.classify(query)
+        latency = (time.perf_counter() - start) / n_repeats * 1e6
+        row = rows.setdefault(query_set, _empty_row(query_set))
+        row["n_queries"] += 1
+        row["fast_latency_us"] += latency
+        if route.pipeline is not None:
+            row["fast_routes"] += 1
+            row["fast_correct"] += are_similar(route.pipeline, label)
+        if llm is not None:
+            for name, service in [("tiered", tiered_router), ("llm", llm_router)]:
+                start = time.perf_counter()
+                pipeline = service.route(query)
+                row[f"{name}_latency_ms"] += (time.perf_counter() - start) * 1e3
+                row[f"{name}_correct"] += are_similar(pipeline, label)
+    return [_result(row, with_llm=llm is not None) for row in rows.values()]
+
+
+def _empty_row(query_set: str) -> dict:
+    """Counters of a query set."""
+    counters = ["n_queries", "fast_routes", "fast_correct", "fast_latency_us"]
+    counters += [
+        f"{name}_{counter}" for name in ["tiered", "llm"] for counter in ["correct", "latency_ms"]
+    ]
+    return {"query_set": query_set, **dict.fromkeys(counters, 0)}
+
+
+def _result(row: dict, with_llm: bool) -> dict:
+    """Format the counters of a query set."""
+    n_queries = row["n_queries"]
+    result = {
+        "query_set": row["query_set"],
+        "n_queries": n_queries,
+        "coverage": row["fast_routes"] / n_queries,
+        "fast_accuracy": row["fast_correct"] / row["fast_routes"] if row["fast_routes"] else None,
+        "fast_latency_us": row["fast_latency_us"] / n_queries,
+    }
+    if with_llm:
+        for name in ["tiered", "llm"]:
+            result[f"{name}_accuracy"] = row[f"{name}_correct"] / n_queries
+            result[f"{name}_latency_ms"] = row[f"{name}_latency_ms"] / n_queries
+    return result
+
+
+if __name__ == "__main__":
+    from core.llmbackend.llm_backend import GptBackend
+    from core.settings.settings import Settings
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--llm", action="store_true", help="also compare with the routing llm")
+    parser.add_argument("--min-confidence", type=float, default=None)
+    args = parser.parse_args()
+
+    _router = KeywordRouter() if args.min_confidence is None else KeywordRouter(args.min_confidence)
+    _llm = GptBackend(settings=Settings()) if args.llm else None
+    for _row in run_benchmark(labelled_queries(), _router, llm=_llm):
+        _fast_accuracy = "-" if _row["fast_accuracy"] is None else f"{_row['fast_accuracy']:.2f}"
+        _line = (
+            f"{_row['query_set']:>40} | n={_row['n_queries']:>2} | "
+            f"coverage={_row['coverage']:.2f} | fast accuracy={_fast_accuracy:>4} | "
+            f"{_row['fast_latency_us']:.1f} us/query"
+        )
+        if args.llm:
+            _line += (
+                f" | tiered accuracy={_row['tiered_accuracy']:.2f} "
+                f"{_row['tiered_latency_ms']:.0f} ms/query | "
+                f"llm accuracy={_row['llm_accuracy']:.2f} {_row['llm_latency_ms']:.0f} ms/query"
+            )
+        print(_line)  # noqa: T201
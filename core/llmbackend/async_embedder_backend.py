@@ -0,0 +1,194 @@
+""".. include:: README.md
+
+Asynchronous wrapper for embedding API (currently ony OpenAI Ada is implemented).
+
+The async backend sends its batches concurrently, bounded by a maximum number of requests in
+flight and by requests-per-minute and tokens-per-minute limits. It also implements the
+synchronous EmbedderBackend methods, so that it can be used anywhere an embedder is expected
+(e.g. the ingestion pipeline or the RagService).
+"""
+
+import asyncio
+import logging
+from collections.abc import Coroutine
+from concurrent.futures import Future
+
+import numpy as np
+
+from core.llmbackend.embedder_backend import (
+    MAX_RETRIES,
+    MODELS,
+    TIME_TO_RETRY,
+    EmbedderBackend,
+    estimate_tokens,
+    is_valid_input,
+    make_batches,
+)
+from core.llmbackend.http_clients import get_http_clients
+from core.llmbackend.rate_limiter import AsyncRateLimiter
+from core.settings.settings import Settings
+
+MAX_CONCURRENCY = 8
+REQUESTS_PER_MINUTE = 1_000
+TOKENS_PER_MINUTE = 350_000
+
+
+class AsyncAdaBackend(EmbedderBackend):
+    """Async backend to fetch embeddings from strings using openAI ada.
+
+    Use aencode/aencode_list from asynchronous code, and encode/encode_list from synchronous
+    code. Both run the requests on the event loop of the shared clients (see http_clients),
+    so that they can be called from any thread or event loop.
+
+    Args:
+        settings (Settings): settings object containing your environment variables.
+        model (str): choosen embedding model. Use only models deployed on the Azure service.
+        list available models: MODELS
+        max_concurrency (int): maximum number of requests in flight
+        requests_per_minute (int): maximum number of requests sent per minute
+        tokens_per_minute (int): maximum number of (estimated) tokens sent per minute
+
+    Attributes:
+        client (AsyncAzureOpenAI): async client for Azure OpenAI API. The client is instantiated
+        with your API credentials, contained in the Settings object, and shared by the backends
+        of the process (see http_clients).
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        model: str | None = None,
+        max_concurrency: int = MAX_CONCURRENCY,
+        requests_per_minute: int = REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = TOKENS_PER_MINUTE,
+    ) -> None:
+        if settings is None:
+            error_message = "Settings object must be provided"
+            logging.error(error_message)
+            raise ValueError(error_message)
+
+        # use default model if none is provided
+        if model is None:
+            model = settings.EMBEDDINGS_MODEL
+
+        # check if model is valid
+        if model not in MODELS:
+            error_message = f"Invalid embedding model, use only: {MODELS}"
+            logging.error(error_message)
+            raise ValueError(error_message)
+
+        # Azure deployment, the client and its connection pool are shared by the process
+        self.client = get_http_clients(settings).async_azure_openai(settings)
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = AsyncRateLimiter(requests_per_minute, tokens_per_minute)
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def encode(self, query: str) -> np.ndarray | None:
+        """Create an embedded vector of a string and return it as a numpy array"""
+        return self.encode_list([query])[0]
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:
+        """Embed all strings in a list, sending the batches concurrently."""
+        return self._submit(self._encode_list(strings)).result()
+
+    async def aencode(self, query: str) -> np.ndarray | None:
+        """Create an embedded vector of a string and return it as a numpy array.
+
+        Args:
+            query (str): string to query
+
+        Returns:
+            np.ndarray or None: embedded string or None if the query is empty of if API failed
+        """
+        return (await self.aencode_list([query]))[0]
+
+    async def aencode_list(self, strings: list[str]) -> list[np.ndarray | None]:
+        """Embed all strings in a list, sending the batches concurrently.
+
+        Batches are built as in AdaBackend.encode_list and retried independently.
+
+        Args:
+            strings (list[str]): strings to embed
+
+        Returns:
+            list[np.ndarray | None]: embeddings in the input order. None for empty or non-string
+            inputs, and for inputs of batches that failed after all retries.
+        """
+        return await asyncio.wrap_future(self._submit(self._encode_list(strings)))
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    async def _encode_list(self, strings: list[str]) -> list[np.ndarray | None]:
+        """Send the batches of strings concurrently and scatter the embeddings back in order."""
+        embeddings = [None] * len(strings)
+        valid_idx = [idx for idx, string in enumerate(strings) if is_valid_input(string)]
+        batches = make_batches(valid_idx, strings)
+        batches_embeddings = await asyncio.gather(
+            *[self._encode_batch([strings[idx] for idx in batch_idx]) for batch_idx in batches]
+        )
+        for batch_idx, batch_embeddings in zip(batches, batches_embeddings, strict=True):
+            if batch_embeddings is None:
+                continue
+            for idx, embedding in zip(batch_idx, batch_embeddings, strict=True):
+                embeddings[idx] = embedding
+        return embeddings
+
+    async def _encode_batch(self, strings: list[str]) -> list[np.ndarray] | None:
+        """Embed a batch of strings in a single API call, with async retries.
+
+        Returns:
+            list[np.ndarray] | None: embeddings in the batch order, None if the API failed
+        """
+        tokens = sum(estimate_tokens(string) for string in strings)
+        embeddings = None
+        async with self._semaphore:
+            for retry in range(MAX_RETRIES):
+                await self.rate_limiter.acquire(tokens)
+                try:
+                    embeddings = await self.client.embeddings.create(
+                        model=self.model, input=strings
+                    )
+                    if embeddings:
+                        break
+
+                except Exception:
+                    logging.exception("API call failed")
+                    if retry == MAX_RETRIES - 1:
+                        break
+
+                # exponential wait between retries
+                await asyncio.sleep(TIME_TO_RETRY * retry)
+
+        if embeddings:
+            # the API returns one item per input, tagged with the input position
+            data = sorted(embeddings.data, key=lambda item: item.index)
+            return [np.array(item.embedding) for item in data]
+        return None
+
+    def _submit(self, coroutine: Coroutine) -> Future:
+        """Schedule a coroutine on the event loop of the shared clients, see http_clients.
+
+        The client connections, the semaphore and the rate limiter are bound to a single event
+        loop: every coroutine of the backend runs on it, whichever thread or loop calls it.
+        """
+        return get_http_clients().submit(coroutine)
+
+
+if __name__ == "__main__":
+    from core.settings.settings import Settings
+
+    ENV = Settings()
+    ada = AsyncAdaBackend(settings=ENV)
+
+    _list_query = ["", None, "hello", "my friend"]
+    response = ada.encode_list(strings=_list_query)
+    print(response)  # noqa: T201
+
+    response = asyncio.run(ada.aencode(query="hello"))
+    print(response)  # noqa: T201
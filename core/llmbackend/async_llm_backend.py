@@ -0,0 +1,192 @@
+""".. include:: README.md
+
+Asynchronous wrapper for llm calling API (currently only OpenAI implementation).
+
+The async backend awaits the API responses instead of blocking a thread, so that a single
+process can serve many concurrent queries (see arun_system in core/services/pipelines.py).
+It also implements the synchronous LlmBackend methods, so that it can be used anywhere an llm
+backend is expected.
+"""
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator, Coroutine, Iterator
+from concurrent.futures import Future
+from typing import Any
+
+from core.llmbackend.http_clients import get_http_clients
+from core.llmbackend.llm_backend import (
+    MAX_RETRIES,
+    MODELS,
+    TIME_TO_RETRY,
+    LlmBackend,
+    completion_request,
+    make_payload,
+    read_chunk,
+    read_completion,
+    retry_delay,
+)
+from core.settings.settings import Settings
+
+
+class AsyncGptBackend(LlmBackend):
+    """Async backend for simple queries with the OpenAI GPT llm.
+
+    Use aget_completion/astream_completion from asynchronous code, and
+    get_completion/stream_completion from synchronous code. Both run the requests on the event
+    loop of the shared clients (see http_clients), so that they can be called from any thread
+    or event loop.
+
+    Args:
+        max_token_in_response (int): maximum number of tokens in the response.
+        settings (Settings): settings object containing your environment variables.
+        llm_model (str | None): llm model, defaults to the LLM_MODEL setting.
+        list available models: MODELS
+
+    Attributes:
+        client (AsyncAzureOpenAI): async client for Azure OpenAI API. The client is instantiated
+        with your API credentials, contained in the Settings object, and shared by the backends
+        of the process (see http_clients).
+        prompt_token_budget (int): maximum number of tokens of the prompts: the context window
+        of the model (see MODELS) minus the response tokens.
+    """
+
+    def __init__(
+        self,
+        max_token_in_response: int = 500,
+        settings: Settings = None,
+        llm_model: str | None = None,
+    ) -> None:
+        if settings is None:
+            error_message = "Settings object is required"
+            logging.error(error_message)
+            raise ValueError(error_message)
+
+        # overwrite default model
+        if llm_model is None:
+            llm_model = settings.LLM_MODEL
+
+        # check llm model
+        if llm_model not in MODELS:
+            error_message = f"Invalid GPT llm_model, use only: {list(MODELS)}"
+            logging.error(error_message)
+            raise ValueError(error_message)
+
+        # Azure deployment, the client and its connection pool are shared by the process
+        self.client = get_http_clients(settings).async_azure_openai(settings)
+
+        self.model = llm_model
+        self.max_tokens = max_token_in_response
+        self.prompt_token_budget = MODELS[llm_model] - max_token_in_response
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def get_completion(
+        self, query: str, primer_prompt: str, tools: dict | None = None
+    ) -> str | Any:
+        """Send message to the llm and receive the response"""
+        return self._submit(self._send_payload(query, primer_prompt, tools)).result()
+
+    def stream_completion(self, query: str, primer_prompt: str) -> Iterator[str]:
+        """Send message to the llm and yield the tokens of the response as they arrive"""
+        tokens = self._stream_payload(query, primer_prompt)
+        while True:
+            try:
+                yield self._submit(anext(tokens)).result()
+            except StopAsyncIteration:
+                return
+
+    async def aget_completion(
+        self, query: str, primer_prompt: str, tools: dict | None = None
+    ) -> str | Any:
+        """Send message to the llm and receive the response, see LlmBackend.get_completion"""
+        return await asyncio.wrap_future(
+            self._submit(self._send_payload(query, primer_prompt, tools))
+        )
+
+    async def astream_completion(self, query: str, primer_prompt: str) -> AsyncIterator[str]:
+        """Send message to the llm and yield the tokens of the response as they arrive"""
+        tokens = self._stream_payload(query, primer_prompt)
+        while True:
+            try:
+                yield await asyncio.wrap_future(self._submit(anext(tokens)))
+            except StopAsyncIteration:
+                return
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    async def _send_payload(
+        self, query: str, primer_prompt: str, tools: dict | None = None
+    ) -> str | Any:
+        """Send the query with async retries. The response is a string or a "Function".
+
+        Requests and retries follow GptBackend._send_payload (see retry_delay).
+        """
+        payload = make_payload(query, primer_prompt)
+        response_string = ""
+        request = completion_request(self.model, self.max_tokens, payload, tools=tools)
+        for retry in range(MAX_RETRIES):
+            try:
+                rsp = await self.client.chat.completions.create(**request)
+                response_string = read_completion(rsp, tools)
+                # exit the retry loop if the llm response is not None
+                if response_string:
+                    break
+                # force pause for API safety
+                await asyncio.sleep(TIME_TO_RETRY)
+
+            except Exception as exc:
+                await asyncio.sleep(retry_delay(exc, retry))
+        return response_string
+
+    async def _stream_payload(self, query: str, primer_prompt: str) -> AsyncIterator[str]:
+        """Send the query in a streamed call and yield the response tokens.
+
+        Requests and retries follow GptBackend._stream_payload: only until the first token is
+        received.
+        """
+        payload = make_payload(query, primer_prompt)
+        request = completion_request(self.model, self.max_tokens, payload, stream=True)
+        for retry in range(MAX_RETRIES):
+            n_tokens = 0
+            try:
+                async for chunk in await self.client.chat.completions.create(**request):
+                    token = read_chunk(chunk)
+                    if token:
+                        n_tokens += 1
+                        yield token
+                if n_tokens:
+                    return
+                # force pause for API safety
+                await asyncio.sleep(TIME_TO_RETRY)
+
+            except Exception as exc:
+                await asyncio.sleep(retry_delay(exc, retry, n_tokens=n_tokens))
+
+    def _submit(self, coroutine: Coroutine) -> Future:
+        """Schedule a coroutine on the event loop of the shared clients, see http_clients.
+
+        The client connections are bound to a single event loop: every coroutine of the backend
+        runs on it, whichever thread or loop calls it.
+        """
+        return get_http_clients().submit(coroutine)
+
+
+if __name__ == "__main__":
+    ENV = Settings()
+    gpt = AsyncGptBackend(settings=ENV)
+
+    _system_function = "You are an efficient assistant.."
+    _queries = ["How many dwellers in San Francisco?", "How many dwellers in Paris?"]
+
+    async def _answer_all() -> list[str]:
+        return await asyncio.gather(
+            *[
+                gpt.aget_completion(query=_query, primer_prompt=_system_function)
+                for _query in _queries
+            ]
+        )
+
+    print(asyncio.run(_answer_all()))  # noqa: T201
@@ -0,0 +1,90 @@
+""".. include:: README.md
+
+Single-flight coalescing of identical concurrent llm requests, wrapping any llm backend.
+
+Requests are keyed like the completions cache (primer prompt, normalized query, tools): the
+concurrent identical requests share one llm call and its completion. Combined with a CachedLlm
+wrapping it, a burst of identical requests costs a single call, and later requests hit the
+cache.
+"""
+
+import hashlib
+import json
+from collections.abc import AsyncIterator, Iterator
+from typing import Any
+
+from core.llmbackend.completion_cache import normalize_query
+from core.llmbackend.llm_backend import LlmBackend
+from core.utils.single_flight import SingleFlight
+
+
+class CoalescedLlm(LlmBackend):
+    """Llm backend sharing a single llm call between identical concurrent requests.
+
+    Streamed completions are not coalesced: they are passed through to the wrapped llm.
+
+    Args:
+        llm (LlmBackend): llm backend called once per flight
+
+    Attributes:
+        flights (SingleFlight): flights of the requests, see SingleFlight.stats for metrics
+        prompt_token_budget (int | None): prompt token budget of the wrapped llm
+    """
+
+    def __init__(self, llm: LlmBackend) -> None:
+        self.llm = llm
+        self.model = getattr(llm, "model", type(llm).__name__)
+        self.prompt_token_budget = getattr(llm, "prompt_token_budget", None)
+        self.flights = SingleFlight()
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def get_completion(
+        self, query: str, primer_prompt: str, tools: dict | None = None
+    ) -> str | Any:
+        """Send message to the llm and receive the response, shared with identical requests"""
+        key = _request_key(query, primer_prompt, tools)
+        return self.flights.do(key, self.llm.get_completion, query, primer_prompt, tools)
+
+    def stream_completion(self, query: str, primer_prompt: str) -> Iterator[str]:
+        """Stream the completion of the wrapped llm"""
+        yield from self.llm.stream_completion(query=query, primer_prompt=primer_prompt)
+
+    async def aget_completion(
+        self, query: str, primer_prompt: str, tools: dict | None = None
+    ) -> str | Any:
+        """Send message to the llm and receive the response, shared with identical requests"""
+        key = _request_key(query, primer_prompt, tools)
+        return await self.flights.ado(key, self.llm.aget_completion, query, primer_prompt, tools)
+
+    async def astream_completion(self, query: str, primer_prompt: str) -> AsyncIterator[str]:
+        """Stream the completion of the wrapped llm"""
+        async for token in self.llm.astream_completion(query=query, primer_prompt=primer_prompt):
+            yield token
+
+    def stats(self) -> dict:
+        """Return the coalescing statistics, see SingleFlight.stats."""
+        return self.flights.stats()
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _request_key(query: str, primer_prompt: str, tools: dict | None) -> str:
+    """Coalescing key of a request."""
+    request = [primer_prompt, normalize_query(query), tools]
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    from core.llmbackend.llm_backend import GptBackend
+    from core.settings.settings import Settings
+
+    _llm = CoalescedLlm(GptBackend(settings=Settings()))
+    with ThreadPoolExecutor(max_workers=4) as _pool:
+        for _ in range(4):
+            _pool.submit(_llm.get_completion, "How many dwellers in Paris?", "Be concise.")
+    print(_llm.stats())  # noqa: T201
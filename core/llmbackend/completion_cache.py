@@ -0,0 +1,358 @@
+""".. include:: README.md
+
+Cache of llm completions, wrapping any llm backend.
+
+Completions are keyed by sha256(model, primer prompt, normalized query, tools): the llm
+backends use a near-zero temperature, so that identical requests get identical answers.
+Text answers and tool-call "Function" answers are both cached, and read back as the same
+types. Two stores are available:
+- MemoryCompletionCache: in-process LRU dictionary
+- DiskCompletionCache: SQLite database, shared by the processes using the same file
+Both are bounded in size (least recently used entries are evicted first) and expire entries
+after a time-to-live.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Iterator
+from typing import Any
+
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+from core.llmbackend.llm_backend import LlmBackend
+
+MAX_ENTRIES = 10_000
+# completions depend on the prompts and on the data they describe: they expire after a week
+TTL_SECONDS = 7 * 24 * 3600
+
+
+class CompletionStore(ABC):
+    """Abstract class for the stores of serialized completions.
+
+    Attributes:
+        evictions (int): number of entries evicted to respect max_entries
+        expirations (int): number of expired entries found by get
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float | None) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evictions = 0
+        self.expirations = 0
+
+    @abstractmethod
+    def get(self, key: str) -> str | None:
+        """Read a serialized completion, None if missing or expired."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, key: str, value: str) -> None:
+        """Store a serialized completion, evicting the least recently used ones if needed."""
+        raise NotImplementedError
+
+    @property
+    @abstractmethod
+    def size(self) -> int:
+        """Number of stored completions."""
+        raise NotImplementedError
+
+    def _expires_at(self) -> float:
+        """Expiry timestamp of an entry written now."""
+        return time.time() + self.ttl_seconds if self.ttl_seconds is not None else float("inf")
+
+
+class MemoryCompletionCache(CompletionStore):
+    """In-process LRU store of completions, shared by the threads of the process.
+
+    Args:
+        max_entries (int): maximum number of cached completions
+        ttl_seconds (float | None): time-to-live of the completions, None to never expire them
+    """
+
+    def __init__(
+        self, max_entries: int = MAX_ENTRIES, ttl_seconds: float | None = TTL_SECONDS
+    ) -> None:
+        super().__init__(max_entries, ttl_seconds)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        """Read a serialized completion, None if missing or expired."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            expires_at, value = self._entries[key]
+            if expires_at < time.time():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        """Store a serialized completion, evicting the least recently used ones if needed."""
+        with self._lock:
+            self._entries[key] = (self._expires_at(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    @property
+    def size(self) -> int:
+        """Number of stored completions."""
+        return len(self._entries)
+
+
+class DiskCompletionCache(CompletionStore):
+    """SQLite store of completions, persistent and shared by the processes using the file.
+
+    Args:
+        cache_path (str): path of the SQLite database, opened (created if needed) on first use
+        max_entries (int): maximum number of cached completions
+        ttl_seconds (float | None): time-to-live of the completions, None to never expire them
+    """
+
+    def __init__(
+        self,
+        cache_path: str,
+        max_entries: int = MAX_ENTRIES,
+        ttl_seconds: float | None = TTL_SECONDS,
+    ) -> None:
+        super().__init__(max_entries, ttl_seconds)
+        self.cache_path = cache_path
+        # the connection is shared by the threads of the process (e.g. Streamlit sessions)
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def get(self, key: str) -> str | None:
+        """Read a serialized completion, None if missing or expired."""
+        now = time.time()
+        with self._lock, self._connect():
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.expirations += 1
+                return None
+            self._connection.execute(
+                "UPDATE completions SET last_used = ? WHERE key = ?", (now, key)
+            )
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        """Store a serialized completion, evicting the least recently used ones if needed."""
+        with self._lock, self._connect():
+            self._connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, value, self._expires_at(), time.time()),
+            )
+            size = self._connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+            excess = size - self.max_entries
+            if excess > 0:
+                self._connection.execute(
+                    "DELETE FROM completions WHERE rowid IN "
+                    "(SELECT rowid FROM completions ORDER BY last_used ASC LIMIT ?)",
+                    (excess,),
+                )
+                self.evictions += excess
+                logging.info("Evicted %s completions from the cache", excess)
+
+    @property
+    def size(self) -> int:
+        """Number of stored completions."""
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def close(self) -> None:
+        """Close the database connection, if opened."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Connection of the database, opened (and created) on first use.
+
+        Called with the lock held: creating the store (e.g. at import) does not touch the disk.
+        """
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS completions ("
+                    "key TEXT PRIMARY KEY, value TEXT, expires_at REAL, last_used REAL)"
+                )
+                self._connection.execute(
+                    "CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)"
+                )
+        return self._connection
+
+
+class CachedLlm(LlmBackend):
+    """Llm backend reading completions from a cache before calling the llm.
+
+    Empty completions (failed calls) are never cached. Streamed completions are cached once
+    fully received, and cached completions are streamed at once.
+
+    Args:
+        llm (LlmBackend): llm backend called on cache misses
+        store (CompletionStore | None): completions store. Defaults to a MemoryCompletionCache.
+        model (str | None): name of the llm model, part of the cache key.
+        Defaults to the `model` attribute of the llm.
+
+    Attributes:
+        hits (int): number of completions read from the cache
+        misses (int): number of completions sent to the llm
+        prompt_token_budget (int | None): prompt token budget of the wrapped llm
+    """
+
+    def __init__(
+        self, llm: LlmBackend, store: CompletionStore | None = None, model: str | None = None
+    ) -> None:
+        if store is None:
+            store = MemoryCompletionCache()
+        if model is None:
+            model = getattr(llm, "model", type(llm).__name__)
+
+        self.llm = llm
+        self.store = store
+        self.model = model
+        self.prompt_token_budget = getattr(llm, "prompt_token_budget", None)
+        self.hits = 0
+        self.misses = 0
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def get_completion(
+        self, query: str, primer_prompt: str, tools: dict | None = None
+    ) -> str | Any:
+        """Send message to the llm and receive the response, unless it is cached"""
+        key = self._key(query, primer_prompt, tools)
+        cached = self._read(key)
+        if cached is not None:
+            return cached
+        completion = self.llm.get_completion(query=query, primer_prompt=primer_prompt, tools=tools)
+        self._write(key, completion)
+        return completion
+
+    def stream_completion(self, query: str, primer_prompt: str) -> Iterator[str]:
+        """Yield the cached completion at once, or stream the llm completion and cache it"""
+        key = self._key(query, primer_prompt, None)
+        cached = self._read(key)
+        if cached is not None:
+            yield cached
+            return
+        tokens = []
+        for token in self.llm.stream_completion(query=query, primer_prompt=primer_prompt):
+            tokens.append(token)
+            yield token
+        self._write(key, "".join(tokens))
+
+    async def aget_completion(
+        self, query: str, primer_prompt: str, tools: dict | None = None
+    ) -> str | Any:
+        """Send message to the llm and receive the response, unless it is cached"""
+        key = self._key(query, primer_prompt, tools)
+        cached = self._read(key)
+        if cached is not None:
+            return cached
+        completion = await self.llm.aget_completion(
+            query=query, primer_prompt=primer_prompt, tools=tools
+        )
+        self._write(key, completion)
+        return completion
+
+    async def astream_completion(self, query: str, primer_prompt: str) -> AsyncIterator[str]:
+        """Yield the cached completion at once, or stream the llm completion and cache it"""
+        key = self._key(query, primer_prompt, None)
+        cached = self._read(key)
+        if cached is not None:
+            yield cached
+            return
+        tokens = []
+        async for token in self.llm.astream_completion(query=query, primer_prompt=primer_prompt):
+            tokens.append(token)
+            yield token
+        self._write(key, "".join(tokens))
+
+    def stats(self) -> dict:
+        """Return the hit/miss statistics of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.store.evictions,
+            "expirations": self.store.expirations,
+            "size": self.store.size,
+        }
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _key(self, query: str, primer_prompt: str, tools: dict | None) -> str:
+        """Cache key of a request."""
+        request = [self.model, primer_prompt, normalize_query(query), tools]
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _read(self, key: str) -> str | Function | None:
+        """Read a cached completion, counting hits and misses."""
+        value = self.store.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _deserialize(value)
+
+    def _write(self, key: str, completion: str | Any) -> None:
+        """Cache a completion, unless it is empty or of an unknown type."""
+        value = _serialize(completion)
+        if value is not None:
+            self.store.put(key, value)
+
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace insensitive form of a query."""
+    return " ".join(query.split()).casefold()
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _serialize(completion: str | Any) -> str | None:
+    """JSON form of a text or tool-call completion, None for uncacheable completions."""
+    if isinstance(completion, str):
+        return json.dumps({"content": completion}) if completion else None
+    if isinstance(completion, Function):
+        return json.dumps({"function": completion.model_dump()})
+    return None
+
+
+def _deserialize(value: str) -> str | Function:
+    """Completion of a JSON form written by _serialize."""
+    completion = json.loads(value)
+    if "function" in completion:
+        return Function(**completion["function"])
+    return completion["content"]
+
+
+if __name__ == "__main__":
+    from core.llmbackend.llm_backend import GptBackend
+    from core.settings.settings import Settings
+
+    _llm = CachedLlm(GptBackend(settings=Settings()))
+    _llm.get_completion(query="How many dwellers in Paris?", primer_prompt="Be concise.")
+    _llm.get_completion(query="how many  dwellers in paris?", primer_prompt="Be concise.")
+    print(_llm.stats())  # noqa: T201
@@ -8,13 +8,17 @@ import time
 from abc import ABC, abstractmethod
 
 import numpy as np
-import openai
 
+from core.llmbackend.http_clients import get_http_clients
 from core.settings.settings import Settings
 
 MODELS = ["text-embedding-3-large", "text-embedding-ada-002"]
 TIME_TO_RETRY = 0.05
 MAX_RETRIES = 5
+# limits of a single embedding request (the API accepts up to 2048 inputs)
+MAX_BATCH_SIZE = 512
+MAX_BATCH_TOKENS = 64_000
+CHARS_PER_TOKEN = 4
 
 
 class EmbedderBackend(ABC):
@@ -44,7 +48,8 @@ class AdaBackend(EmbedderBackend):
 
     Attributes:
         client (AzureOpenAI): client for Azure OpenAI API. The client is instantiated with
-        your API credentials, contained in the Settings object.
+        your API credentials, contained in the Settings object, and shared by the backends of
+        the process (see http_clients).
     """
 
     def __init__(self, settings: Settings, model: str | None = None) -> None:
@@ -63,12 +68,8 @@ class AdaBackend(EmbedderBackend):
             logging.error(error_message)
             raise ValueError(error_message)
 
-        # Azure deployment
-        self.client = openai.AzureOpenAI(
-            api_key=settings.OPENAI_API_KEY,
-            api_version=settings.OPENAI_API_VERSION,
-            azure_endpoint=settings.OPENAI_API_ENDPOINT,
-        )
+        # Azure deployment, the client and its connection pool are shared by the process
+        self.client = get_http_clients(settings).azure_openai(settings)
         self.model = model
 
     def encode(self, query: str) -> np.ndarray | None:
@@ -80,17 +81,52 @@ class AdaBackend(EmbedderBackend):
         Returns:
             np.ndarray or None: embedded string or None if the query is empty of if API failed
         """
-        if not query:
-            return None
-        if not isinstance(query, str):
-            return None
-        if len(query) == 0:
+        if not is_valid_input(query):
             return None
+        embeddings = self._encode_batch([query])
+        if embeddings:
+            return embeddings[0]
+        return None
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:
+        """Embed all strings in a list, sending batches of strings in a single API call each.
+
+        Batches are limited by a number of strings and an estimated number of tokens. Each batch
+        is retried independently: a failed batch does not trigger new calls for the others.
+
+        Args:
+            strings (list[str]): strings to embed
 
+        Returns:
+            list[np.ndarray | None]: embeddings in the input order. None for empty or non-string
+            inputs, and for inputs of batches that failed after all retries.
+        """
+        embeddings = [None] * len(strings)
+        valid_idx = [idx for idx, string in enumerate(strings) if is_valid_input(string)]
+        for batch_idx in make_batches(valid_idx, strings):
+            batch_embeddings = self._encode_batch([strings[idx] for idx in batch_idx])
+            if batch_embeddings is None:
+                continue
+            for idx, embedding in zip(batch_idx, batch_embeddings, strict=True):
+                embeddings[idx] = embedding
+        return embeddings
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _encode_batch(self, strings: list[str]) -> list[np.ndarray] | None:
+        """Embed a batch of strings in a single API call.
+
+        This function will retry several times if the API call fails, using time sleeps
+        between retries.
+
+        Returns:
+            list[np.ndarray] | None: embeddings in the batch order, None if the API failed
+        """
         embeddings = None
         for retry in range(MAX_RETRIES):
             try:
-                embeddings = self.client.embeddings.create(model=self.model, input=query)
+                embeddings = self.client.embeddings.create(model=self.model, input=strings)
                 if embeddings:
                     break
 
@@ -103,12 +139,39 @@ class AdaBackend(EmbedderBackend):
             time.sleep(TIME_TO_RETRY * retry)
 
         if embeddings:
-            return np.array(embeddings.data[0].embedding)
+            # the API returns one item per input, tagged with the input position
+            data = sorted(embeddings.data, key=lambda item: item.index)
+            return [np.array(item.embedding) for item in data]
         return None
 
-    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:
-        """Embed all strings in a list."""
-        return [self.encode(string) for string in strings]
+
+# =============================================================================
+# support functions
+# =============================================================================
+def is_valid_input(query: str) -> bool:
+    """Only non-empty strings are sent to the API."""
+    return isinstance(query, str) and len(query) > 0
+
+
+def estimate_tokens(string: str) -> int:
+    """Rough number of tokens of a string, used to budget the API requests."""
+    return len(string) // CHARS_PER_TOKEN + 1
+
+
+def make_batches(valid_idx: list[int], strings: list[str]) -> list[list[int]]:
+    """Group strings positions into batches respecting the batch size and token budgets."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for idx in valid_idx:
+        tokens = estimate_tokens(strings[idx])
+        if batch and (len(batch) >= MAX_BATCH_SIZE or batch_tokens + tokens > MAX_BATCH_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(idx)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+""".. include:: README.md
+
+Persistent, content-addressed cache of embeddings, wrapping any embedder backend.
+
+Embeddings are stored in a SQLite database keyed by (model, sha256(text)), so that re-ingesting
+a document or re-asking a question only pays for the texts that were never embedded.
+The cache is bounded in size: least recently used entries are evicted first.
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+
+import numpy as np
+
+from core.llmbackend.embedder_backend import EmbedderBackend
+
+MAX_ENTRIES = 200_000
+# SQLite limits the number of parameters of a single statement
+SQL_BATCH_SIZE = 500
+DTYPE = np.float32
+
+
+class CachedEmbedder(EmbedderBackend):
+    """Embedder backend reading embeddings from a persistent cache before calling the embedder.
+
+    Vectors are stored as float32. Failed embeddings (None) are never cached.
+
+    Args:
+        embedder (EmbedderBackend): embedder called on cache misses
+        cache_path (str): path of the SQLite database, opened (created if needed) on first use.
+        Use ":memory:" for a non-persistent cache.
+        max_entries (int): maximum number of cached embeddings. Least recently used embeddings
+        are evicted beyond this size.
+        model (str | None): name of the embedding model, part of the cache key.
+        Defaults to the `model` attribute of the embedder.
+
+    Attributes:
+        hits (int): number of inputs read from the cache
+        misses (int): number of inputs sent to the embedder
+        evictions (int): number of evicted embeddings
+    """
+
+    def __init__(
+        self,
+        embedder: EmbedderBackend,
+        cache_path: str,
+        max_entries: int = MAX_ENTRIES,
+        model: str | None = None,
+    ) -> None:
+        if model is None:
+            model = getattr(embedder, "model", type(embedder).__name__)
+
+        self.embedder = embedder
+        self.model = model
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cache_path = cache_path
+
+        # the connection is shared by the threads of the process (e.g. Streamlit sessions)
+        self._lock = threading.Lock()
+        self._connection = None
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def encode(self, query: str) -> np.ndarray | None:
+        """Create an embedded vector of a string and return it as a numpy array"""
+        return self.encode_list([query])[0]
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:
+        """Embed all strings in a list, only sending the uncached strings to the embedder."""
+        hashes = [_hash_text(string) if _is_cacheable(string) else None for string in strings]
+        unique_hashes = list(dict.fromkeys(text_hash for text_hash in hashes if text_hash))
+
+        with self._lock:
+            cached = self._read(unique_hashes)
+
+        # embed each missing text once, in a single call to the wrapped embedder
+        missing = {
+            text_hash: string
+            for string, text_hash in zip(strings, hashes, strict=True)
+            if text_hash and text_hash not in cached
+        }
+        if missing:
+            new_vectors = self.embedder.encode_list(list(missing.values()))
+            new_entries = {
+                text_hash: np.asarray(vector, dtype=DTYPE)
+                for text_hash, vector in zip(missing, new_vectors, strict=True)
+                if vector is not None
+            }
+            with self._lock:
+                self._write(new_entries)
+            cached.update(new_entries)
+
+        n_valid = sum(text_hash is not None for text_hash in hashes)
+        n_missed = sum(text_hash in missing for text_hash in hashes)
+        self.hits += n_valid - n_missed
+        self.misses += n_missed
+        return [cached.get(text_hash) if text_hash else None for text_hash in hashes]
+
+    def stats(self) -> dict:
+        """Return the hit/miss statistics of the cache."""
+        lookups = self.hits + self.misses
+        with self._lock:
+            size = (
+                self._connect()
+                .execute("SELECT COUNT(*) FROM embeddings WHERE model = ?", (self.model,))
+                .fetchone()[0]
+            )
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": size,
+        }
+
+    def close(self) -> None:
+        """Close the database connection, if opened."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _read(self, text_hashes: list[str]) -> dict[str, np.ndarray]:
+        """Read cached vectors and mark them as recently used."""
+        cached = {}
+        with self._connect():
+            now = self._tick()
+            for start in range(0, len(text_hashes), SQL_BATCH_SIZE):
+                batch = text_hashes[start : start + SQL_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    "SELECT text_hash, vector FROM embeddings "  # noqa: S608
+                    f"WHERE model = ? AND text_hash IN ({placeholders})",
+                    (self.model, *batch),
+                ).fetchall()
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, self.model, text_hash) for text_hash, _ in rows],
+                )
+                cached.update(
+                    {text_hash: np.frombuffer(vector, DTYPE) for text_hash, vector in rows}
+                )
+        return cached
+
+    def _write(self, entries: dict[str, np.ndarray]) -> None:
+        """Store new vectors and evict the least recently used ones beyond max_entries."""
+        if not entries:
+            return
+        with self._connect():
+            now = self._tick()
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                [
+                    (self.model, text_hash, vector.tobytes(), now)
+                    for text_hash, vector in entries.items()
+                ],
+            )
+            size = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            excess = size - self.max_entries
+            if excess > 0:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE rowid IN "
+                    "(SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (excess,),
+                )
+                self.evictions += excess
+                logging.info("Evicted %s embeddings from the cache", excess)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Connection of the database, opened (and created) on first use.
+
+        Called with the lock held: creating the embedder (e.g. at import) does not touch the disk.
+        """
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "model TEXT, text_hash TEXT, vector BLOB, last_used INTEGER, "
+                    "PRIMARY KEY (model, text_hash))"
+                )
+                self._connection.execute(
+                    "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+                )
+        return self._connection
+
+    def _tick(self) -> int:
+        """Logical clock of the cache usage, shared by every process using the database."""
+        last = self._connection.execute("SELECT MAX(last_used) FROM embeddings").fetchone()[0]
+        return (last or 0) + 1
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _is_cacheable(string: str) -> bool:
+    """Only non-empty strings are embedded, hence cached."""
+    return isinstance(string, str) and len(string) > 0
+
+
+def _hash_text(string: str) -> str:
+    """Content address of a text."""
+    return hashlib.sha256(string.encode("utf-8")).hexdigest()
+
+
+if __name__ == "__main__":
+    from core.llmbackend.embedder_backend import AdaBackend
+    from core.settings.settings import Settings
+
+    _embedder = CachedEmbedder(AdaBackend(settings=Settings()), cache_path=":memory:")
+    _embedder.encode_list(["hello", "my friend", "hello"])
+    _embedder.encode_list(["hello", "my friend"])
+    print(_embedder.stats())  # noqa: T201
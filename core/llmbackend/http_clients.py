@@ -0,0 +1,232 @@
+""".. include:: README.md
+
+Process-wide registry of the HTTP clients of the llm and embedder backends.
+
+Every backend used to create its own OpenAI client, each with its own connection pool: the TCP
+and TLS handshakes were paid again by every component (and by every Streamlit rerun). The
+registry creates one pooled httpx client per process (one synchronous, one asynchronous), shared
+by every OpenAI client it hands out. Connections are kept alive between requests, and HTTP/2
+is used when the h2 package is installed.
+
+Asynchronous clients are bound to the event loop they first run on: the registry also owns the
+event loop (in a background thread) running the coroutines of every asynchronous backend.
+"""
+
+import asyncio
+import importlib.util
+import logging
+import threading
+from collections.abc import Coroutine
+from concurrent.futures import Future
+
+import httpx
+import openai
+
+from core.settings.settings import Settings
+
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY = 30.0  # seconds
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+CLIENT_KINDS = ["sync", "async"]
+
+
+class HttpClientRegistry:
+    """Pooled HTTP clients and OpenAI clients, shared by the backends of the process.
+
+    Use get_http_clients to get the registry of the process.
+
+    Args:
+        max_connections (int): maximum number of connections of each pool
+        max_keepalive_connections (int): maximum number of idle connections kept alive
+        keepalive_expiry (float): seconds after which idle connections are closed
+        http2 (bool): use HTTP/2, requires the h2 package
+    """
+
+    def __init__(
+        self,
+        max_connections: int = MAX_CONNECTIONS,
+        max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = KEEPALIVE_EXPIRY,
+        http2: bool = HTTP2_AVAILABLE,
+    ) -> None:
+        if http2 and not HTTP2_AVAILABLE:
+            error_message = "HTTP/2 requires the h2 package, install httpx[http2]"
+            logging.error(error_message)
+            raise ValueError(error_message)
+
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self._http_clients = {}
+        self._openai_clients = {}
+        self._counters = {
+            kind: dict.fromkeys(["requests", "connections", "tls"], 0) for kind in CLIENT_KINDS
+        }
+        self._loop = None
+        self._lock = threading.Lock()
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def azure_openai(self, settings: Settings) -> openai.AzureOpenAI:
+        """Azure OpenAI client of the settings credentials, using the shared sync pool."""
+        return self._openai_client("sync", settings)
+
+    def async_azure_openai(self, settings: Settings) -> openai.AsyncAzureOpenAI:
+        """Async Azure OpenAI client of the settings credentials, using the shared async pool.
+
+        Its requests must run on the registry event loop, see submit.
+        """
+        return self._openai_client("async", settings)
+
+    def submit(self, coroutine: Coroutine) -> Future:
+        """Schedule a coroutine on the registry event loop, started on first use.
+
+        The async pool connections are bound to a single event loop: every coroutine of the
+        asynchronous backends runs on it, whichever thread or loop calls it.
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def stats(self) -> dict:
+        """Return the requests, new connections and pool utilisation of each client.
+
+        New connections (TCP handshakes) and TLS handshakes are counted from the start:
+        `reuse_rate` is the share of requests sent on an already open connection.
+        """
+        stats = {"http2": self.http2, "max_connections": self.limits.max_connections}
+        for kind in CLIENT_KINDS:
+            counters = self._counters[kind]
+            requests = counters["requests"]
+            connections = self._pool_connections(kind)
+            stats[kind] = {
+                "requests": requests,
+                "new_connections": counters["connections"],
+                "tls_handshakes": counters["tls"],
+                "reuse_rate": 1 - counters["connections"] / requests if requests else 0.0,
+                "open_connections": len(connections),
+                "idle_connections": sum(connection.is_idle() for connection in connections),
+            }
+        return stats
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _openai_client(
+        self, kind: str, settings: Settings
+    ) -> openai.AzureOpenAI | openai.AsyncAzureOpenAI:
+        """OpenAI client of a kind and credentials, created on first use."""
+        key = (
+            kind,
+            settings.OPENAI_API_ENDPOINT,
+            settings.OPENAI_API_VERSION,
+            settings.OPENAI_API_KEY,
+        )
+        with self._lock:
+            if key not in self._openai_clients:
+                client_class = openai.AzureOpenAI if kind == "sync" else openai.AsyncAzureOpenAI
+                self._openai_clients[key] = client_class(
+                    api_key=settings.OPENAI_API_KEY,
+                    api_version=settings.OPENAI_API_VERSION,
+                    azure_endpoint=settings.OPENAI_API_ENDPOINT,
+                    http_client=self._http_client(kind),
+                )
+            return self._openai_clients[key]
+
+    def _http_client(self, kind: str) -> httpx.Client | httpx.AsyncClient:
+        """Pooled httpx client of a kind, created on first use. Called with the lock held."""
+        if kind not in self._http_clients:
+            if kind == "sync":
+                client = httpx.Client(
+                    limits=self.limits,
+                    http2=self.http2,
+                    event_hooks={"request": [self._count_request]},
+                )
+            else:
+                client = httpx.AsyncClient(
+                    limits=self.limits,
+                    http2=self.http2,
+                    event_hooks={"request": [self._acount_request]},
+                )
+            self._http_clients[kind] = client
+        return self._http_clients[kind]
+
+    def _count_request(self, request: httpx.Request) -> None:
+        """Count a request of the sync client, and trace its handshakes."""
+        self._increment("sync", "requests")
+
+        def _trace(event_name: str, _: dict) -> None:
+            self._count_handshake("sync", event_name)
+
+        request.extensions["trace"] = _trace
+
+    async def _acount_request(self, request: httpx.Request) -> None:
+        """Count a request of the async client, and trace its handshakes."""
+        self._increment("async", "requests")
+
+        async def _trace(event_name: str, _: dict) -> None:
+            self._count_handshake("async", event_name)
+
+        request.extensions["trace"] = _trace
+
+    def _count_handshake(self, kind: str, event_name: str) -> None:
+        """Count the new connections and TLS handshakes from the httpcore trace events."""
+        if event_name == "connection.connect_tcp.complete":
+            self._increment(kind, "connections")
+        elif event_name == "connection.start_tls.complete":
+            self._increment(kind, "tls")
+
+    def _increment(self, kind: str, counter: str) -> None:
+        """Increment a counter of a client."""
+        with self._lock:
+            self._counters[kind][counter] += 1
+
+    def _pool_connections(self, kind: str) -> list:
+        """Connections of the pool of a client, empty before its first request."""
+        client = self._http_clients.get(kind)
+        if client is None:
+            return []
+        # httpx does not expose its httpcore pool
+        pool = getattr(client._transport, "_pool", None)  # noqa: SLF001
+        return list(getattr(pool, "connections", []))
+
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_http_clients(settings: Settings | None = None) -> HttpClientRegistry:
+    """Registry of the process, created on first call.
+
+    The pool is configured by the HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS and
+    HTTP_KEEPALIVE_EXPIRY settings (defaults to the module constants when they are not set).
+    """
+    global _REGISTRY  # noqa: PLW0603
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            if settings is None:
+                settings = Settings()
+            _REGISTRY = HttpClientRegistry(
+                max_connections=int(settings.HTTP_MAX_CONNECTIONS or MAX_CONNECTIONS),
+                max_keepalive_connections=int(
+                    settings.HTTP_MAX_KEEPALIVE_CONNECTIONS or MAX_KEEPALIVE_CONNECTIONS
+                ),
+                keepalive_expiry=float(settings.HTTP_KEEPALIVE_EXPIRY or KEEPALIVE_EXPIRY),
+            )
+        return _REGISTRY
+
+
+if __name__ == "__main__":
+    from core.llmbackend.llm_backend import GptBackend
+
+    _registry = get_http_clients()
+    for _ in range(3):
+        GptBackend(settings=Settings()).get_completion("How many dwellers in Paris?", "Be concise.")
+    print(_registry.stats())  # noqa: T201
@@ -3,16 +3,18 @@
 Wrapper for llm calling API (currently only OpenAI implementation).
 """
 
+import asyncio
 import logging
 import time
 from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Iterator
 from typing import Any
 
-import openai
-
+from core.llmbackend.http_clients import get_http_clients
 from core.settings.settings import Settings
 
-MODELS = ["gpt-35-turbo-16k", "gpt-4"]
+# context window (prompt and response tokens) of each model
+MODELS = {"gpt-35-turbo-16k": 16_384, "gpt-4": 8_192}
 TEMPERATURE = 0.000000001  # This tends to be more stable than zero...
 TOP_P = 0.95
 FREQUENCY_PENALTY = 0
@@ -26,7 +28,10 @@ MAX_RETRIES = 5
 class LlmBackend(ABC):
     """Abstract class for llm backends.
 
-    All child must implement the get_completion public method.
+    All child must implement the get_completion public method. Backends able to stream their
+    responses should override stream_completion.
+    The async methods (aget_completion, astream_completion) run the sync methods in a worker
+    thread by default, asynchronous backends override them (see AsyncGptBackend).
     """
 
     @abstractmethod
@@ -54,6 +59,30 @@ class LlmBackend(ABC):
         msg = "Please implement the get_completion method"
         raise msg from NotImplementedError
 
+    def stream_completion(self, query: str, primer_prompt: str) -> Iterator[str]:
+        """Send message to the llm and yield the text of the response as it is generated.
+
+        Backends without streaming yield the whole response at once.
+
+        Args:
+            query (str): main query string
+            primer_prompt (str): system or "primer" query string
+
+        Yields:
+            str: successive pieces of the response of the llm
+        """
+        yield self.get_completion(query=query, primer_prompt=primer_prompt)
+
+    async def aget_completion(
+        self, query: str, primer_prompt: str, tools: dict | None = None
+    ) -> str | Any:
+        """Send message to the llm and receive the response, see get_completion"""
+        return await asyncio.to_thread(self.get_completion, query, primer_prompt, tools)
+
+    async def astream_completion(self, query: str, primer_prompt: str) -> AsyncIterator[str]:
+        """Send message to the llm and yield the text of the response, see stream_completion"""
+        yield await asyncio.to_thread(self.get_completion, query, primer_prompt)
+
 
 class GptBackend(LlmBackend):
     """backend for simple queries with the OpanAI GPT llm. Use only: get_completion
@@ -67,7 +96,10 @@ class GptBackend(LlmBackend):
 
     Attributes:
         client (AzureOpenAI): client for Azure OpenAI API. The client is instantiated with
-        your API credentials, contained in the Settings object.
+        your API credentials, contained in the Settings object, and shared by the backends of
+        the process (see http_clients).
+        prompt_token_budget (int): maximum number of tokens of the prompts: the context window
+        of the model (see MODELS) minus the response tokens.
     """
 
     def __init__(
@@ -87,20 +119,17 @@ class GptBackend(LlmBackend):
 
         # check llm model
         if llm_model not in MODELS:
-            error_message = f"Invalid GPT llm_model, use only: {MODELS}"
+            error_message = f"Invalid GPT llm_model, use only: {list(MODELS)}"
             logging.error(error_message)
             raise ValueError(error_message)
 
-        # Azure deployment
-        self.client = openai.AzureOpenAI(
-            api_key=settings.OPENAI_API_KEY,
-            api_version=settings.OPENAI_API_VERSION,
-            azure_endpoint=settings.OPENAI_API_ENDPOINT,
-        )
+        # Azure deployment, the client and its connection pool are shared by the process
+        self.client = get_http_clients(settings).azure_openai(settings)
 
         # get llm chatbot model
         self.model = llm_model
         self.max_tokens = max_token_in_response
+        self.prompt_token_budget = MODELS[llm_model] - max_token_in_response
 
     # =============================================================================
     # user functions
@@ -109,58 +138,37 @@ class GptBackend(LlmBackend):
         self, query: str, primer_prompt: str, tools: dict | None = None
     ) -> str | Any:
         """Send message to the llm and receive the response"""
-        payload = self._make_payload(query, primer_prompt)
+        payload = make_payload(query, primer_prompt)
         response_message = self._send_payload(payload, tools)
         return response_message
 
+    def stream_completion(self, query: str, primer_prompt: str) -> Iterator[str]:
+        """Send message to the llm and yield the tokens of the response as they arrive"""
+        payload = make_payload(query, primer_prompt)
+        yield from self._stream_payload(payload)
+
     # =============================================================================
     # internal functions
     # =============================================================================
-    def _make_payload(self, query: str, system_function: str) -> list[dict]:
-        """Generate the payload list[hashmap] according to openAI format"""
-        payload = [
-            {"role": "system", "content": system_function},
-            {"role": "user", "content": query},
-        ]
-        return payload
-
     def _send_payload(self, payload: list[dict], tools: dict | None = None) -> str | Any:
         """Send payload via API .create() function. The response is a string or a "Function".
 
         This function will retry several times if the API call fails, using time sleeps
-        between retries.
+        between retries (see retry_delay).
 
         Args:
-            payload (list[dict]): payload list generated by _make_payload
+            payload (list[dict]): payload list generated by make_payload
             tools (dict | None, optional): OpenAI tools. Defaults to None.
 
         Returns:
             str: response of the llm
         """
         response_string = ""
-        tools_call = None
-        if tools:
-            tools_call = "auto"
-
+        request = completion_request(self.model, self.max_tokens, payload, tools=tools)
         for retry in range(MAX_RETRIES):
             try:
-                rsp = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=payload,
-                    tools=tools,
-                    tool_choice=tools_call,
-                    temperature=TEMPERATURE,
-                    max_tokens=self.max_tokens,
-                    top_p=TOP_P,
-                    frequency_penalty=FREQUENCY_PENALTY,
-                    presence_penalty=PRESENCE_PENALTY,
-                    stop=STOP,
-                    timeout=REQUEST_TIMEOUT,
-                )
-                if tools_call is None:
-                    response_string = rsp.choices[0].message.content
-                else:
-                    response_string = rsp.choices[0].message.tool_calls[0].function
+                rsp = self.client.chat.completions.create(**request)
+                response_string = read_completion(rsp, tools)
                 # exit the retry loop if the llm response is not None
                 if response_string:
                     break
@@ -168,14 +176,120 @@ class GptBackend(LlmBackend):
                 time.sleep(TIME_TO_RETRY)
 
             except Exception as exc:
-                logging.exception("API call failed")
-                if retry == MAX_RETRIES - 1:
-                    msg = f"API call failed after {MAX_RETRIES} retries."
-                    raise RuntimeError(msg) from exc
-                # wait before retrying
-                time.sleep(TIME_TO_RETRY * retry)
+                time.sleep(retry_delay(exc, retry))
         return response_string
 
+    def _stream_payload(self, payload: list[dict]) -> Iterator[str]:
+        """Send payload via a streamed API .create() call and yield the response tokens.
+
+        The call is retried like in _send_payload as long as no token was received: tokens
+        already yielded cannot be taken back, so later failures are raised.
+        """
+        request = completion_request(self.model, self.max_tokens, payload, stream=True)
+        for retry in range(MAX_RETRIES):
+            n_tokens = 0
+            try:
+                for token in read_stream(self.client.chat.completions.create(**request)):
+                    n_tokens += 1
+                    yield token
+                if n_tokens:
+                    return
+                # force pause for API safety
+                time.sleep(TIME_TO_RETRY)
+
+            except Exception as exc:
+                time.sleep(retry_delay(exc, retry, n_tokens=n_tokens))
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def make_payload(query: str, system_function: str) -> list[dict]:
+    """Generate the payload list[hashmap] according to openAI format"""
+    payload = [
+        {"role": "system", "content": system_function},
+        {"role": "user", "content": query},
+    ]
+    return payload
+
+
+def completion_request(
+    model: str,
+    max_tokens: int,
+    payload: list[dict],
+    tools: dict | None = None,
+    stream: bool = False,
+) -> dict:
+    """Arguments of the chat.completions.create call, shared by the sync and async backends.
+
+    Streamed calls do not use tools.
+    """
+    request = {
+        "model": model,
+        "messages": payload,
+        "temperature": TEMPERATURE,
+        "max_tokens": max_tokens,
+        "top_p": TOP_P,
+        "frequency_penalty": FREQUENCY_PENALTY,
+        "presence_penalty": PRESENCE_PENALTY,
+        "stop": STOP,
+        "timeout": REQUEST_TIMEOUT,
+    }
+    if stream:
+        request["stream"] = True
+    else:
+        request["tools"] = tools
+        request["tool_choice"] = "auto" if tools else None
+    return request
+
+
+def read_completion(rsp: Any, tools: dict | None = None) -> str | Any:
+    """Response of a completion: its text, or the "Function" called when tools are given."""
+    if tools:
+        return rsp.choices[0].message.tool_calls[0].function
+    return rsp.choices[0].message.content
+
+
+def read_chunk(chunk: Any) -> str | None:
+    """Token of a streamed completion chunk, None if it holds none."""
+    # Azure sends chunks without choices (e.g. content filter results)
+    if chunk.choices and chunk.choices[0].delta.content:
+        return chunk.choices[0].delta.content
+    return None
+
+
+def read_stream(stream: Iterator) -> Iterator[str]:
+    """Tokens of a streamed completion."""
+    for chunk in stream:
+        token = read_chunk(chunk)
+        if token:
+            yield token
+
+
+def retry_delay(exc: Exception, retry: int, n_tokens: int | None = None) -> float:
+    """Retry policy of the llm backends: pause before retrying a failed API call.
+
+    The exception is logged. The failure is raised as a RuntimeError after MAX_RETRIES tries,
+    or as soon as a streamed call (n_tokens is given) has yielded tokens: they cannot be taken
+    back.
+
+    Args:
+        exc (Exception): exception raised by the API call
+        retry (int): index of the failed try
+        n_tokens (int | None): tokens already yielded by a streamed call, None if not streamed
+
+    Returns:
+        float: pause in seconds before the next try
+    """
+    logging.error("API call failed", exc_info=exc)
+    if n_tokens is None and retry == MAX_RETRIES - 1:
+        msg = f"API call failed after {MAX_RETRIES} retries."
+        raise RuntimeError(msg) from exc
+    if n_tokens is not None and (n_tokens or retry == MAX_RETRIES - 1):
+        msg = f"Streamed API call failed after {retry + 1} tries."
+        raise RuntimeError(msg) from exc
+    return TIME_TO_RETRY * retry
+
 
 if __name__ == "__main__":
     from core.settings.settings import Settings
@@ -187,3 +301,5 @@ if __name__ == "__main__":
     _query = "What is the approximate number of dwellers in San Francisco?"
     response = gpt.get_completion(query=_query, primer_prompt=_system_function)
     print(response)  # noqa: T201
+    for _token in gpt.stream_completion(query=_query, primer_prompt=_system_function):
+        print(_token, end="", flush=True)  # noqa: T201
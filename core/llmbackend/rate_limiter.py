@@ -0,0 +1,78 @@
+""".. include:: README.md
+
+Asynchronous requests-per-minute and tokens-per-minute limiter for the APIs backends.
+"""
+
+import asyncio
+import time
+
+
+class AsyncRateLimiter:
+    """Token-bucket limiter on the number of requests and of tokens sent per minute.
+
+    Both buckets start full and are refilled continuously. A call to acquire() waits until
+    both buckets hold enough capacity for the request, then consumes it.
+
+    Args:
+        requests_per_minute (int): maximum number of requests per minute
+        tokens_per_minute (int): maximum number of tokens per minute
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int) -> None:
+        if requests_per_minute <= 0 or tokens_per_minute <= 0:
+            msg = "Rate limits must be positive"
+            raise ValueError(msg)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until a request of this number of tokens can be sent.
+
+        Requests larger than the tokens-per-minute limit wait for a full bucket.
+        """
+        tokens = min(tokens, self.tokens_per_minute)
+        # the lock makes waiting requests acquire capacity in arrival order
+        async with self._lock:
+            while True:
+                self._refill()
+                missing_requests = 1 - self._available_requests
+                missing_tokens = tokens - self._available_tokens
+                if missing_requests <= 0 and missing_tokens <= 0:
+                    self._available_requests -= 1
+                    self._available_tokens -= tokens
+                    return
+                wait = max(
+                    missing_requests * 60 / self.requests_per_minute,
+                    missing_tokens * 60 / self.tokens_per_minute,
+                )
+                await asyncio.sleep(wait)
+
+    def _refill(self) -> None:
+        """Refill both buckets proportionally to the elapsed time."""
+        now = time.monotonic()
+        elapsed_minutes = (now - self._last_refill) / 60
+        self._last_refill = now
+        self._available_requests = min(
+            self.requests_per_minute,
+            self._available_requests + elapsed_minutes * self.requests_per_minute,
+        )
+        self._available_tokens = min(
+            self.tokens_per_minute,
+            self._available_tokens + elapsed_minutes * self.tokens_per_minute,
+        )
+
+
+if __name__ == "__main__":
+
+    async def _demo() -> None:
+        limiter = AsyncRateLimiter(requests_per_minute=120, tokens_per_minute=10_000)
+        start = time.monotonic()
+        for _ in range(125):
+            await limiter.acquire(tokens=10)
+        print(f"125 requests in {time.monotonic() - start:.2f}s")  # noqa: T201
+
+    asyncio.run(_demo())
@@ -0,0 +1,62 @@
+""".. include:: README.md
+
+Local token counting of the prompts, used to fit them into the context window of the llm models.
+
+Tokens are counted with tiktoken when it is installed, otherwise they are estimated from the
+number of characters (see estimate_tokens).
+"""
+
+from functools import lru_cache
+
+from core.llmbackend.embedder_backend import CHARS_PER_TOKEN, estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+# encoding of the gpt-35-turbo and gpt-4 models
+ENCODING_NAME = "cl100k_base"
+
+
+# =============================================================================
+# user functions
+# =============================================================================
+def count_tokens(text: str) -> int:
+    """Number of tokens of a text."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Keep the first max_tokens tokens of a text."""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is None:
+        if estimate_tokens(text) <= max_tokens:
+            return text
+        return text[: (max_tokens - 1) * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+@lru_cache(maxsize=1)
+def _get_encoding() -> "tiktoken.Encoding | None":
+    """Load the tiktoken encoding once, None when tiktoken or its encoding is unavailable."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception:  # the encoding is downloaded on first use
+        return None
+
+
+if __name__ == "__main__":
+    _text = "How do I compute the PNL of my company? And what does the PNL mean?"
+    print(count_tokens(_text), truncate_tokens(_text, 5))  # noqa: T201
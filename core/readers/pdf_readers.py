@@ -11,14 +11,69 @@ metadata to the output.
 the chunk size if it needed be dynamic
 """
 
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
 import pandas as pd
 import pymupdf
-from tqdm import tqdm
 
 from core.llmbackend.embedder_backend import AdaBackend, EmbedderBackend
 from core.readers.rag_schema import RagSchema
 from core.settings.settings import Settings
 from core.utils import are_similar
+from core.vectorstore.bm25_index import Bm25Index, bm25_index_path, chunk_texts
+from core.vectorstore.embedding_store import (
+    EMBEDDING_COLUMNS,
+    append_vector_store,
+    is_mmap_store,
+    load_embeddings,
+    load_metadata,
+    load_vector_store,
+    recover_vector_store,
+    remove_indexes,
+    save_vector_store,
+    save_vector_store_batches,
+    store_fingerprint,
+    write_parquet_batches,
+)
+from core.vectorstore.ivf_index import IvfIndex, ivf_index_path
+from core.vectorstore.quantization import (
+    QUANTIZATION_MODES,
+    QuantizedIndex,
+    quantized_index_path,
+)
+from core.vectorstore.sharded_store import ShardedVectorStore
+
+PAGE_START = 26
+PAGE_END = 592
+NEW_CHAPTER_MARK = "CHAPTER INTRODUCTION"
+FIRST_CHAPTER = "INTRODUCTION"
+BOOK_TITLE = "Financial Planning & Analysis and Performance Management"
+DROP_PAGE_MARKS = ["TABLE", "FIGURE", "Trim Size"]
+STORE_FORMATS = ["mmap", "parquet"]
+PAGE_COLUMNS = [RagSchema.DOC_ID, RagSchema.PAGE, RagSchema.PAGE_METADATA, RagSchema.PAGE_NUMBER]
+CHUNK_COLUMNS = [
+    RagSchema.DOC_ID,
+    RagSchema.PAGE_METADATA,
+    RagSchema.PAGE_NUMBER,
+    RagSchema.CHUNK,
+    RagSchema.CHUNK_LENGTH,
+]
+# pages parsed together, the parsing memory does not grow with the document size
+PARSE_WINDOW = 128
+# chunks embedded and committed together by the streaming pipeline
+BATCH_SIZE = 256
+STAGING_SUFFIX = ".partial"
+CHECKPOINT_FILE = "checkpoint.json"
 
 
 # =============================================================================
@@ -30,6 +85,12 @@ def pdf_ingestion_pipeline(
     embedder: EmbedderBackend,
     min_len: int = 500,
     max_len: int = 700,
+    build_ivf_index: bool = False,
+    store_format: str = "mmap",
+    quantization: str | None = None,
+    n_workers: int | None = None,
+    doc_id: int = 0,
+    build_bm25_index: bool = False,
 ) -> pd.DataFrame:
     """Pipeline for ingesting pdf files.
 
@@ -38,58 +99,529 @@ def pdf_ingestion_pipeline(
         min_len (int): minimum size of chunks in characters
         file_path (str): Path to your pdf file
         save_path (str): Path to save your output dataframe containing chunks, metas and embeddings
-        embedder (Any): Embeddings engine. Must implement the `encode` method
+        embedder (EmbedderBackend): Embeddings engine. Must implement the `encode_list` method
+        build_ivf_index (bool): also build the approximate search index next to the output file
+        store_format (str): "mmap" saves a directory of memory-mappable embeddings and a slim
+        metadata table, "parquet" saves a single (legacy) parquet file. list: STORE_FORMATS
+        quantization (str | None): also save "int8" or "binary" codes next to the output file,
+        for the quantized search modes of the RagService. list: QUANTIZATION_MODES
+        n_workers (int | None): number of processes parsing the pdf. Defaults to the cpu count.
+        doc_id (int): DOC_ID of the document in the vector store
+        build_bm25_index (bool): also build the lexical BM25 index next to the output file
 
     Returns:
         pd.DataFrame: Output dataframe containing chunks, metas and embeddings.
         This dataframe follows the RagSchema
     """
-    pages = _parse_pages(file_path=file_path)
+    _check_store_options(store_format, quantization, save_path)
+
+    pages = _parse_pages(file_path=file_path, n_workers=n_workers, doc_id=doc_id)
     chunks = _chunk_pages(pages=pages, min_len=min_len, max_len=max_len)
-    final = _embed_chunks(chunks=chunks, embedder=embedder)
-    save_df(df=final, file_path=save_path)
+    if chunks.empty:
+        error_message = f"No chunk found in {file_path} (pages {PAGE_START} to {PAGE_END})"
+        logging.error(error_message)
+        raise ValueError(error_message)
+    # chunks are embedded by batches: a failed embedding stops the pipeline at its batch
+    batches = []
+    for start in range(0, len(chunks), BATCH_SIZE):
+        batch = _embed_chunks(
+            chunks=chunks.iloc[start : start + BATCH_SIZE], embedder=embedder, first_chunk_id=start
+        )
+        if _has_missing_embeddings(batch):
+            error_message = (
+                f"Embedding failed after {start} of {len(chunks)} chunks, the vector store "
+                "was not saved. Use pdf_streaming_ingestion_pipeline to resume failed ingestions"
+            )
+            logging.error(error_message)
+            raise RuntimeError(error_message)
+        batches.append(batch)
+    final = pd.concat(batches, ignore_index=True)
+    if store_format == "mmap":
+        save_vector_store(df=final, dir_path=save_path)
+    else:
+        remove_indexes(save_path)
+        save_df(df=final, file_path=save_path)
+    _build_indexes(save_path, build_ivf_index, quantization, build_bm25_index)
     return final
 
 
+def pdf_streaming_ingestion_pipeline(
+    file_path: str,
+    save_path: str,
+    embedder: EmbedderBackend,
+    min_len: int = 500,
+    max_len: int = 700,
+    batch_size: int = BATCH_SIZE,
+    build_ivf_index: bool = False,
+    store_format: str = "mmap",
+    quantization: str | None = None,
+    n_workers: int | None = None,
+    doc_id: int = 0,
+    build_bm25_index: bool = False,
+) -> int:
+    """Streaming and resumable pipeline for ingesting pdf files.
+
+    Pages are parsed, chunked and embedded lazily, by batches of batch_size chunks. Each embedded
+    batch is committed to a staging directory (save_path + STAGING_SUFFIX) along with a
+    checkpoint. If the pipeline fails (e.g. embedding API throttling), a rerun on the same inputs
+    resumes parsing and embedding after the last committed batch. Once every batch is committed,
+    the batches are written to the store one at a time and the staging directory is removed. Only
+    one batch of embeddings is held in memory.
+
+    Args:
+        file_path (str): Path to your pdf file
+        save_path (str): Path to save the vector store
+        embedder (EmbedderBackend): Embeddings engine. Must implement the `encode_list` method
+        min_len (int): minimum size of chunks in characters
+        max_len (int): maximum size of chunks in characters
+        batch_size (int): number of chunks embedded and committed together
+        build_ivf_index (bool): also build the approximate search index next to the output file
+        store_format (str): format of the vector store. list: STORE_FORMATS
+        quantization (str | None): also save quantized codes next to the output file.
+        list: QUANTIZATION_MODES
+        n_workers (int | None): number of processes parsing the pdf. Defaults to the cpu count.
+        doc_id (int): DOC_ID of the document in the vector store
+        build_bm25_index (bool): also build the lexical BM25 index next to the output file
+
+    Returns:
+        int: number of ingested chunks
+    """
+    _check_store_options(store_format, quantization, save_path)
+    staging_path = save_path + STAGING_SUFFIX
+    fingerprint = _ingestion_fingerprint(file_path, embedder, min_len, max_len, doc_id)
+    checkpoint = _load_checkpoint(staging_path, fingerprint)
+    if checkpoint["n_chunks"]:
+        logging.info("Resuming ingestion after %s chunks", checkpoint["n_chunks"])
+
+    # chunking is deterministic: parsing restarts at the page of the last committed chunk, and
+    # the chunks of that page which are already committed are skipped, not embedded again
+    pages = _iter_pages(
+        file_path,
+        n_workers=n_workers,
+        page_start=checkpoint["page_number"],
+        doc_id=doc_id,
+        chapter=checkpoint["chapter"],
+    )
+    chunks = itertools.islice(
+        _iter_chunks(pages, min_len, max_len), checkpoint["page_chunks"], None
+    )
+    for batch in _batched(chunks, batch_size):
+        embedded = _embed_chunks(
+            pd.DataFrame(batch, columns=CHUNK_COLUMNS),
+            embedder=embedder,
+            first_chunk_id=checkpoint["n_chunks"],
+        )
+        if _has_missing_embeddings(embedded):
+            msg = (
+                f"Embedding failed after {checkpoint['n_chunks']} chunks, "
+                "rerun the pipeline to resume from the last committed batch"
+            )
+            raise RuntimeError(msg)
+        _commit_batch(staging_path, embedded, checkpoint)
+
+    if not checkpoint["n_chunks"]:
+        shutil.rmtree(staging_path)
+        error_message = f"No chunk found in {file_path} (pages {PAGE_START} to {PAGE_END})"
+        logging.error(error_message)
+        raise ValueError(error_message)
+    parts = (pd.read_parquet(part_path) for part_path in _part_paths(staging_path, checkpoint))
+    if store_format == "mmap":
+        save_vector_store_batches(parts, dir_path=save_path, n_rows=checkpoint["n_chunks"])
+    else:
+        remove_indexes(save_path)
+        write_parquet_batches(parts, file_path=save_path, compression=None)
+    shutil.rmtree(staging_path)
+    _build_indexes(save_path, build_ivf_index, quantization, build_bm25_index)
+    return checkpoint["n_chunks"]
+
+
+def pdf_incremental_ingestion_pipeline(
+    file_path: str,
+    save_path: str,
+    embedder: EmbedderBackend,
+    min_len: int = 500,
+    max_len: int = 700,
+    n_workers: int | None = None,
+    doc_id: int = 0,
+) -> pd.DataFrame:
+    """Pipeline for re-ingesting an edited pdf file into its existing vector store.
+
+    The pdf is parsed and chunked again, and each chunk is matched with the stored chunks by the
+    content hash of its text and page metadata. Only new or changed chunks are embedded, and
+    appended to the store. Stored chunks that are not found anymore are tombstoned
+    (RagSchema.DELETED): they keep their row, but are not retrieved anymore. Unchanged chunks
+    keep their row and CHUNK_ID, only their page number is updated.
+    The vector store is created if it does not exist yet.
+
+    Args:
+        file_path (str): Path to your pdf file
+        save_path (str): Path of the vector store directory
+        embedder (EmbedderBackend): Embeddings engine. Must implement the `encode_list` method
+        min_len (int): minimum size of chunks in characters
+        max_len (int): maximum size of chunks in characters
+        n_workers (int | None): number of processes parsing the pdf. Defaults to the cpu count.
+        doc_id (int): DOC_ID of the document in the vector store
+
+    Returns:
+        pd.DataFrame: updated chunks table of the vector store, without embeddings
+    """
+    recover_vector_store(save_path)
+    if not is_mmap_store(save_path):
+        if os.path.exists(save_path):
+            msg = "Incremental ingestion requires a vector store directory (mmap format)"
+            raise ValueError(msg)
+        pdf_ingestion_pipeline(
+            file_path, save_path, embedder, min_len, max_len, n_workers=n_workers, doc_id=doc_id
+        )
+        return load_metadata(save_path)
+
+    store = load_metadata(save_path)
+    if RagSchema.DELETED not in store.columns:
+        store[RagSchema.DELETED] = False
+    pages = _parse_pages(file_path=file_path, n_workers=n_workers, doc_id=doc_id)
+    chunks = _chunk_pages(pages=pages, min_len=min_len, max_len=max_len)
+
+    # live stored rows of the document by content hash, duplicated chunks are matched in order
+    stored_rows = defaultdict(list)
+    stored_hashes = _chunk_hashes(store)
+    is_live = ~store[RagSchema.DELETED].to_numpy(dtype=bool)
+    is_document = store[RagSchema.DOC_ID].to_numpy() == doc_id
+    for row in np.flatnonzero(is_live & is_document):
+        stored_rows[stored_hashes[row]].append(int(row))
+    for rows in stored_rows.values():
+        rows.reverse()
+    matched_rows = np.array(
+        [
+            stored_rows[text_hash].pop() if stored_rows[text_hash] else -1
+            for text_hash in _chunk_hashes(chunks)
+        ],
+        dtype=np.int64,
+    )
+
+    # unchanged chunks may have moved to another page
+    is_matched = matched_rows >= 0
+    page_numbers = chunks[RagSchema.PAGE_NUMBER].to_numpy()[is_matched]
+    store.loc[matched_rows[is_matched], RagSchema.PAGE_NUMBER] = page_numbers
+    # tombstone the chunks whose source disappeared
+    removed_rows = [row for rows in stored_rows.values() for row in rows]
+    store.loc[removed_rows, RagSchema.DELETED] = True
+
+    new_chunks = chunks[~is_matched].reset_index(drop=True)
+    first_chunk_id = int(store[RagSchema.CHUNK_ID].max()) + 1 if len(store) else 0
+    new_rows = _embed_chunks(new_chunks, embedder, first_chunk_id=first_chunk_id)
+    if _has_missing_embeddings(new_rows):
+        msg = "Embedding failed, the vector store was not updated"
+        raise RuntimeError(msg)
+    new_rows[RagSchema.DELETED] = False
+    # appending removes the indexes of the store: the lexical index is cheap to rebuild,
+    # approximate indexes are rebuilt by the RagService
+    had_bm25_index = os.path.exists(bm25_index_path(save_path))
+    append_vector_store(store, new_rows, dir_path=save_path)
+    _build_indexes(save_path, False, None, build_bm25_index=had_bm25_index)
+    logging.info(
+        "Incremental ingestion: %s unchanged, %s new and %s tombstoned chunks",
+        int(is_matched.sum()),
+        len(new_rows),
+        len(removed_rows),
+    )
+    return load_metadata(save_path)
+
+
+def add_pdf_document(
+    file_path: str,
+    store: ShardedVectorStore,
+    embedder: EmbedderBackend,
+    name: str | None = None,
+    min_len: int = 500,
+    max_len: int = 700,
+    build_ivf_index: bool = False,
+    quantization: str | None = None,
+    n_workers: int | None = None,
+) -> int:
+    """Ingest a pdf file as a new document of a sharded vector store.
+
+    The document is ingested into its own shard with the streaming pipeline, the other
+    documents of the store are left untouched.
+
+    Args:
+        file_path (str): Path to your pdf file
+        store (ShardedVectorStore): multi-document vector store
+        embedder (EmbedderBackend): Embeddings engine. Must implement the `encode_list` method
+        name (str | None): name of the document. Defaults to the file name.
+        min_len (int): minimum size of chunks in characters
+        max_len (int): maximum size of chunks in characters
+        build_ivf_index (bool): also build the approximate search index of the shard
+        quantization (str | None): also save quantized codes of the shard.
+        list: QUANTIZATION_MODES
+        n_workers (int | None): number of processes parsing the pdf. Defaults to the cpu count.
+
+    Returns:
+        int: DOC_ID of the document
+    """
+    doc_id, shard_path = store.new_shard()
+    pdf_streaming_ingestion_pipeline(
+        file_path,
+        shard_path,
+        embedder,
+        min_len=min_len,
+        max_len=max_len,
+        build_ivf_index=build_ivf_index,
+        quantization=quantization,
+        n_workers=n_workers,
+        doc_id=doc_id,
+    )
+    store.add_document(doc_id, name=name or os.path.basename(file_path))
+    return doc_id
+
+
 # =============================================================================
 # support functions
 # =============================================================================
+def _check_store_options(store_format: str, quantization: str | None, save_path: str) -> None:
+    """Validate the vector store options of the ingestion pipelines.
+
+    A legacy parquet store can be replaced by a vector store directory (migration), the
+    opposite is rejected: a parquet file cannot be written over a directory.
+    """
+    if store_format not in STORE_FORMATS:
+        msg = f"Invalid store format, use only: {STORE_FORMATS}"
+        raise ValueError(msg)
+    if quantization is not None and quantization not in QUANTIZATION_MODES:
+        msg = f"Invalid quantization mode, use only: {QUANTIZATION_MODES}"
+        raise ValueError(msg)
+    if store_format == "parquet" and is_mmap_store(save_path):
+        error_message = f"{save_path} is a vector store directory, save it with the mmap format"
+        logging.error(error_message)
+        raise ValueError(error_message)
+
+
+def _build_indexes(
+    save_path: str, build_ivf_index: bool, quantization: str | None, build_bm25_index: bool
+) -> None:
+    """Build the optional search indexes of a saved vector store, next to it.
+
+    Each index records the fingerprint of the store, see store_fingerprint.
+    """
+    if not build_ivf_index and quantization is None and not build_bm25_index:
+        return
+    metadata, embeddings = load_vector_store(save_path)
+    indexes = {}
+    if build_bm25_index:
+        indexes[bm25_index_path(save_path)] = Bm25Index.build(chunk_texts(metadata))
+    if build_ivf_index:
+        indexes[ivf_index_path(save_path)] = IvfIndex.build(embeddings, normalized=True)
+    if quantization is not None:
+        indexes[quantized_index_path(save_path, quantization)] = QuantizedIndex.build(
+            embeddings, quantization
+        )
+    source = store_fingerprint(save_path)
+    for index_path, index in indexes.items():
+        index.source = source
+        index.save(index_path)
+
+
+def _ingestion_fingerprint(
+    file_path: str, embedder: EmbedderBackend, min_len: int, max_len: int, doc_id: int
+) -> str:
+    """Identify the inputs of an ingestion: a checkpoint is only resumed with the same inputs."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            digest.update(block)
+    model = getattr(embedder, "model", type(embedder).__name__)
+    digest.update(f"{model}|{min_len}|{max_len}|{PAGE_START}|{PAGE_END}|{doc_id}".encode())
+    return digest.hexdigest()
+
+
+def _load_checkpoint(staging_path: str, fingerprint: str) -> dict:
+    """Load the checkpoint of a previous run on the same inputs, or start a new staging dir."""
+    checkpoint_path = os.path.join(staging_path, CHECKPOINT_FILE)
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as file:
+            checkpoint = json.load(file)
+        # checkpoints written before the parsing position was recorded cannot be resumed
+        if checkpoint["fingerprint"] == fingerprint and "page_number" in checkpoint:
+            return checkpoint
+        logging.info("Inputs changed since the last checkpoint, restarting ingestion")
+    shutil.rmtree(staging_path, ignore_errors=True)
+    os.makedirs(staging_path)
+    return {
+        "fingerprint": fingerprint,
+        "n_batches": 0,
+        "n_chunks": 0,
+        "page_number": PAGE_START,
+        "page_chunks": 0,
+        "chapter": FIRST_CHAPTER,
+    }
 
-PAGE_START = 26
-PAGE_END = 592
-NEW_CHAPTER_MARK = "CHAPTER INTRODUCTION"
-BOOK_TITLE = "Financial Planning & Analysis and Performance Management"
-DROP_PAGE_MARKS = ["TABLE", "FIGURE", "Trim Size"]
 
+def _commit_batch(staging_path: str, batch: pd.DataFrame, checkpoint: dict) -> None:
+    """Write a batch to the staging directory, then record it in the checkpoint.
 
-def _parse_pages(file_path: str) -> pd.DataFrame:
+    Both files are written under a temporary name and renamed, which is atomic: a batch is
+    either committed or ignored by the next run.
+    The checkpoint also records the parsing position: the page of the last committed chunk, its
+    chapter and its number of committed chunks (chunks never span pages).
+    """
+    part_path = _part_path(staging_path, checkpoint["n_batches"])
+    batch.to_parquet(part_path + ".tmp", index=False)
+    os.replace(part_path + ".tmp", part_path)
+
+    checkpoint["n_batches"] += 1
+    checkpoint["n_chunks"] += len(batch)
+    last_page = int(batch[RagSchema.PAGE_NUMBER].iloc[-1])
+    on_last_page = int((batch[RagSchema.PAGE_NUMBER] == last_page).sum())
+    if last_page == checkpoint["page_number"]:
+        on_last_page += checkpoint["page_chunks"]
+    checkpoint["page_number"] = last_page
+    checkpoint["page_chunks"] = on_last_page
+    checkpoint["chapter"] = batch[RagSchema.PAGE_METADATA].iloc[-1]
+    checkpoint_path = os.path.join(staging_path, CHECKPOINT_FILE)
+    with open(checkpoint_path + ".tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+def _part_paths(staging_path: str, checkpoint: dict) -> list[str]:
+    """Paths of the committed batches, in order."""
+    return [_part_path(staging_path, idx) for idx in range(checkpoint["n_batches"])]
+
+
+def _part_path(staging_path: str, batch_idx: int) -> str:
+    """Path of a committed batch."""
+    return os.path.join(staging_path, f"part-{batch_idx:05d}.parquet")
+
+
+def _chunk_hashes(chunks: pd.DataFrame) -> list[str]:
+    """Content hash of chunks: their text and page metadata, from which they are embedded."""
+    return [
+        hashlib.sha256(f"{metadata}\n{chunk}".encode()).hexdigest()
+        for metadata, chunk in zip(
+            chunks[RagSchema.PAGE_METADATA], chunks[RagSchema.CHUNK], strict=True
+        )
+    ]
+
+
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Group the items of an iterable into lists of size items (the last one can be shorter)."""
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _parse_pages(
+    file_path: str,
+    n_workers: int | None = None,
+    page_start: int = PAGE_START,
+    page_end: int = PAGE_END,
+    doc_id: int = 0,
+) -> pd.DataFrame:
     """Parse pdf into pages and return as a dataframe.
 
     This ignores pages that are out of bounds.
     This removes chapters and book names on top of pages.
     This removes pages containing a figure, table or noisy box data
     """
-    output_pages = {
-        RagSchema.DOC_ID: [],
-        RagSchema.PAGE: [],
-        RagSchema.PAGE_METADATA: [],
-        RagSchema.PAGE_NUMBER: [],
-    }
+    pages = _iter_pages(file_path, n_workers, page_start, page_end, doc_id)
+    return pd.DataFrame(list(pages), columns=PAGE_COLUMNS)
+
 
+def _iter_pages(
+    file_path: str,
+    n_workers: int | None = None,
+    page_start: int = PAGE_START,
+    page_end: int = PAGE_END,
+    doc_id: int = 0,
+    chapter: str = FIRST_CHAPTER,
+) -> Iterator[dict]:
+    """Parse pdf into pages, yielded as RagSchema records by windows of PARSE_WINDOW pages.
+
+    Text extraction and line cleaning run in a process pool, on contiguous page-range shards.
+    The chapter of each page depends on the previous pages, it is found sequentially in between.
+    chapter is the chapter of the page preceding page_start (or of page_start itself).
+    The output is identical to a sequential parsing (n_workers=1).
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    stop = page_end + 1
+    with pymupdf.open(file_path) as doc:
+        stop = min(stop, len(doc))
+
+    current_chapter = chapter
+    with ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else nullcontext() as pool:
+        map_shards = pool.map if pool else map
+        for window_start in range(page_start, stop, PARSE_WINDOW):
+            shards = _make_shards(window_start, min(window_start + PARSE_WINDOW, stop), n_workers)
+            texts = _flatten(
+                map_shards(_extract_texts, [file_path] * len(shards), *zip(*shards, strict=True))
+            )
+            chapters = _find_chapters(texts, current_chapter)
+            current_chapter = chapters[-1]
+            # shards of the (text, chapter) lists, in the same page ranges
+            bounds = [(first - window_start, last - window_start) for first, last in shards]
+            cleaned_pages = _flatten(
+                map_shards(
+                    _clean_pages,
+                    [texts[first:last] for first, last in bounds],
+                    [chapters[first:last] for first, last in bounds],
+                )
+            )
+
+            for idx, (cleaned_page, chapter) in enumerate(
+                zip(cleaned_pages, chapters, strict=True)
+            ):
+                # dropped pages
+                if cleaned_page is None:
+                    continue
+                yield {
+                    RagSchema.DOC_ID: doc_id,
+                    RagSchema.PAGE: cleaned_page,
+                    RagSchema.PAGE_METADATA: chapter,
+                    RagSchema.PAGE_NUMBER: window_start + idx,
+                }
+
+
+def _make_shards(start: int, stop: int, n_shards: int) -> list[tuple[int, int]]:
+    """Split the [start, stop) page range into contiguous (first, last) ranges."""
+    bounds = np.linspace(start, stop, num=max(1, min(n_shards, stop - start)) + 1, dtype=int)
+    return [(int(first), int(last)) for first, last in itertools.pairwise(bounds)]
+
+
+def _flatten(shards: Iterable[list]) -> list:
+    """Concatenate the per-shard results, in shard order."""
+    return list(itertools.chain.from_iterable(shards))
+
+
+def _extract_texts(file_path: str, first: int, last: int) -> list[str]:
+    """Extract the text of the pages [first, last) of a pdf (run in worker processes)."""
     with pymupdf.open(file_path) as doc:
-        pages = [page.get_text() for page in doc]
+        return [doc[idx].get_text() for idx in range(first, last)]
 
-    current_chapter = "INTRODUCTION"
-    for idx, page in enumerate(pages):
-        # ignore out of bound pages
-        if idx < PAGE_START or idx > PAGE_END:
-            continue
+
+def _find_chapters(texts: list[str], current_chapter: str) -> list[str]:
+    """Find the chapter of each page: the one started by the last page holding a chapter mark.
+
+    current_chapter is the chapter of the page preceding the first text.
+    """
+    chapters = []
+    for page in texts:
         # define the current chapter (for metadata)
         if NEW_CHAPTER_MARK in page:
             current_chapter = page.split(NEW_CHAPTER_MARK)[0].strip()
             current_chapter = current_chapter.split("\n")[1:]
             current_chapter = " ".join(current_chapter).lower()
+        chapters.append(current_chapter)
+    return chapters
+
+
+def _clean_pages(texts: list[str], chapters: list[str]) -> list[str | None]:
+    """Clean pages given their chapter (run in worker processes).
 
+    Returns:
+        list[str | None]: cleaned pages, None for dropped pages
+    """
+    cleaned_pages = []
+    for page, current_chapter in zip(texts, chapters, strict=True):
         # strip current page of chapter and book title
         cleaned_page = []
         current_page = page.split("\n")
@@ -102,21 +634,12 @@ def _parse_pages(file_path: str) -> pd.DataFrame:
             cleaned_page.append(line)
         # group into pages
         cleaned_page = "\n".join(cleaned_page)
-        # drop empty pages
-        if len(cleaned_page) == 0:
-            continue
-        # drop pages containing drop marks
-        if any(mark in cleaned_page for mark in DROP_PAGE_MARKS):
+        # drop empty pages and pages containing drop marks
+        if len(cleaned_page) == 0 or any(mark in cleaned_page for mark in DROP_PAGE_MARKS):
+            cleaned_pages.append(None)
             continue
-
-        output_pages[RagSchema.DOC_ID].append(0)
-        output_pages[RagSchema.PAGE].append(cleaned_page)
-        output_pages[RagSchema.PAGE_METADATA].append(current_chapter)
-        output_pages[RagSchema.PAGE_NUMBER].append(idx)
-
-    # convert to dataframe
-    output_pages = pd.DataFrame.from_dict(output_pages, orient="columns")
-    return output_pages
+        cleaned_pages.append(cleaned_page)
+    return cleaned_pages
 
 
 def _chunk_pages(pages: pd.DataFrame, min_len: int = 500, max_len: int = 700) -> pd.DataFrame:
@@ -124,25 +647,21 @@ def _chunk_pages(pages: pd.DataFrame, min_len: int = 500, max_len: int = 700) ->
 
     Chunks are created using the _split_string_approx() function.
     """
-    output_chunks = {
-        RagSchema.DOC_ID: [],
-        RagSchema.PAGE_METADATA: [],
-        RagSchema.PAGE_NUMBER: [],
-        RagSchema.CHUNK: [],
-        RagSchema.CHUNK_LENGTH: [],
-    }
+    chunks = _iter_chunks(pages.to_dict(orient="records"), min_len, max_len)
+    return pd.DataFrame(list(chunks), columns=CHUNK_COLUMNS)
 
-    for row in pages.iterrows():
-        chunk_list = _split_string_approx(row[1][RagSchema.PAGE], min_len, max_len)
-        for chunk in chunk_list:
-            output_chunks[RagSchema.DOC_ID].append(row[1][RagSchema.DOC_ID])
-            output_chunks[RagSchema.PAGE_METADATA].append(row[1][RagSchema.PAGE_METADATA])
-            output_chunks[RagSchema.PAGE_NUMBER].append(row[1][RagSchema.PAGE_NUMBER])
-            output_chunks[RagSchema.CHUNK].append(chunk)
-            output_chunks[RagSchema.CHUNK_LENGTH].append(len(chunk))
 
-    output_chunks = pd.DataFrame.from_dict(output_chunks, orient="columns")
-    return output_chunks
+def _iter_chunks(pages: Iterable[dict], min_len: int = 500, max_len: int = 700) -> Iterator[dict]:
+    """Split page records into chunk records, lazily."""
+    for page in pages:
+        for chunk in _split_string_approx(page[RagSchema.PAGE], min_len, max_len):
+            yield {
+                RagSchema.DOC_ID: page[RagSchema.DOC_ID],
+                RagSchema.PAGE_METADATA: page[RagSchema.PAGE_METADATA],
+                RagSchema.PAGE_NUMBER: page[RagSchema.PAGE_NUMBER],
+                RagSchema.CHUNK: chunk,
+                RagSchema.CHUNK_LENGTH: len(chunk),
+            }
 
 
 def _split_string_approx(text: str, min_length: int = 500, max_length: int = 700) -> list[str]:
@@ -178,56 +697,58 @@ def _split_string_approx(text: str, min_length: int = 500, max_length: int = 700
     return chunks
 
 
-def _embed_chunks(chunks: pd.DataFrame, embedder: EmbedderBackend) -> pd.DataFrame:
+def _embed_chunks(
+    chunks: pd.DataFrame, embedder: EmbedderBackend, first_chunk_id: int = 0
+) -> pd.DataFrame:
     """Add embeddings vectors to chunks dataframe.
 
-    This function also computes the embeddings of metadata, and of metadata+chunk
+    This function also computes the embeddings of metadata, and of metadata+chunk.
+    Each distinct text of the three columns is embedded once, in batches, and its vector is
+    scattered back to every row using it (e.g. a chapter title shared by many chunks).
+    Chunks are numbered from first_chunk_id, for chunks embedded by batches.
     """
+    chunk_texts = chunks[RagSchema.CHUNK].to_list()
+    metadata_texts = chunks[RagSchema.PAGE_METADATA].to_list()
+    chunk_w_metadata_texts = [
+        metadata + "\n" + chunk for metadata, chunk in zip(metadata_texts, chunk_texts, strict=True)
+    ]
+
+    # embed distinct texts only, keeping their first-seen order
+    unique_texts = list(dict.fromkeys(chunk_texts + metadata_texts + chunk_w_metadata_texts))
+    vectors = dict(zip(unique_texts, embedder.encode_list(unique_texts), strict=True))
+
     output_embeddings = {
-        RagSchema.DOC_ID: [],
-        RagSchema.PAGE_METADATA: [],
-        RagSchema.PAGE_NUMBER: [],
-        RagSchema.CHUNK_ID: [],
-        RagSchema.CHUNK: [],
-        RagSchema.CHUNK_LENGTH: [],
-        RagSchema.CHUNK_EMBEDDING: [],
-        RagSchema.PAGE_METADATA_EMBEDDING: [],
-        RagSchema.CHUNK_W_METADATA_EMBEDDING: [],
+        RagSchema.DOC_ID: chunks[RagSchema.DOC_ID].to_list(),
+        RagSchema.PAGE_METADATA: metadata_texts,
+        RagSchema.PAGE_NUMBER: chunks[RagSchema.PAGE_NUMBER].to_list(),
+        RagSchema.CHUNK_ID: list(range(first_chunk_id, first_chunk_id + len(chunks))),
+        RagSchema.CHUNK: chunk_texts,
+        RagSchema.CHUNK_LENGTH: chunks[RagSchema.CHUNK_LENGTH].to_list(),
+        RagSchema.CHUNK_EMBEDDING: [vectors[text] for text in chunk_texts],
+        RagSchema.PAGE_METADATA_EMBEDDING: [vectors[text] for text in metadata_texts],
+        RagSchema.CHUNK_W_METADATA_EMBEDDING: [vectors[text] for text in chunk_w_metadata_texts],
     }
-    # iterate through rows and embed chunks, metadata and chunks + metadata
-    for idx, row in tqdm(enumerate(chunks.iterrows())):
-        # place misc values in output
-        output_embeddings[RagSchema.DOC_ID].append(row[1][RagSchema.DOC_ID])
-        output_embeddings[RagSchema.PAGE_METADATA].append(row[1][RagSchema.PAGE_METADATA])
-        output_embeddings[RagSchema.PAGE_NUMBER].append(row[1][RagSchema.PAGE_NUMBER])
-        output_embeddings[RagSchema.CHUNK_ID].append(idx)
-        output_embeddings[RagSchema.CHUNK].append(row[1][RagSchema.CHUNK])
-        output_embeddings[RagSchema.CHUNK_LENGTH].append(row[1][RagSchema.CHUNK_LENGTH])
-
-        # embed chunk and place vector in output
-        chunk_embedding = embedder.encode(row[1][RagSchema.CHUNK])
-        output_embeddings[RagSchema.CHUNK_EMBEDDING].append(chunk_embedding)
-
-        # embed metadata and place vector in output
-        page_metadata_embedding = embedder.encode(row[1][RagSchema.PAGE_METADATA])
-        output_embeddings[RagSchema.PAGE_METADATA_EMBEDDING].append(page_metadata_embedding)
-
-        # embed chunk+metadata and place vector in output
-        chunk_w_metadata = row[1][RagSchema.PAGE_METADATA] + "\n" + row[1][RagSchema.CHUNK]
-        chunk_w_metadata_embedding = embedder.encode(chunk_w_metadata)
-        output_embeddings[RagSchema.CHUNK_W_METADATA_EMBEDDING].append(chunk_w_metadata_embedding)
-
     output_embeddings = pd.DataFrame.from_dict(output_embeddings, orient="columns")
     return output_embeddings
 
 
+def _has_missing_embeddings(chunks: pd.DataFrame) -> bool:
+    """Check if an embedding of any of the EMBEDDING_COLUMNS failed (None vector)."""
+    return bool(chunks[EMBEDDING_COLUMNS].isna().any(axis=None))
+
+
 def save_df(df: pd.DataFrame, file_path: str) -> None:
     """Save dataframe to parquet."""
     df.to_parquet(file_path, index=False, compression=None)
 
 
 def load_df(file_path: str) -> pd.DataFrame:
-    """Load dataframe from parquet."""
+    """Load dataframe from parquet, or from a memory-mapped vector store directory."""
+    if is_mmap_store(file_path):
+        loaded_df = load_metadata(file_path)
+        for column in EMBEDDING_COLUMNS:
+            loaded_df[column] = list(load_embeddings(file_path, column))
+        return loaded_df
     loaded_df = pd.read_parquet(file_path)
     return loaded_df
 
@@ -19,6 +19,8 @@ class RagSchema:
     PAGE_METADATA_EMBEDDING = "page_metadata_embedding"
     CHUNK_W_METADATA_EMBEDDING = "chunk_with_metadata_embedding"
     CHUNK_LENGTH = "chunk_length"
+    # tombstone of chunks removed from their source by an incremental ingestion
+    DELETED = "deleted"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+""".. include:: README.md
+
+Token-budget aware packing of the retrieved chunks into the RAG prompts.
+
+Chunks are ordered by decreasing score, near-duplicates of a better chunk are dropped, and the
+remaining chunks are added until the prompt token budget is reached. The first chunk that does
+not fit is truncated to the remaining budget, so that requests are never larger than the model
+accepts (oversized requests are slower, more expensive, and rejected then retried by the llm
+backend).
+"""
+
+import re
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from core.llmbackend.tokenizer import count_tokens, truncate_tokens
+from core.vectorstore.search_index import DUPLICATE_SIMILARITY
+
+# truncated chunks shorter than this number of tokens are dropped rather than sent
+MIN_TRUNCATED_TOKENS = 32
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+@dataclass
+class PackedContext:
+    """Chunks packed into a prompt token budget.
+
+    Attributes:
+        positions (list[int]): positions of the packed chunks in the candidates, best first
+        chunks (list[str]): packed chunks, the last one may be truncated
+        n_tokens (int): number of tokens of the packed chunks
+        truncated (bool): some candidates (other than duplicates) were truncated or dropped to
+        fit the budget
+    """
+
+    positions: list[int] = field(default_factory=list)
+    chunks: list[str] = field(default_factory=list)
+    n_tokens: int = 0
+    truncated: bool = False
+
+
+class ContextPacker:
+    """Pack chunks into a prompt token budget. Use only: pack
+
+    Args:
+        token_budget (int): maximum number of tokens of the packed chunks
+        duplicate_similarity (float): cosine similarity above which a chunk is a near-duplicate
+        of a better scored chunk
+    """
+
+    def __init__(
+        self, token_budget: int, duplicate_similarity: float = DUPLICATE_SIMILARITY
+    ) -> None:
+        self.token_budget = token_budget
+        self.duplicate_similarity = duplicate_similarity
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def pack(
+        self, chunks: list[str], scores: np.ndarray, vectors: np.ndarray | None = None
+    ) -> PackedContext:
+        """Select the best scored, distinct chunks fitting the token budget.
+
+        Args:
+            chunks (list[str]): candidate chunks
+            scores (np.ndarray): (n_chunks,) score of each chunk, higher is better
+            vectors (np.ndarray | None): (n_chunks, dim) L2-normalized chunk embeddings, used to
+            find near-duplicates. Without vectors, only chunks of identical text are duplicates.
+
+        Returns:
+            PackedContext: packed chunks, best first
+        """
+        packed = PackedContext()
+        kept_texts = set()
+        kept_vectors = []
+        for position in np.argsort(-np.asarray(scores), kind="stable").tolist():
+            chunk = chunks[position]
+            if self._is_duplicate(chunk, position, vectors, kept_texts, kept_vectors):
+                continue
+            remaining = self.token_budget - packed.n_tokens
+            chunk_tokens = count_tokens(chunk)
+            if chunk_tokens > remaining:
+                packed.truncated = True
+                if remaining < MIN_TRUNCATED_TOKENS:
+                    break
+                chunk = truncate_tokens(chunk, remaining)
+                chunk_tokens = count_tokens(chunk)
+            packed.positions.append(position)
+            packed.chunks.append(chunk)
+            packed.n_tokens += chunk_tokens
+            kept_texts.add(_normalize(chunks[position]))
+            if vectors is not None:
+                kept_vectors.append(vectors[position])
+        return packed
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _is_duplicate(
+        self,
+        chunk: str,
+        position: int,
+        vectors: np.ndarray | None,
+        kept_texts: set[str],
+        kept_vectors: list[np.ndarray],
+    ) -> bool:
+        """Check if a chunk repeats the text, or is too similar to the vector, of a kept chunk."""
+        if _normalize(chunk) in kept_texts:
+            return True
+        if vectors is None or not kept_vectors:
+            return False
+        similarities = np.stack(kept_vectors) @ vectors[position]
+        return bool(similarities.max() > self.duplicate_similarity)
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _normalize(text: str) -> str:
+    """Lowercase text with collapsed whitespaces, to compare chunks text."""
+    return WHITESPACE_PATTERN.sub(" ", text).strip().lower()
+
+
+if __name__ == "__main__":
+    _packer = ContextPacker(token_budget=40)
+    print(_packer.pack(["PnL  of the company", "pnl of the company", "ROI " * 50], [3, 2, 1]))  # noqa: T201
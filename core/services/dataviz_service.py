@@ -3,6 +3,9 @@
 Use this service to create simple data visualizations out of the database.
 """
 
+import asyncio
+from collections.abc import Awaitable
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -41,6 +44,26 @@ def dataviz_tunnel(query: str, llm: LlmBackend) -> tuple[pd.DataFrame, str, list
     return requested_data, table_name, figs
 
 
+async def adataviz_tunnel(
+    query: str, llm: LlmBackend, data_request: Awaitable | None = None
+) -> tuple[pd.DataFrame, str, list[plt.Figure]]:
+    """Run a simple dataviz pipeline from a user query, see dataviz_tunnel.
+
+    The data request and the choice of the dataviz function do not depend on each other: both
+    llm calls are sent concurrently. An already sent data request can be given, see
+    DbQueryEngine.arequest_tunnel.
+    """
+    request_service = await asyncio.to_thread(DbQueryEngine, llm)
+    (requested_data, table_name), display_tools = await asyncio.gather(
+        request_service.arequest_tunnel(query, data_request),
+        llm.aget_completion(query=query, primer_prompt=DATAVIZ_PROMPT, tools=DATAVIZ_TOOLS),
+    )
+    function_name = read_tooled_response(display_tools)["function_name"]
+    function = globals().get(function_name)
+    figs = function(requested_data, table_name)
+    return requested_data, table_name, figs
+
+
 def plot_timeseries(df: pd.DataFrame, title: str | None = None) -> list[plt.Figure]:
     """Generate a timeseries plot of the given data and returns a list of figure objects"""
     fig, ax = plt.subplots()
@@ -4,6 +4,7 @@ This engine is used to fetch data from the database (multiple pandas dataframes)
 In general this engine should be replaced by your SQL engine.
 """
 
+from collections.abc import Awaitable
 from datetime import datetime
 
 import pandas as pd
@@ -74,6 +75,24 @@ class DbQueryEngine:
         requested_data, table_name = self._request(table_name, columns, start_date, end_date)
         return requested_data, table_name
 
+    async def arequest_tunnel(
+        self, query: str, data_request: Awaitable | None = None
+    ) -> tuple[pd.DataFrame, str]:
+        """Request data from a user query, see request_tunnel.
+
+        Args:
+            query (str): user query
+            data_request (Awaitable | None): llm tool call of the DATAENG_PROMPT already sent for
+            the query (see arun_system), awaited instead of sending a new call.
+        """
+        if data_request is None:
+            data_request = self.llm.aget_completion(
+                query=query, primer_prompt=DATAENG_PROMPT, tools=DATAENG_TOOLS
+            )
+        data_request = await data_request
+        table_name, columns, start_date, end_date = self._parse_llm_response(data_request)
+        return self._request(table_name, columns, start_date, end_date)
+
     # =============================================================================
     # internal functions
     # =============================================================================
@@ -4,8 +4,10 @@ Use this engine to generate forcast on data.
 In general this engine would be your ML pipeline APIs.
 """
 
+import asyncio
 import time
 import warnings
+from collections.abc import Awaitable
 
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -53,10 +55,43 @@ class ForecastService:
         )
         return requested_data, table_name, figs
 
+    async def aforecast_tunnel(
+        self, query: str, data_request: Awaitable | None = None
+    ) -> tuple[pd.DataFrame, str, list[plt.Figure]]:
+        """Run the entire forecasting pipeline from a user query, see forecast_tunnel.
+
+        The data request and the scenario agent do not depend on each other: both llm calls
+        are sent concurrently. The forecast runs in a worker thread. An already sent data
+        request can be given, see DbQueryEngine.arequest_tunnel.
+        """
+        (requested_data, table_name), scenario = await asyncio.gather(
+            self.db_query_engine.arequest_tunnel(query, data_request), self._aget_scenario(query)
+        )
+        figs = await asyncio.to_thread(
+            self._arima_forecast_and_plot,
+            df=requested_data,
+            title=table_name,
+            steps=10,
+            scenario=scenario,
+        )
+        return requested_data, table_name, figs
+
     def _get_scenario(self, query: str) -> str:
         """Get the scenario from the user query."""
         forecast_query = FORECAST_QUERY.replace("{query}", query)
         scenario = self.llm.get_completion(query=forecast_query, primer_prompt=FORECAST_PROMPT)
+        return self._match_scenario(scenario)
+
+    async def _aget_scenario(self, query: str) -> str:
+        """Get the scenario from the user query, see _get_scenario."""
+        forecast_query = FORECAST_QUERY.replace("{query}", query)
+        scenario = await self.llm.aget_completion(
+            query=forecast_query, primer_prompt=FORECAST_PROMPT
+        )
+        return self._match_scenario(scenario)
+
+    def _match_scenario(self, scenario: str) -> str:
+        """Match the llm answer to one of the scenarios, the first one by default."""
         if are_similar(scenario, self.scenarios[0]):
             scenario = self.scenarios[0]
         elif are_similar(scenario, self.scenarios[1]):
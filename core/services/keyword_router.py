@@ -0,0 +1,211 @@
+""".. include:: README.md
+
+Local keyword classifier of the user queries, the fast path of the RouterService.
+
+Most queries state their intent with a few words: "forecast", "histogram", "what does ... mean".
+The classifier matches the intent patterns of the Analyst, Data Visualization and Financial
+Consulting pipelines, and routes the queries without intent but about the company data (a
+measure such as costs or profits, and a scope such as a year or a sector) to Data Engineering.
+It runs in microseconds, without API call: the routing llm is only called when the classifier
+is not confident (mixed intents, few data words, data shown without saying how, spam).
+"""
+
+import re
+from dataclasses import dataclass
+
+# names of the pipelines, as answered by the routing llm (see ROUTING_PROMPT)
+ANALYST = "Analyst"
+DATA_VISUALIZATION = "Data Visualization"
+FINANCIAL_CONSULTING = "Financial Consulting"
+DATA_ENGINEERING = "Data Engineering"
+
+# "how can our company reduce its costs ?" asks for advice
+HOW_TO_SUBJECTS = r"(i|we|you|one|(a|my|our) company)"
+HOW_TO_VERBS = r"(compute|calculate|measure|improve|make|increase|reduce|grow)"
+INTENT_PATTERNS = {
+    ANALYST: [
+        r"\bfor+e?c+ast",
+        r"\bpredict",
+        r"\bprojections?\b",
+        r"\barima\b",
+        r"\bprophet\b",
+        r"\bregression\b",
+        r"\b(next|coming|following) (year|quarter|month|semester)s?\b",
+        r"\b(optimistic|pessimistic|neutral) scenario",
+    ],
+    DATA_VISUALIZATION: [
+        r"\bhistograms?\b",
+        r"\bcharts?\b",
+        r"\bplots?\b",
+        r"\bgraphs?\b",
+        r"\bvisuali[sz]",
+        r"\bdashboards?\b",
+        r"\bpower ?bi\b",
+        r"\btableau\b",
+        r"\btime ?series\b",
+        r"\btrends?\b",
+        r"\bevolution\b",
+        r"\bdistributions?\b",
+        r"\bcompositions?\b",
+    ],
+    FINANCIAL_CONSULTING: [
+        r"\bwhat (does|do) .+ mean",
+        r"\bmeaning\b",
+        r"\bdefin(e|ition)\b",
+        r"\bexplain",
+        r"\bconcepts?\b",
+        rf"\bhow (do|does|can|should|could) {HOW_TO_SUBJECTS} {HOW_TO_VERBS}\b",
+        r"\bkpis?\b",
+        r"\badvi[cs]e\b",
+        r"\bstrateg(y|ies)\b",
+    ],
+}
+# queries about the company data ask for a measure, over a period or a part of the company:
+# measures alone are as common in spam ("how much does ice cream cost ?"), and "we" or "money"
+# as common in personal finance ("how much money should we invest in our retirement ?")
+DATA_PATTERNS = {
+    "measure": [
+        r"\b(profits?|costs?|income|revenues?|transactions?|sales|expenses?|margins?)\b",
+        r"\b(total|gross|net)\b",
+        r"\bhow (much|many)\b",
+    ],
+    "scope": [
+        r"\b(19|20)\d{2}\b",
+        r"\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b",
+        r"\bquarter(ly)?\b",
+        r"\b(sectors?|business|profit cent(er|re)s?)\b",
+    ],
+}
+# "show me the profits of 2023" asks for data without saying how: a table (Data Engineering) or
+# a chart (Data Visualization). Without a chart intent, these queries are left to the llm.
+DISPLAY_PATTERNS = [
+    r"\bshow",
+    r"\bdisplay",
+    r"\b(see|view)\b",
+]
+# confidence of the data queries shown without a chart intent
+DISPLAY_PENALTY = 0.5
+MIN_CONFIDENCE = 0.75
+
+
+@dataclass
+class KeywordRoute:
+    """Classification of a query by the KeywordRouter.
+
+    Attributes:
+        pipeline (str | None): pipeline of the query, None when the confidence is too low
+        confidence (float): share of the intent pattern matches belonging to the pipeline.
+        Without intent, the Data Engineering confidence is 0.5 per kind of data pattern
+        (measure, scope) matched, times DISPLAY_PENALTY when a display pattern is matched.
+        scores (dict[str, int]): number of patterns matched by each pipeline
+    """
+
+    pipeline: str | None
+    confidence: float
+    scores: dict[str, int]
+
+
+class KeywordRouter:
+    """Route queries with keyword rules, when they are confident enough. Use only: route
+
+    Args:
+        min_confidence (float): minimum confidence of a routed query
+        intent_patterns (dict[str, list[str]]): intent regex patterns of each pipeline
+        data_patterns (dict[str, list[str]]): regex patterns of the measures and the scopes of
+        the data queries (Data Engineering)
+        display_patterns (list[str]): regex patterns of the queries asking to show data, which
+        may be tables (Data Engineering) or charts (Data Visualization)
+
+    Attributes:
+        hits (int): number of queries routed by the classifier
+        misses (int): number of queries left to the routing llm
+    """
+
+    def __init__(
+        self,
+        min_confidence: float = MIN_CONFIDENCE,
+        intent_patterns: dict[str, list[str]] | None = None,
+        data_patterns: dict[str, list[str]] | None = None,
+        display_patterns: list[str] | None = None,
+    ) -> None:
+        if intent_patterns is None:
+            intent_patterns = INTENT_PATTERNS
+        if data_patterns is None:
+            data_patterns = DATA_PATTERNS
+        if display_patterns is None:
+            display_patterns = DISPLAY_PATTERNS
+
+        self.min_confidence = min_confidence
+        self.intent_patterns = {
+            pipeline: [re.compile(pattern) for pattern in patterns]
+            for pipeline, patterns in intent_patterns.items()
+        }
+        self.data_patterns = {
+            kind: [re.compile(pattern) for pattern in patterns]
+            for kind, patterns in data_patterns.items()
+        }
+        self.display_patterns = [re.compile(pattern) for pattern in display_patterns]
+        self.hits = 0
+        self.misses = 0
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def route(self, query: str) -> str | None:
+        """Pipeline of a query, None when the routing llm must decide."""
+        pipeline = self.classify(query).pipeline
+        if pipeline is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return pipeline
+
+    def classify(self, query: str) -> KeywordRoute:
+        """Score a query against the patterns of each pipeline.
+
+        Queries matching intent patterns go to the pipeline matching most of them, queries
+        without intent go to Data Engineering when they match both a measure and a scope, and
+        do not ask to show the data (table or chart).
+        """
+        text = query.lower()
+        scores = {
+            pipeline: _count_matches(patterns, text)
+            for pipeline, patterns in self.intent_patterns.items()
+        }
+        n_intents = sum(scores.values())
+        data_matches = [_count_matches(patterns, text) for patterns in self.data_patterns.values()]
+        scores[DATA_ENGINEERING] = sum(data_matches)
+        if n_intents:
+            pipeline = max(self.intent_patterns, key=scores.get)
+            confidence = scores[pipeline] / n_intents
+        else:
+            pipeline = DATA_ENGINEERING
+            confidence = sum(matches > 0 for matches in data_matches) / len(data_matches)
+            if _count_matches(self.display_patterns, text):
+                confidence *= DISPLAY_PENALTY
+        if confidence < self.min_confidence:
+            pipeline = None
+        return KeywordRoute(pipeline=pipeline, confidence=confidence, scores=scores)
+
+    def stats(self) -> dict:
+        """Return the share of the queries routed without the llm."""
+        queries = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / queries if queries else 0.0,
+        }
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _count_matches(patterns: list[re.Pattern], text: str) -> int:
+    """Number of patterns found in a text."""
+    return sum(bool(pattern.search(text)) for pattern in patterns)
+
+
+if __name__ == "__main__":
+    _router = KeywordRouter()
+    for _query in ["need a forrcasting of enterprise revenue", "histogram of profits", "Hi!"]:
+        print(_query, _router.classify(_query))  # noqa: T201
@@ -6,6 +6,22 @@ and dataviz.
 The pipelines are called by the Router agents. Each pipeline may use an LLM to generate the correct
 requests on your backend APIs.
 
+Pipelines are asynchronous: arun_system awaits every llm call, so that a single process serves
+many concurrent queries. run_system and call_pipeline are synchronous wrappers.
+
+Responses are cached by query similarity (see query_cache): a query close to an already
+answered query returns a copy of its response, without routing nor calling the pipeline. Each
+pipeline has its own cache, emptied when its data (the xlsx database or the vector store)
+changes.
+
+Identical concurrent queries (e.g. a question pasted by many users at once) share a single
+execution, see SingleFlight: run_system coalesces the whole pipeline, and the LLM coalesces
+identical llm requests.
+
+Routing and data requests are speculative: the data request of the tabular pipelines (the
+DATAENG_PROMPT tool call) does not depend on the route, it is sent while the query is routed,
+and cancelled if the query is routed to another pipeline.
+
 Add more pipelines as you see fit, make sure to implement their requiered backend functions and
 add the pipeline list and description to the prompt of the routing LLM.
 
@@ -14,31 +30,69 @@ This Dataclass acts as the payload and response of a REST API. It contains all t
 information to the user. You must use this OrderData class to display the results in your UI.
 """
 
-from dataclasses import dataclass
+import asyncio
+import threading
+from collections.abc import Awaitable, Iterable, Iterator
+from dataclasses import dataclass, replace
 from typing import Optional
 
+import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 
+from core.llmbackend.async_llm_backend import AsyncGptBackend
+from core.llmbackend.coalesced_llm import CoalescedLlm
+from core.llmbackend.completion_cache import CachedLlm, DiskCompletionCache, normalize_query
 from core.llmbackend.embedder_backend import AdaBackend
-from core.llmbackend.llm_backend import GptBackend
+from core.llmbackend.embedding_cache import CachedEmbedder
+from core.llmbackend.prompts.dataeng_prompt import DATAENG_PROMPT, DATAENG_TOOLS
 from core.services.dataviz_service import (  # noqa: F401
-    dataviz_tunnel,
+    adataviz_tunnel,
     display_histogram,
     display_pie_chart,
     plot_timeseries,
 )
 from core.services.db_query_service import DbQueryEngine
 from core.services.forecast_service import ForecastService
+from core.services.keyword_router import KeywordRouter
+from core.services.query_cache import SemanticQueryCache, source_fingerprint
 from core.services.rag_service import RagService
 from core.services.router_service import RouterService
 from core.settings.settings import Settings
-from core.utils import are_similar
+from core.utils import are_similar, run_sync
+from core.utils.single_flight import SharedStream, SingleFlight
+from core.vectorstore.bm25_index import bm25_index_path
 
-LLM = GptBackend(settings=Settings())
-EMBEDDER = AdaBackend(settings=Settings())
+LLM = CachedLlm(
+    CoalescedLlm(AsyncGptBackend(settings=Settings())),
+    store=DiskCompletionCache(cache_path=Settings().COMPLETION_CACHE_PATH),
+)
+EMBEDDER = CachedEmbedder(
+    AdaBackend(settings=Settings()), cache_path=Settings().EMBEDDINGS_CACHE_PATH
+)
 DB_QUERY_ENGINE = DbQueryEngine(LLM)
 VECTOR_STORE_PATH = Settings().VECTOR_STORE_PATH
+XLSX_PATH = Settings().XLSX_PATH
+# data sources of the cached pipelines, spam and unknown pipelines are not cached
+CACHED_PIPELINES = {
+    "analyst": [XLSX_PATH],
+    "data engineering": [XLSX_PATH],
+    "data visualization": [XLSX_PATH],
+    "financial consulting": [VECTOR_STORE_PATH, bm25_index_path(VECTOR_STORE_PATH)],
+}
+QUERY_CACHE = SemanticQueryCache(EMBEDDER, sources=CACHED_PIPELINES)
+# executions of run_system, shared by the identical concurrent queries
+RUN_FLIGHTS = SingleFlight()
+# obvious queries are routed locally, without calling the routing llm
+FAST_ROUTER = KeywordRouter()
+# opt-in: send the data request of the tabular pipelines while routing, at the cost of a wasted
+# llm call for the queries routed by the llm to the other pipelines
+SPECULATIVE_DATA_REQUEST = (Settings().SPECULATIVE_DATA_REQUEST or "false").lower() == "true"
+TABULAR_PIPELINES = ["analyst", "data engineering", "data visualization"]
+# RAG service loaded on the first RAG query, see get_rag_service
+_RAG_SERVICE = None
+_RAG_SERVICE_FINGERPRINT = None
+_RAG_SERVICE_LOCK = threading.Lock()
 
 
 @dataclass
@@ -46,10 +100,13 @@ class OrderData:
     """Dataclass containing the input and output of the pipelines.
 
     Each pipeline must return an instance of this class.
+    Streamed pipelines set llm_stream rather than llm_response: use stream_response to read
+    the response as it is generated, llm_response is filled once the stream is consumed.
     """
 
     user_query: Optional[str] = None
     llm_response: Optional[str] = None
+    llm_stream: Optional[Iterable[str]] = None
     table: Optional[pd.DataFrame] = None
     table_name: Optional[str] = None
     figure: Optional[list[plt.figure]] = None
@@ -75,56 +132,166 @@ class OrderData:
                 fig.show()
         return _repr
 
+    def stream_response(self) -> Iterator[str]:
+        """Yield the llm response as it is generated, then keep it in llm_response.
+
+        Responses that are not streamed are yielded at once.
+        """
+        if self.llm_stream is None:
+            if self.llm_response:
+                yield self.llm_response
+            return
+        tokens = []
+        for token in self.llm_stream:
+            tokens.append(token)
+            yield token
+        self.llm_stream = None
+        self.llm_response = "".join(tokens)
+
 
-def run_system(query: str) -> OrderData:
+def run_system(query: str, stream: bool = False) -> OrderData:
     """Entry point for the entire system.
 
-    Calls the llm routing agent and calls the appropriate pipeline using the routing agent response.
+    Calls the routing agent (keyword rules, then the llm when they are not confident) and calls the
+    appropriate pipeline using the routing agent response.
 
     Args:
         query (str): user-input query
+        stream (bool): stream the llm response of the pipelines, see OrderData.stream_response
 
     Returns:
         OrderData: response from the pipeline
     """
-    router = RouterService(LLM)
-    pipe = router.route(query)
+    return run_sync(arun_system(query, stream=stream))
 
-    order_data = OrderData(user_query=query, pipeline_name=pipe)
-    order_data = call_pipeline(order_data)
+
+async def arun_system(query: str, stream: bool = False) -> OrderData:
+    """Entry point for the entire system, from asynchronous code. See run_system.
+
+    Identical concurrent queries share a single execution. Each caller gets its own OrderData,
+    but their tables and figures are shared: they must not be modified.
+    """
+    key = (normalize_query(query), stream)
+    order_data = await RUN_FLIGHTS.ado(key, _arun_system, query, stream)
+    return replace(order_data, user_query=query)
+
+
+async def _arun_system(query: str, stream: bool) -> OrderData:
+    """Answer a query from the cache, or route it and call its pipeline."""
+    query_vector = await asyncio.to_thread(QUERY_CACHE.embed, query)
+    cached = await asyncio.to_thread(QUERY_CACHE.lookup, query, query_vector)
+    if cached is not None:
+        return cached
+
+    data_request = None
+    if SPECULATIVE_DATA_REQUEST:
+        data_request = asyncio.ensure_future(
+            LLM.aget_completion(query=query, primer_prompt=DATAENG_PROMPT, tools=DATAENG_TOOLS)
+        )
+    try:
+        router = RouterService(LLM, fast_router=FAST_ROUTER)
+        pipe = await router.aroute(query)
+        if data_request is not None and not _is_tabular(pipe):
+            _discard(data_request)
+            data_request = None
+
+        order_data = OrderData(user_query=query, pipeline_name=pipe)
+        order_data = await acall_pipeline(order_data, stream=stream, data_request=data_request)
+    finally:
+        # the pipeline failed before awaiting the data request
+        if data_request is not None and not data_request.done():
+            _discard(data_request)
+    await asyncio.to_thread(_cache_response, query, query_vector, order_data)
+    if order_data.llm_stream is not None:
+        # each caller sharing the execution reads the whole stream
+        order_data.llm_stream = SharedStream(order_data.llm_stream)
     return order_data
 
 
-def call_pipeline(order_data: OrderData) -> OrderData:
+def call_pipeline(order_data: OrderData, stream: bool = False) -> OrderData:
     """Call the appropriate pipeline using the routing agent response.
 
     These pipelines must fill and return the OrderData class.
     The pipelines are selected using the routing agent response (with fuzzy matching).
+    With stream, the pipelines answering with the llm (RAG and spam) set the llm_stream of the
+    OrderData instead of its llm_response.
+    """
+    return run_sync(acall_pipeline(order_data, stream=stream))
+
+
+async def acall_pipeline(
+    order_data: OrderData, stream: bool = False, data_request: Awaitable | None = None
+) -> OrderData:
+    """Call the appropriate pipeline from asynchronous code. See call_pipeline.
+
+    The tabular pipelines await the given data request (DATAENG_PROMPT tool call of the query)
+    instead of sending it, see arun_system.
     """
     if are_similar(order_data.pipeline_name, "spam"):
-        order_data = _spam_pipeline(order_data)
+        order_data = _spam_pipeline(order_data, stream)
     elif are_similar(order_data.pipeline_name, "analyst"):
-        order_data = _forecast_pipeline(order_data)
+        order_data = await _forecast_pipeline(order_data, data_request)
     elif are_similar(order_data.pipeline_name, "data engineering"):
-        order_data = _request_data(order_data)
+        order_data = await _request_data(order_data, data_request)
     elif are_similar(order_data.pipeline_name, "data visualization"):
-        order_data = _dataviz_pipeline(order_data)
+        order_data = await _dataviz_pipeline(order_data, data_request)
     elif are_similar(order_data.pipeline_name, "financial consulting"):
-        order_data = _rag_pipeline(order_data)
+        order_data = await _rag_pipeline(order_data, stream)
     else:
         order_data.pipeline_name = "Requested service not found"
     return order_data
 
 
+def _is_tabular(pipeline_name: str) -> bool:
+    """Check if a pipeline starts with a data request."""
+    return any(are_similar(pipeline_name, name) for name in TABULAR_PIPELINES)
+
+
+def _discard(request: asyncio.Future) -> None:
+    """Cancel an unused llm request, and retrieve its outcome once done.
+
+    The LLM coalesces identical requests: the call goes on while another query waits for it.
+    """
+    request.cancel()
+    request.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+
+def _cache_response(query: str, query_vector: np.ndarray | None, order_data: OrderData) -> None:
+    """Cache the response of a pipeline, once its llm stream (if any) is consumed."""
+    scope = next(
+        (name for name in CACHED_PIPELINES if are_similar(order_data.pipeline_name, name)), None
+    )
+    if scope is None:
+        return
+    if order_data.llm_stream is None:
+        if order_data.llm_response or order_data.table is not None or order_data.figure:
+            QUERY_CACHE.add(query, query_vector, order_data, scope)
+        return
+
+    def _stream_then_cache(stream: Iterator[str]) -> Iterator[str]:
+        tokens = []
+        for token in stream:
+            tokens.append(token)
+            yield token
+        if tokens:
+            response = replace(order_data, llm_stream=None, llm_response="".join(tokens))
+            QUERY_CACHE.add(query, query_vector, response, scope)
+
+    order_data.llm_stream = _stream_then_cache(order_data.llm_stream)
+
+
 ##########################
 # PIPELINES, IMPLEMENTED #
 ##########################
-def _forecast_pipeline(order_data: OrderData) -> OrderData:
+# services load their data at instantiation: they are created in worker threads
+async def _forecast_pipeline(
+    order_data: OrderData, data_request: Awaitable | None = None
+) -> OrderData:
     """Run the entire forecasting pipeline from a user query."""
     # request data
-    forecast_service = ForecastService(LLM)
+    forecast_service = await asyncio.to_thread(ForecastService, LLM)
     query = order_data.user_query
-    requested_data, table_name, figs = forecast_service.forecast_tunnel(query)
+    requested_data, table_name, figs = await forecast_service.aforecast_tunnel(query, data_request)
     # fills the OrderData class
     order_data.llm_response = "Past Performance is Not Indicative of Future Results."
     order_data.table = requested_data
@@ -133,11 +300,13 @@ def _forecast_pipeline(order_data: OrderData) -> OrderData:
     return order_data
 
 
-def _dataviz_pipeline(order_data: OrderData) -> OrderData:
+async def _dataviz_pipeline(
+    order_data: OrderData, data_request: Awaitable | None = None
+) -> OrderData:
     """Run a simple dataviz pipeline from a user query."""
     # request data
     query = order_data.user_query
-    requested_data, table_name, figs = dataviz_tunnel(query, LLM)
+    requested_data, table_name, figs = await adataviz_tunnel(query, LLM, data_request)
     # fills the OrderData class
     order_data.table = requested_data
     order_data.table_name = table_name
@@ -145,32 +314,62 @@ def _dataviz_pipeline(order_data: OrderData) -> OrderData:
     return order_data
 
 
-def _request_data(order_data: OrderData) -> OrderData:
+async def _request_data(order_data: OrderData, data_request: Awaitable | None = None) -> OrderData:
     """Request data from a user query."""
     # request data
     query = order_data.user_query
-    request_service = DbQueryEngine(LLM)
-    requested_data, table_name = request_service.request_tunnel(query)
+    request_service = await asyncio.to_thread(DbQueryEngine, LLM)
+    requested_data, table_name = await request_service.arequest_tunnel(query, data_request)
     # fills the OrderData class
     order_data.table = requested_data
     order_data.table_name = table_name
     return order_data
 
 
-def _rag_pipeline(order_data: OrderData) -> OrderData:
+def get_rag_service() -> RagService:
+    """RAG service of the pipelines, loaded on first call and shared by the RAG queries.
+
+    The vector store and its indexes are loaded once, and reloaded when the store changes on
+    disk. The answer metrics of the strategies are kept across reloads, see RagService.stats.
+    """
+    global _RAG_SERVICE, _RAG_SERVICE_FINGERPRINT  # noqa: PLW0603
+    with _RAG_SERVICE_LOCK:
+        sources = CACHED_PIPELINES["financial consulting"]
+        if _RAG_SERVICE is None or source_fingerprint(sources) != _RAG_SERVICE_FINGERPRINT:
+            rag_service = RagService(
+                embedder=EMBEDDER,
+                llm=LLM,
+                vector_store_path=VECTOR_STORE_PATH,
+                answer_strategy="adaptive",
+            )
+            if _RAG_SERVICE is not None:
+                rag_service.metrics = _RAG_SERVICE.metrics
+            _RAG_SERVICE = rag_service
+            # indexes built at load are saved next to the store: fingerprint it afterwards
+            _RAG_SERVICE_FINGERPRINT = source_fingerprint(sources)
+        return _RAG_SERVICE
+
+
+async def _rag_pipeline(order_data: OrderData, stream: bool = False) -> OrderData:
     """Call the RAG pipeline."""
     # request data
     query = order_data.user_query
-    rag_service = RagService(embedder=EMBEDDER, llm=LLM, vector_store_path=VECTOR_STORE_PATH)
-    agent_answer = rag_service.rag_tunnel(query=query)
+    rag_service = await asyncio.to_thread(get_rag_service)
     # fills the OrderData class
-    order_data.llm_response = agent_answer
+    if stream:
+        order_data.llm_stream = rag_service.rag_stream(query=query)
+    else:
+        order_data.llm_response = await rag_service.arag_tunnel(query=query)
     return order_data
 
 
-def _spam_pipeline(order_data: OrderData) -> OrderData:
+def _spam_pipeline(order_data: OrderData, stream: bool = False) -> OrderData:
     """Spam pipeline."""
-    order_data.llm_response = "Please do not spam me"
+    answer = "Please do not spam me"
+    if stream:
+        order_data.llm_stream = iter([answer])
+    else:
+        order_data.llm_response = answer
     return order_data
 
 
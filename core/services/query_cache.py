@@ -0,0 +1,202 @@
+""".. include:: README.md
+
+Semantic cache of the pipelines responses, keyed by the embeddings of the user queries.
+
+A query whose embedding is close enough (cosine similarity above a threshold) to a cached query
+is answered with a copy of the cached response, e.g. "total profits 2023" and "what were our
+2023 total profits". Queries must also mention the same numbers (years, amounts...): they are
+often the only difference between two questions with different answers.
+
+Responses are cached per pipeline scope. Each scope depends on a data source (the xlsx
+database, the vector store...): the scope is emptied when its source changes on disk.
+"""
+
+import logging
+import os
+import pickle
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Any
+
+import numpy as np
+
+from core.llmbackend.embedder_backend import EmbedderBackend
+from core.vectorstore.search_index import DTYPE
+
+SIMILARITY_THRESHOLD = 0.95
+MAX_ENTRIES = 1_000
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+@dataclass
+class _Scope:
+    """Cached queries of a pipeline, and the fingerprint of its data source when cached."""
+
+    fingerprint: Any = None
+    queries: list[str] = field(default_factory=list)
+    vectors: list[np.ndarray] = field(default_factory=list)
+    responses: list[bytes] = field(default_factory=list)
+
+
+class SemanticQueryCache:
+    """In-memory cache of responses, looked up by query embedding similarity.
+
+    Responses are stored pickled: each hit returns a fresh copy (DataFrames and figures
+    included) that callers may modify.
+
+    Args:
+        embedder (EmbedderBackend): embedder of the queries
+        sources (dict[str, list[str]]): data source paths (files or directories) of each cached
+        scope, e.g. pipeline. Responses of other scopes are never cached.
+        similarity_threshold (float): minimum cosine similarity of a cached query
+        max_entries (int): maximum number of cached responses per scope, the oldest responses
+        are evicted first
+
+    Attributes:
+        hits (int): number of queries answered from the cache
+        misses (int): number of looked up queries without cached response
+        invalidations (int): number of scopes emptied after a change of their data source
+    """
+
+    def __init__(
+        self,
+        embedder: EmbedderBackend,
+        sources: dict[str, list[str]],
+        similarity_threshold: float = SIMILARITY_THRESHOLD,
+        max_entries: int = MAX_ENTRIES,
+    ) -> None:
+        self.embedder = embedder
+        self.sources = sources
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._scopes = {scope: _Scope() for scope in sources}
+        self._lock = threading.Lock()
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def embed(self, query: str) -> np.ndarray | None:
+        """Normalized embedding of a query, None if it could not be embedded."""
+        vector = self.embedder.encode(query)
+        if vector is None:
+            return None
+        vector = np.asarray(vector, dtype=DTYPE)
+        return vector / np.linalg.norm(vector)
+
+    def lookup(self, query: str, vector: np.ndarray | None) -> Any | None:
+        """Copy of the response of the most similar cached query, None without match.
+
+        Args:
+            query (str): user query
+            vector (np.ndarray | None): normalized query embedding, see embed
+
+        Returns:
+            Any | None: cached response, None on a miss
+        """
+        if vector is None:
+            return None
+        best_similarity, best_response = self.similarity_threshold, None
+        with self._lock:
+            for scope_name in self._scopes:
+                scope = self._valid_scope(scope_name)
+                if not scope.queries:
+                    continue
+                similarities = np.stack(scope.vectors) @ vector
+                for idx in np.flatnonzero(similarities >= best_similarity):
+                    if _same_numbers(query, scope.queries[idx]):
+                        best_similarity = similarities[idx]
+                        best_response = scope.responses[idx]
+            if best_response is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(best_response)  # noqa: S301 - written by this process only
+
+    def add(self, query: str, vector: np.ndarray | None, response: Any, scope_name: str) -> None:
+        """Cache the response of a query, in the scope of the pipeline that answered it.
+
+        Responses of queries without embedding, or of scopes missing from the sources, are not
+        cached.
+        """
+        if vector is None or scope_name not in self._scopes:
+            return
+        payload = pickle.dumps(response)
+        with self._lock:
+            scope = self._valid_scope(scope_name)
+            scope.queries.append(query)
+            scope.vectors.append(vector)
+            scope.responses.append(payload)
+            if len(scope.queries) > self.max_entries:
+                del scope.queries[0], scope.vectors[0], scope.responses[0]
+
+    def invalidate(self, scope_name: str | None = None) -> None:
+        """Empty a scope, or every scope."""
+        with self._lock:
+            for name in self._scopes if scope_name is None else [scope_name]:
+                self._scopes[name] = _Scope()
+
+    def stats(self) -> dict:
+        """Return the hit/miss statistics of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "size": {name: len(scope.queries) for name, scope in self._scopes.items()},
+        }
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _valid_scope(self, scope_name: str) -> _Scope:
+        """Scope of a pipeline, emptied first if its data source changed since it was filled."""
+        scope = self._scopes[scope_name]
+        fingerprint = source_fingerprint(self.sources[scope_name])
+        if scope.fingerprint != fingerprint:
+            if scope.queries:
+                logging.info("Data source of %s changed, emptying its query cache", scope_name)
+                self.invalidations += 1
+            scope = _Scope(fingerprint=fingerprint)
+            self._scopes[scope_name] = scope
+        return scope
+
+
+def source_fingerprint(paths: list[str]) -> tuple:
+    """Modification times and sizes of data source files, and of the files of directories."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                files.extend(os.path.join(root, file_name) for file_name in file_names)
+        else:
+            files.append(path)
+    fingerprint = []
+    for file_path in sorted(files):
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            fingerprint.append((file_path, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _same_numbers(query: str, other_query: str) -> bool:
+    """Check that two queries mention the same numbers."""
+    return sorted(NUMBER_PATTERN.findall(query)) == sorted(NUMBER_PATTERN.findall(other_query))
+
+
+if __name__ == "__main__":
+    from core.llmbackend.embedder_backend import AdaBackend
+    from core.settings.settings import Settings
+
+    _cache = SemanticQueryCache(AdaBackend(settings=Settings()), {"rag": []})
+    _vector = _cache.embed("total profits 2023")
+    _cache.add("total profits 2023", _vector, "42", "rag")
+    _query = "what were our 2023 total profits"
+    print(_cache.lookup(_query, _cache.embed(_query)), _cache.stats())  # noqa: T201
@@ -3,53 +3,407 @@
 This service is used to generate RAG answers.
 """
 
+import asyncio
+import logging
+import os
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import pandas as pd
 
-from core.llmbackend.embedder_backend import AdaBackend
+from core.llmbackend.embedder_backend import AdaBackend, EmbedderBackend
 from core.llmbackend.llm_backend import GptBackend
 from core.llmbackend.prompts.rag_prompt import RAG_PRIMER, RAG_QUERY, SUMMARY_PRIMER, SUMMARY_QUERY
-from core.readers.pdf_readers import load_df
+from core.llmbackend.tokenizer import count_tokens
 from core.readers.rag_schema import RagSchema
+from core.services.context_packer import ContextPacker, PackedContext
 from core.settings.settings import Settings
+from core.vectorstore.bm25_index import Bm25Index, bm25_index_path, chunk_texts
+from core.vectorstore.embedding_store import load_vector_store, store_fingerprint
+from core.vectorstore.ivf_index import N_PROBE, IvfIndex, ivf_index_path
+from core.vectorstore.metadata_index import MetadataIndex
+from core.vectorstore.quantization import (
+    QUANTIZATION_MODES,
+    RESCORE_FACTOR,
+    QuantizedIndex,
+    quantized_index_path,
+)
+from core.vectorstore.search_index import (
+    DUPLICATE_SIMILARITY,
+    MMR_LAMBDA,
+    ExactSearchIndex,
+    SearchIndex,
+    maximal_marginal_relevance,
+    reciprocal_rank_fusion,
+)
+from core.vectorstore.sharded_store import (
+    ShardedSearchIndex,
+    ShardedVectorStore,
+    is_sharded_store,
+)
 
 VECTOR_STORE_PATH = Settings().VECTOR_STORE_PATH
+SEARCH_MODES = ["exact", "ivf", *QUANTIZATION_MODES]
+RETRIEVAL_MODES = ["vector", "hybrid", "lexical"]
+# number of candidates of each retriever fused in "hybrid" mode, as a multiple of k
+HYBRID_CANDIDATES_FACTOR = 3
+ANSWER_STRATEGIES = ["summary", "direct", "adaptive"]
+# number of chunks retrieved to answer a query
+RAG_TOP_K = 20
+# tokens of retrieved chunks sent to the answer prompt by the "direct" and "adaptive" strategies
+CONTEXT_TOKEN_BUDGET = 3000
 
 
 class RagService:
     """RAG Service
 
-    Use the rag_tunnel method to start the retrieval augmented generation.
-    Best chunks are fetched from the vector store and summarized by a summary agent.
-    A second agent uses the summary to generate a RAG answer.
+    Use the rag_tunnel method to start the retrieval augmented generation, rag_stream to
+    receive the answer tokens as they are generated, or arag_tunnel from asynchronous code.
+    Best chunks are fetched from the vector store, then answered with one of the strategies:
+    - "summary": chunks are summarized by a summary agent, a second agent uses the summary to
+    generate a RAG answer (2 llm calls)
+    - "direct": chunks are deduplicated, diversified (maximal marginal relevance) and packed into
+    the context token budget of the RAG answer prompt (1 llm call)
+    - "adaptive": "direct" when the deduplicated chunks fit the context token budget, "summary"
+    of the deduplicated chunks otherwise
+    Chunks are always packed (see ContextPacker) into the prompt token budget of the llm model.
 
     Args:
-        embedder (AdaBackend): embedder backend
+        embedder (EmbedderBackend): embedder backend, e.g. AdaBackend or AsyncAdaBackend
         llm (GptBackend): llm backend
-        vector_store_path (str): path to the vector store
+        vector_store_path (str): path to the vector store, or to a sharded multi-document store
+        search_mode (str): "exact" brute-force search, "ivf" approximate search, or "int8" and
+        "binary" quantized search with exact rescoring. list available modes: SEARCH_MODES
+        n_probe (int): number of inverted lists scored per query in "ivf" mode. Higher values
+        improve recall at the cost of latency.
+        rescore_factor (int): shortlist size, as a multiple of k, rescored exactly in "int8" and
+        "binary" modes. Higher values improve recall at the cost of latency.
+        retrieval_mode (str): "vector" embedding similarity, "lexical" BM25 scores (no API
+        call), or "hybrid" reciprocal rank fusion of both. In "hybrid" mode, queries that could
+        not be embedded are scored lexically only. list available modes: RETRIEVAL_MODES
+        embedding_timeout (float | None): seconds to wait for the query embeddings before
+        considering them unavailable, e.g. to fall back to lexical scores in "hybrid" mode.
+        answer_strategy (str): how retrieved chunks are turned into an answer.
+        list available strategies: ANSWER_STRATEGIES
+        context_token_budget (int): maximum number of chunk tokens in the RAG answer prompt of the
+        "direct" and "adaptive" strategies
+        mmr_lambda (float): relevance weight of the chunks diversification, 1.0 keeps the
+        retrieval order
+
+    Attributes:
+        metrics (dict[str, dict]): per answer strategy, number of answers (and of streamed
+        answers), llm calls, prompt and completion tokens (counted locally), retrieval and llm
+        seconds, and seconds to the first token of the streamed answers. See stats.
     """
 
-    def __init__(self, embedder: AdaBackend, llm: GptBackend, vector_store_path: str) -> None:
+    def __init__(
+        self,
+        embedder: EmbedderBackend,
+        llm: GptBackend,
+        vector_store_path: str,
+        search_mode: str = "exact",
+        n_probe: int = N_PROBE,
+        rescore_factor: int = RESCORE_FACTOR,
+        retrieval_mode: str = "vector",
+        embedding_timeout: float | None = None,
+        answer_strategy: str = "summary",
+        context_token_budget: int = CONTEXT_TOKEN_BUDGET,
+        mmr_lambda: float = MMR_LAMBDA,
+    ) -> None:
+        if search_mode not in SEARCH_MODES:
+            error_message = f"Invalid search mode, use only: {SEARCH_MODES}"
+            logging.error(error_message)
+            raise ValueError(error_message)
+        if retrieval_mode not in RETRIEVAL_MODES:
+            error_message = f"Invalid retrieval mode, use only: {RETRIEVAL_MODES}"
+            logging.error(error_message)
+            raise ValueError(error_message)
+        if answer_strategy not in ANSWER_STRATEGIES:
+            error_message = f"Invalid answer strategy, use only: {ANSWER_STRATEGIES}"
+            logging.error(error_message)
+            raise ValueError(error_message)
+
         self.embedder = embedder
         self.llm = llm
-        self.vector_store = load_df(file_path=vector_store_path)
+        if is_sharded_store(vector_store_path):
+            self.vector_store, self.search_index, self.embeddings = self._load_sharded_store(
+                vector_store_path, search_mode, n_probe, rescore_factor
+            )
+        else:
+            # chunks table and memory-mapped, pre-normalized embeddings of the search column
+            self.vector_store, embeddings = load_vector_store(
+                vector_store_path, embedding_column=RagSchema.CHUNK_W_METADATA_EMBEDDING
+            )
+            self.search_index = self._load_search_index(
+                vector_store_path, embeddings, search_mode, n_probe, rescore_factor
+            )
+            self.embeddings = [embeddings]
+        # first row of the embeddings of each shard
+        self.embedding_offsets = np.cumsum([0] + [len(e) for e in self.embeddings])[:-1]
+        # tombstoned chunks keep their row in the store, but are never retrieved
+        if RagSchema.DELETED in self.vector_store.columns:
+            # shards without tombstones have no DELETED column (NaN once concatenated)
+            self.live_rows = ~self.vector_store[RagSchema.DELETED].eq(True).to_numpy()
+        else:
+            self.live_rows = np.ones(len(self.vector_store), dtype=bool)
+        self.n_deleted = int((~self.live_rows).sum())
+        # inverted indexes of the metadata, used to pre-filter the searched rows
+        self.metadata_index = MetadataIndex(self.vector_store)
+        self.retrieval_mode = retrieval_mode
+        self.bm25_index = None
+        if retrieval_mode != "vector":
+            self.bm25_index = self._load_bm25_index(vector_store_path, self.vector_store)
+        self.embedding_timeout = embedding_timeout
+        self._embedding_pool = ThreadPoolExecutor() if embedding_timeout is not None else None
+        self.answer_strategy = answer_strategy
+        self.context_token_budget = context_token_budget
+        self.mmr_lambda = mmr_lambda
+        self.metrics = {
+            strategy: {
+                "answers": 0,
+                "llm_calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "retrieval_seconds": 0.0,
+                "llm_seconds": 0.0,
+                "streamed_answers": 0,
+                "first_token_seconds": 0.0,
+            }
+            for strategy in ANSWER_STRATEGIES
+        }
 
-    def rag_tunnel(self, query: str) -> str:
-        """Start the RAG tunnel"""
-        # Fetch top k chunks
-        chunks, chunk_sources, page_numbers = self._fetch_top_k_chunks(query)
-        # Summarize the chunks
-        summary_query, summary_prompt = self._build_prompt(
-            query, chunks, SUMMARY_QUERY, SUMMARY_PRIMER
-        )
-        chunks_summary = self.llm.get_completion(query=summary_query, primer_prompt=summary_prompt)
+    def rag_tunnel(self, query: str, filters: dict | None = None) -> str:
+        """Start the RAG tunnel
+
+        Args:
+            query (str): user query
+            filters (dict | None): only retrieve chunks matching these metadata filters, e.g.
+            {RagSchema.PAGE_NUMBER: (30, 40)}. See core/vectorstore/metadata_index.py.
+        """
+        context, sources = self._answer_context(query, filters)
         # Generate RAG answer
-        query, primer = self._build_prompt(query, chunks_summary, RAG_QUERY, RAG_PRIMER)
-        rag_answer = self.llm.get_completion(query=query, primer_prompt=primer)
-        # Add metadata to the llm answer
-        rag_answer += "\n\n" + "#" * 55
-        rag_answer += "\nfrom sources: " + str(chunk_sources)
-        rag_answer += "\npage numbers: " + str(page_numbers)
-        return rag_answer
+        rag_answer = self._complete(query, context, RAG_QUERY, RAG_PRIMER)
+        self.metrics[self.answer_strategy]["answers"] += 1
+        return rag_answer + sources
+
+    def rag_stream(self, query: str, filters: dict | None = None) -> Iterator[str]:
+        """Start the RAG tunnel and yield the tokens of the answer as they are generated.
+
+        Retrieval (and the summary of the "summary" strategy) run when the first token is
+        requested. The sources of the answer are yielded last, as in rag_tunnel.
+
+        Args:
+            query (str): user query
+            filters (dict | None): only retrieve chunks matching these metadata filters
+        """
+        context, sources = self._answer_context(query, filters)
+        yield from self._stream(query, context, RAG_QUERY, RAG_PRIMER)
+        self.metrics[self.answer_strategy]["answers"] += 1
+        yield sources
+
+    async def arag_tunnel(self, query: str, filters: dict | None = None) -> str:
+        """Start the RAG tunnel from asynchronous code, see rag_tunnel.
+
+        Retrieval runs in a worker thread, the llm calls are awaited.
+        """
+        packed, rows = await asyncio.to_thread(self._plan_context, query, filters)
+        if packed is None:
+            context, rows = await self._asummarize(query, rows)
+        else:
+            context, rows = packed.chunks, rows[packed.positions]
+        rag_answer = await self._acomplete(query, context, RAG_QUERY, RAG_PRIMER)
+        self.metrics[self.answer_strategy]["answers"] += 1
+        return rag_answer + self._sources(rows)
+
+    def _answer_context(self, query: str, filters: dict | None) -> tuple[list[str] | str, str]:
+        """Retrieve the chunks and prepare the context of the answer prompt.
+
+        Returns:
+            list[str] | str: packed chunks, or summary of the chunks
+            str: sources and page numbers of the chunks, appended to the answer
+        """
+        packed, rows = self._plan_context(query, filters)
+        if packed is None:
+            context, rows = self._summarize(query, rows)
+        else:
+            context, rows = packed.chunks, rows[packed.positions]
+        return context, self._sources(rows)
+
+    def _plan_context(
+        self, query: str, filters: dict | None
+    ) -> tuple[PackedContext | None, np.ndarray]:
+        """Retrieve the chunks and pack them into the answer prompt, following the strategy.
+
+        Returns:
+            PackedContext | None: chunks of the answer prompt, None if the rows must be
+            summarized first
+            np.ndarray: retrieved rows, in the order of the packed positions
+        """
+        metrics = self.metrics[self.answer_strategy]
+        # Fetch top k chunks
+        start = time.perf_counter()
+        top_k_idx = self._retrieve([query], RAG_TOP_K, filters)[0]
+        if top_k_idx is None:
+            msg = "Query could not be embedded"
+            raise ValueError(msg)
+        metrics["retrieval_seconds"] += time.perf_counter() - start
+
+        if self.answer_strategy == "summary":
+            return None, top_k_idx
+        candidates_idx = self._select_context(top_k_idx)
+        budget = self.context_token_budget
+        model_budget = self._prompt_budget(query, RAG_QUERY, RAG_PRIMER)
+        if model_budget is not None:
+            budget = min(budget, model_budget)
+        packed = self._pack_context(candidates_idx, budget)
+        if self.answer_strategy == "adaptive" and packed.truncated:
+            # the chunks exceed the budget: summarize all of them
+            return None, candidates_idx
+        return packed, candidates_idx
+
+    def _sources(self, rows: np.ndarray) -> str:
+        """Sources and page numbers of the chunks of the rows, appended to the answers."""
+        _, chunk_sources, page_numbers = self._gather_chunks(rows)
+        sources = "\n\n" + "#" * 55
+        sources += "\nfrom sources: " + str(chunk_sources)
+        sources += "\npage numbers: " + str(page_numbers)
+        return sources
+
+    def stats(self) -> dict:
+        """Mean latency and token metrics of the answers of each strategy used so far."""
+        stats = {}
+        for strategy, metrics in self.metrics.items():
+            n_answers = metrics["answers"]
+            if not n_answers:
+                continue
+            n_streamed = metrics["streamed_answers"]
+            stats[strategy] = {
+                key: value / n_answers
+                for key, value in metrics.items()
+                if key not in ("answers", "streamed_answers", "first_token_seconds")
+            }
+            stats[strategy]["answers"] = n_answers
+            stats[strategy]["streamed_answers"] = n_streamed
+            if n_streamed:
+                stats[strategy]["first_token_seconds"] = metrics["first_token_seconds"] / n_streamed
+        return stats
+
+    def fetch_top_k_batch(
+        self, queries: list[str], k: int = 20, filters: dict | None = None
+    ) -> list[tuple[list[str], list[str], list[str]]]:
+        """Fetch the top k chunks of many queries at once.
+
+        Queries are embedded in a single embedder call and scored against the vector store with
+        a single matrix product. Queries that could not be embedded return empty results, unless
+        they can be scored lexically ("hybrid" mode).
+
+        Args:
+            queries (list[str]): user queries
+            k (int, optional): number of chunks to return per query. Defaults to 20.
+            filters (dict | None): only retrieve chunks matching these metadata filters
+
+        Returns:
+            list[tuple]: for each query, the (chunks, sources, page numbers) returned by
+            _fetch_top_k_chunks
+        """
+        return [
+            ([], [], []) if row_idx is None else self._gather_chunks(row_idx)
+            for row_idx in self._retrieve(queries, k, filters)
+        ]
+
+    @staticmethod
+    def _load_sharded_store(
+        vector_store_path: str, search_mode: str, n_probe: int, rescore_factor: int
+    ) -> tuple[pd.DataFrame, ShardedSearchIndex, list[np.ndarray]]:
+        """Load the chunks table, search index and embeddings of every shard of a store.
+
+        The chunks tables are concatenated in the shards order, the shards are searched in
+        parallel by a ShardedSearchIndex. Each shard has its own (cached) search index, and keeps
+        its own memory-mapped embeddings.
+        """
+        tables = []
+        indexes = []
+        shard_embeddings = []
+        for shard_path in ShardedVectorStore(vector_store_path).shard_paths():
+            metadata, embeddings = load_vector_store(
+                shard_path, embedding_column=RagSchema.CHUNK_W_METADATA_EMBEDDING
+            )
+            tables.append(metadata)
+            shard_embeddings.append(embeddings)
+            indexes.append(
+                RagService._load_search_index(
+                    shard_path, embeddings, search_mode, n_probe, rescore_factor
+                )
+            )
+        if not tables:
+            error_message = f"Vector store {vector_store_path} holds no document"
+            logging.error(error_message)
+            raise ValueError(error_message)
+        return pd.concat(tables, ignore_index=True), ShardedSearchIndex(indexes), shard_embeddings
+
+    @staticmethod
+    def _load_bm25_index(vector_store_path: str, vector_store: pd.DataFrame) -> Bm25Index:
+        """Load the BM25 index built next to the vector store, or build it from the chunks.
+
+        The index of a sharded store is built over every shard at load time (no API call), so
+        that its term statistics cover the whole corpus.
+        """
+        if is_sharded_store(vector_store_path):
+            return Bm25Index.build(chunk_texts(vector_store))
+        index_path = bm25_index_path(vector_store_path)
+        source = store_fingerprint(vector_store_path)
+        if os.path.exists(index_path):
+            bm25_index = Bm25Index.load(index_path)
+            if bm25_index.source == source:
+                return bm25_index
+            logging.warning("BM25 index %s is out of date, rebuilding it", index_path)
+        bm25_index = Bm25Index.build(chunk_texts(vector_store))
+        bm25_index.source = source
+        bm25_index.save(index_path)
+        return bm25_index
+
+    @staticmethod
+    def _load_search_index(
+        vector_store_path: str,
+        embeddings: np.ndarray,
+        search_mode: str,
+        n_probe: int,
+        rescore_factor: int,
+    ) -> SearchIndex:
+        """Load the search index of the vector store.
+
+        IVF and quantized indexes are read from disk when they were built next to the vector
+        store from its current contents (same store fingerprint), otherwise they are built (and
+        saved) from the vector store embeddings.
+        """
+        if search_mode == "ivf":
+            index_path = ivf_index_path(vector_store_path)
+            source = store_fingerprint(vector_store_path)
+            if os.path.exists(index_path):
+                search_index = IvfIndex.load(index_path, embeddings, n_probe=n_probe)
+                if search_index.source == source:
+                    return search_index
+                logging.warning("IVF index %s is out of date, rebuilding it", index_path)
+            search_index = IvfIndex.build(embeddings, n_probe=n_probe, normalized=True)
+            search_index.source = source
+            search_index.save(index_path)
+            return search_index
+        if search_mode in QUANTIZATION_MODES:
+            index_path = quantized_index_path(vector_store_path, search_mode)
+            source = store_fingerprint(vector_store_path)
+            if os.path.exists(index_path):
+                search_index = QuantizedIndex.load(index_path, embeddings, rescore_factor)
+                if search_index.source == source:
+                    return search_index
+                logging.warning("Quantized index %s is out of date, rebuilding it", index_path)
+            search_index = QuantizedIndex.build(embeddings, search_mode, rescore_factor)
+            search_index.source = source
+            search_index.save(index_path)
+            return search_index
+        # queries are scored in a single product against the pre-normalized embeddings
+        return ExactSearchIndex(embeddings, normalized=True)
 
     @staticmethod
     def _build_prompt(
@@ -79,88 +433,228 @@ class RagService:
         primer_prompt = primer_prompt.replace("{chunks}", chunks)
         return query_prompt, primer_prompt
 
+    def _summarize(self, query: str, rows: np.ndarray) -> tuple[str, np.ndarray]:
+        """Summarize the chunks of the rows fitting the summary prompt, best first.
+
+        Returns:
+            str: summary of the chunks
+            np.ndarray: rows of the summarized chunks
+        """
+        packed = self._pack_context(rows, self._prompt_budget(query, SUMMARY_QUERY, SUMMARY_PRIMER))
+        summary = self._complete(query, packed.chunks, SUMMARY_QUERY, SUMMARY_PRIMER)
+        return summary, rows[packed.positions]
+
+    async def _asummarize(self, query: str, rows: np.ndarray) -> tuple[str, np.ndarray]:
+        """Summarize the chunks of the rows fitting the summary prompt, see _summarize."""
+        packed = self._pack_context(rows, self._prompt_budget(query, SUMMARY_QUERY, SUMMARY_PRIMER))
+        summary = await self._acomplete(query, packed.chunks, SUMMARY_QUERY, SUMMARY_PRIMER)
+        return summary, rows[packed.positions]
+
+    def _prompt_budget(self, query: str, query_prompt: str, primer_prompt: str) -> int | None:
+        """Tokens left to the chunks in the prompts of the llm, None without model limit."""
+        model_budget = getattr(self.llm, "prompt_token_budget", None)
+        if model_budget is None:
+            return None
+        return model_budget - count_tokens(query + query_prompt + primer_prompt)
+
+    def _complete(
+        self, query: str, chunks: list[str] | str, query_prompt: str, primer_prompt: str
+    ) -> str:
+        """Fill the prompts and call the llm, recording the metrics of the answer strategy."""
+        query_prompt, primer_prompt = self._build_prompt(query, chunks, query_prompt, primer_prompt)
+        start = time.perf_counter()
+        completion = self.llm.get_completion(query=query_prompt, primer_prompt=primer_prompt)
+        self._record_call(query_prompt, primer_prompt, completion, time.perf_counter() - start)
+        return completion
+
+    async def _acomplete(
+        self, query: str, chunks: list[str] | str, query_prompt: str, primer_prompt: str
+    ) -> str:
+        """Fill the prompts and await the llm, recording the metrics of the answer strategy."""
+        query_prompt, primer_prompt = self._build_prompt(query, chunks, query_prompt, primer_prompt)
+        start = time.perf_counter()
+        completion = await self.llm.aget_completion(query=query_prompt, primer_prompt=primer_prompt)
+        self._record_call(query_prompt, primer_prompt, completion, time.perf_counter() - start)
+        return completion
+
+    def _stream(
+        self, query: str, chunks: list[str] | str, query_prompt: str, primer_prompt: str
+    ) -> Iterator[str]:
+        """Fill the prompts and stream the llm response, recording the metrics."""
+        query_prompt, primer_prompt = self._build_prompt(query, chunks, query_prompt, primer_prompt)
+        metrics = self.metrics[self.answer_strategy]
+        start = time.perf_counter()
+        completion = []
+        for token in self.llm.stream_completion(query=query_prompt, primer_prompt=primer_prompt):
+            if not completion:
+                metrics["first_token_seconds"] += time.perf_counter() - start
+                metrics["streamed_answers"] += 1
+            completion.append(token)
+            yield token
+        self._record_call(
+            query_prompt, primer_prompt, "".join(completion), time.perf_counter() - start
+        )
+
+    def _record_call(
+        self, query_prompt: str, primer_prompt: str, completion: str, seconds: float
+    ) -> None:
+        """Add an llm call to the metrics of the answer strategy."""
+        metrics = self.metrics[self.answer_strategy]
+        metrics["llm_seconds"] += seconds
+        metrics["llm_calls"] += 1
+        metrics["prompt_tokens"] += count_tokens(query_prompt) + count_tokens(primer_prompt)
+        metrics["completion_tokens"] += count_tokens(completion)
+
+    def _select_context(self, top_k_idx: np.ndarray) -> np.ndarray:
+        """Deduplicate and diversify the retrieved rows with the maximal marginal relevance.
+
+        Relevance follows the retrieval ranks, so that every retrieval mode (including the
+        lexical and fused rankings) is diversified the same way.
+        """
+        if len(top_k_idx) == 0:
+            return top_k_idx
+        relevance = 1.0 - np.arange(len(top_k_idx)) / len(top_k_idx)
+        order = maximal_marginal_relevance(
+            self._chunk_vectors(top_k_idx), relevance, self.mmr_lambda, DUPLICATE_SIMILARITY
+        )
+        return top_k_idx[order]
+
+    def _pack_context(self, rows: np.ndarray, token_budget: int | None) -> PackedContext:
+        """Pack the chunks of the rows, best first, into a token budget (None: no budget)."""
+        if len(rows) == 0:
+            return PackedContext()
+        chunks = self.vector_store[RagSchema.CHUNK].to_numpy()[rows].tolist()
+        if token_budget is None:
+            token_budget = sum(count_tokens(chunk) for chunk in chunks)
+        # chunks keep the order of the rows
+        scores = -np.arange(len(rows))
+        return ContextPacker(token_budget).pack(chunks, scores, self._chunk_vectors(rows))
+
+    def _chunk_vectors(self, rows: np.ndarray) -> np.ndarray:
+        """Normalized embeddings of vector store rows, read from the shard holding each row."""
+        shards = np.searchsorted(self.embedding_offsets, rows, side="right") - 1
+        return np.stack(
+            [
+                self.embeddings[shard][row - self.embedding_offsets[shard]]
+                for shard, row in zip(shards, rows, strict=True)
+            ]
+        )
+
     def _fetch_top_k_chunks(
-        self, query: str, k: int = 20
+        self, query: str, k: int = 20, filters: dict | None = None
     ) -> tuple[list[str], list[str], list[str]]:
         """Fetch top k chunks based on the query vector.
 
         Args:
             query (str): userquery
-            k (int, optional): number of chunks to return. Defaults to 10.
+            k (int, optional): number of chunks to return. Defaults to 20.
+            filters (dict | None): only retrieve chunks matching these metadata filters
 
         Returns:
             list[str]: list of top k chunks
+            list[str]: sources (page metadata) of the top k chunks
+            list[str]: page numbers of the top k chunks
         """
-        # vectorize the query and compute similarities with the chunks
-        query_vector = self.embedder.encode(query)
-        similarities = self._compute_similiarities(query_vector)
+        top_k_idx = self._retrieve([query], k, filters)[0]
+        if top_k_idx is None:
+            msg = "Query could not be embedded"
+            raise ValueError(msg)
+        return self._gather_chunks(top_k_idx)
 
-        # select the top k chunks and their metadata from the vector store
-        top_k_idx = sorted(similarities, key=similarities.get, reverse=True)[:k]
-        top_chunks = [
-            self.vector_store.iloc[idx][[RagSchema.CHUNK]].to_list()[0] for idx in top_k_idx
-        ]
+    def _retrieve(
+        self, queries: list[str], k: int, filters: dict | None = None
+    ) -> list[np.ndarray | None]:
+        """Row positions of the top k live chunks of each query, best first.
 
-        metadata = [
-            self.vector_store.iloc[idx][[RagSchema.PAGE_METADATA]].to_list()[0] for idx in top_k_idx
-        ]
+        Vector and lexical rankings are fused in "hybrid" mode. Queries that neither retriever
+        could score (not embedded, in "vector" mode) return None.
+        """
+        query_vectors = self._embed_queries(queries)
+        embedded = [idx for idx, vector in enumerate(query_vectors) if vector is not None]
+        n_candidates = k if self.bm25_index is None else k * HYBRID_CANDIDATES_FACTOR
 
-        page_numbers = [
-            self.vector_store.iloc[idx][[RagSchema.PAGE_NUMBER]].to_list()[0] for idx in top_k_idx
-        ]
+        rankings = [[] for _ in queries]
+        if embedded:
+            vector_idx = self._search(
+                np.stack([query_vectors[idx] for idx in embedded]), n_candidates, filters
+            )
+            for query_idx, row_idx in zip(embedded, vector_idx, strict=True):
+                rankings[query_idx].append(row_idx)
+        if self.bm25_index is not None:
+            for query_idx, row_idx in enumerate(
+                self._lexical_search(queries, n_candidates, filters)
+            ):
+                rankings[query_idx].append(row_idx)
 
-        return top_chunks, list(set(metadata)), list(set(page_numbers))
+        results = []
+        for ranking in rankings:
+            if len(ranking) > 1:
+                results.append(reciprocal_rank_fusion(ranking, k))
+            else:
+                results.append(ranking[0][:k] if ranking else None)
+        return results
 
-    def _compute_similiarities(self, query_vector: list[float]) -> dict:
-        """Compute similarities between the query vector and the chunks in the vector store.
+    def _embed_queries(self, queries: list[str]) -> list[np.ndarray | None]:
+        """Embed the queries in a single call, None for queries without embedding.
 
-        Args:
-            query_vector (list[float]): embedded query
-
-        Returns:
-            dict: chunk_id -> similarity hashmap
+        Queries are not embedded in "lexical" mode, nor when the embedder exceeds the timeout.
         """
-        similiarities = {}
-        for row in self.vector_store.iterrows():
-            v1 = row[1][RagSchema.CHUNK_W_METADATA_EMBEDDING]
-            v2 = query_vector
-            chunk_id = row[1][RagSchema.CHUNK_ID]
-            similiarities[chunk_id] = self._cosine_similarity(embedding1=v1, embedding2=v2)
-        return similiarities
+        if self.retrieval_mode == "lexical":
+            return [None] * len(queries)
+        if self._embedding_pool is None:
+            return self.embedder.encode_list(queries)
+        future = self._embedding_pool.submit(self.embedder.encode_list, queries)
+        try:
+            return future.result(timeout=self.embedding_timeout)
+        except TimeoutError:
+            logging.warning("Query embedding timed out after %ss", self.embedding_timeout)
+            return [None] * len(queries)
 
-    @staticmethod
-    def _cosine_similarity(
-        embedding1: list[float] | np.ndarray, embedding2: list[float] | np.ndarray
-    ) -> float:
-        """Compute cosine similarity between two vectors of identical length.
+    def _lexical_search(
+        self, queries: list[str], k: int, filters: dict | None = None
+    ) -> list[np.ndarray]:
+        """Row positions of the top k live chunks of each query by BM25 score, best first."""
+        rows = self._filtered_rows(filters)
+        if rows is None and self.n_deleted:
+            rows = np.flatnonzero(self.live_rows)
+        top_k_idx, _ = self.bm25_index.search(queries, k, rows)
+        return [row_idx[row_idx >= 0] for row_idx in top_k_idx]
 
-        Args:
-            embedding1 (list[float] | np.ndarray): embedding vector 1
-            embedding2 (list[float] | np.ndarray): embedding vector 2
+    def _filtered_rows(self, filters: dict | None) -> np.ndarray | None:
+        """Live rows matching the metadata filters, None without filters."""
+        if not filters:
+            return None
+        rows = self.metadata_index.select(filters)
+        return rows[self.live_rows[rows]]
 
-        Returns:
-            float: cosine similarity
+    def _search(
+        self, query_vectors: np.ndarray, k: int, filters: dict | None = None
+    ) -> list[np.ndarray]:
+        """Row positions of the top k live chunks of each query, best first.
+
+        With filters, only the live rows matching them are scored. Otherwise the search index
+        also holds the tombstoned chunks: it is asked for k more results per tombstone, which
+        are then dropped.
         """
-        # check input
-        if len(embedding1) == 0 or len(embedding2) == 0:
-            msg = "Embeddings cannot be empty"
-            raise ValueError(msg)
-        if len(embedding1) != len(embedding2):
-            msg = "Embeddings must have the same dimension"
-            raise ValueError(msg)
-        if isinstance(embedding1, list):
-            embedding1 = np.array(embedding1)
-        if isinstance(embedding2, list):
-            embedding2 = np.array(embedding2)
-        if embedding1.ndim != 1 or embedding2.ndim != 1:
-            msg = "Embeddings must be a 1 dimensional array"
-            raise ValueError(msg)
+        rows = self._filtered_rows(filters)
+        if rows is not None:
+            top_k_idx, _ = self.search_index.search_rows(query_vectors, k, rows)
+            return list(top_k_idx)
+        top_k_idx, _ = self.search_index.search(query_vectors, k + self.n_deleted)
+        results = []
+        for row_idx in top_k_idx:
+            # approximate indexes pad missing results with negative positions
+            found = row_idx[row_idx >= 0]
+            results.append(found[self.live_rows[found]][:k])
+        return results
 
-        norm_a = np.linalg.norm(embedding1)
-        norm_b = np.linalg.norm(embedding2)
-        dot_product = np.dot(embedding1, embedding2)
-        cosine = dot_product / (norm_a * norm_b)
-        return cosine
+    def _gather_chunks(self, top_k_idx: np.ndarray) -> tuple[list[str], list[str], list[str]]:
+        """Select chunks and their metadata from the vector store rows positions."""
+        top_rows = self.vector_store.iloc[top_k_idx]
+        top_chunks = top_rows[RagSchema.CHUNK].to_list()
+        metadata = top_rows[RagSchema.PAGE_METADATA].to_list()
+        page_numbers = top_rows[RagSchema.PAGE_NUMBER].to_list()
+        return top_chunks, list(set(metadata)), list(set(page_numbers))
 
 
 if __name__ == "__main__":
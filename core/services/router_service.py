@@ -2,17 +2,24 @@
 
 from core.llmbackend.llm_backend import LlmBackend
 from core.llmbackend.prompts.routing_prompts import ROUTING_PROMPT
+from core.services.keyword_router import KeywordRouter
 
 
 class RouterService:
     """A simple agent to route user queries to the right pipeline.
 
+    With a fast router, queries are first classified locally, and only sent to the llm when the
+    classifier is not confident.
+
     Args:
         llm (LlmBackend): llm backend to use for routing.
+        fast_router (KeywordRouter | None): local classifier tried before the llm. Defaults to
+        None (every query is routed by the llm).
     """
 
-    def __init__(self, llm: LlmBackend) -> None:
+    def __init__(self, llm: LlmBackend, fast_router: KeywordRouter | None = None) -> None:
         self.llm = llm
+        self.fast_router = fast_router
 
     def route(self, query: str) -> str:
         """Route user query to the proper pipeline.
@@ -23,9 +30,24 @@ class RouterService:
         Returns:
             str: pipeline name
         """
-        pipeline = self.llm.get_completion(query=query, primer_prompt=ROUTING_PROMPT)
+        pipeline = self._fast_route(query)
+        if pipeline is None:
+            pipeline = self.llm.get_completion(query=query, primer_prompt=ROUTING_PROMPT)
+        return pipeline
+
+    async def aroute(self, query: str) -> str:
+        """Route user query to the proper pipeline, see route."""
+        pipeline = self._fast_route(query)
+        if pipeline is None:
+            pipeline = await self.llm.aget_completion(query=query, primer_prompt=ROUTING_PROMPT)
         return pipeline
 
+    def _fast_route(self, query: str) -> str | None:
+        """Pipeline of the fast router, None without fast router or when it is not confident."""
+        if self.fast_router is None:
+            return None
+        return self.fast_router.route(query)
+
 
 if __name__ == "__main__":
     pass
@@ -75,6 +75,8 @@ class Settings(metaclass=SingletonMeta):
         self.EMBEDDINGS_MODEL = os.getenv("EMBEDDINGS_MODEL")
         self.LLM_MODEL = os.getenv("LLM_MODEL")
         self.VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH")
+        self.EMBEDDINGS_CACHE_PATH = os.getenv("EMBEDDINGS_CACHE_PATH")
+        self.COMPLETION_CACHE_PATH = os.getenv("COMPLETION_CACHE_PATH")
         self.XLSX_PATH = os.getenv("XLSX_PATH")
         self.DE_PROMPT = os.getenv("DE_PROMPT")
         self.DE_TOOLS = os.getenv("DE_TOOLS")
@@ -82,6 +84,12 @@ class Settings(metaclass=SingletonMeta):
         self.DATAVIZ_TOOLS = os.getenv("DATAVIZ_TOOLS")
         self.FORECAST_PROMPT = os.getenv("FORECAST_PROMPT")
         self.RAG_PROMPT = os.getenv("RAG_PROMPT")
+        # connection pool shared by the llm and embedder backends
+        self.HTTP_MAX_CONNECTIONS = os.getenv("HTTP_MAX_CONNECTIONS")
+        self.HTTP_MAX_KEEPALIVE_CONNECTIONS = os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS")
+        self.HTTP_KEEPALIVE_EXPIRY = os.getenv("HTTP_KEEPALIVE_EXPIRY")
+        # "true" to send the data request while routing the query (see pipelines.py)
+        self.SPECULATIVE_DATA_REQUEST = os.getenv("SPECULATIVE_DATA_REQUEST")
 
 
 if __name__ == "__main__":
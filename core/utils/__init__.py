@@ -4,7 +4,10 @@ Miscellaneous functions used throughout the project.
 """
 
 import ast
+import asyncio
 import json
+from collections.abc import Coroutine
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 import Levenshtein
@@ -39,6 +42,20 @@ def read_tooled_response(llm_response: Any) -> dict:
     return {"function_name": function_name, "arguments": arguments}
 
 
+def run_sync(coroutine: Coroutine) -> Any:
+    """Run a coroutine to completion from synchronous code and return its result.
+
+    Called from a running event loop (e.g. a notebook), the coroutine runs on a new event loop
+    in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+
 def are_similar(str1: str, str2: str, threshold: float = 0.9) -> bool:
     """Check if two strings are similar using Levenshtein distance."""
     str1 = str1.lower().replace(" ", "").replace("_", "")
@@ -0,0 +1,209 @@
+""".. include:: README.md
+
+Single-flight coalescing of identical concurrent calls.
+
+The first call of a key (the leader) runs the function, the calls of the same key made while it
+runs wait for its result (or its exception) instead of running the function again. Calls are
+shared across threads and event loops: Streamlit sessions run in their own threads, and
+run_system runs its own event loop.
+
+Asynchronous functions run in their own task: cancelling the leader does not cancel the flight
+while other calls wait for it. A flight cancelled anyway (no other caller, or its event loop
+closed) is abandoned, and its waiters start a new one.
+"""
+
+import asyncio
+import threading
+from collections.abc import Awaitable, Callable, Hashable, Iterator
+from concurrent.futures import CancelledError, Future
+from dataclasses import dataclass, field
+from typing import Any
+
+
+@dataclass
+class _Flight:
+    """Execution shared by the calls of a key."""
+
+    future: Future = field(default_factory=Future)
+    waiters: int = 1
+
+
+class SingleFlight:
+    """Share a single execution between the concurrent calls of the same key.
+
+    Results are shared, not copied: callers must not modify them.
+
+    Attributes:
+        executions (int): number of executions of the functions (one per flight)
+        coalesced (int): number of calls answered by the execution of another call
+        max_waiters (int): largest number of calls sharing an execution
+    """
+
+    def __init__(self) -> None:
+        self.executions = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def do(self, key: Hashable, function: Callable, *args: Any, **kwargs: Any) -> Any:
+        """Call function(*args, **kwargs), or wait for the running call of the same key."""
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return flight.future.result()
+            except CancelledError:
+                pass  # abandoned flight, start a new one
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as exc:
+            self._finish(key, flight, exception=exc)
+            raise
+        self._finish(key, flight, result=result)
+        return result
+
+    async def ado(
+        self, key: Hashable, function: Callable[..., Awaitable], *args: Any, **kwargs: Any
+    ) -> Any:
+        """Await function(*args, **kwargs), or the running call of the same key."""
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            try:
+                # a cancelled waiter must not cancel the flight of the other callers
+                return await asyncio.shield(asyncio.wrap_future(flight.future))
+            except asyncio.CancelledError:
+                if not flight.future.cancelled():
+                    raise
+                # abandoned flight, start a new one
+        task = asyncio.ensure_future(function(*args, **kwargs))
+        task.add_done_callback(lambda done: self._finish_task(key, flight, done))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            with self._lock:
+                abandoned = flight.waiters == 1
+            if abandoned:
+                task.cancel()
+            raise
+
+    def waiters(self) -> dict[Hashable, int]:
+        """Number of calls waiting for each key in flight, the running call included."""
+        with self._lock:
+            return {key: flight.waiters for key, flight in self._flights.items()}
+
+    def stats(self) -> dict:
+        """Return the coalescing statistics, and the waiters of the keys in flight."""
+        calls = self.executions + self.coalesced
+        return {
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / calls if calls else 0.0,
+            "max_waiters": self.max_waiters,
+            "in_flight": self.waiters(),
+        }
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _join(self, key: Hashable) -> tuple[_Flight, bool]:
+        """Flight of a key, and whether the call leads it (it must run the function)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.executions += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+            self.max_waiters = max(self.max_waiters, flight.waiters)
+            return flight, leader
+
+    def _finish(
+        self,
+        key: Hashable,
+        flight: _Flight,
+        result: Any = None,
+        exception: BaseException | None = None,
+    ) -> None:
+        """End the flight of a key: later calls start a new execution."""
+        with self._lock:
+            del self._flights[key]
+        if exception is not None:
+            flight.future.set_exception(exception)
+        else:
+            flight.future.set_result(result)
+
+    def _finish_task(self, key: Hashable, flight: _Flight, task: asyncio.Future) -> None:
+        """End the flight of a key with the outcome of its task, abandon it if cancelled."""
+        if task.cancelled():
+            with self._lock:
+                del self._flights[key]
+                flight.future.cancel()
+        elif task.exception() is not None:
+            self._finish(key, flight, exception=task.exception())
+        else:
+            self._finish(key, flight, result=task.result())
+
+
+class SharedStream:
+    """Iterable over a stream, each iteration yields every item of the stream from the start.
+
+    Lets several consumers (possibly in different threads) read a single stream, e.g. the
+    streamed llm response of a coalesced call. Items are kept in memory.
+
+    Args:
+        stream (Iterator): stream to share, consumed once
+    """
+
+    def __init__(self, stream: Iterator) -> None:
+        self._stream = stream
+        self._items = []
+        self._done = False
+        self._exception = None
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator:
+        """Yield the items of the stream, reading the next ones from the stream if needed."""
+        position = 0
+        while True:
+            with self._lock:
+                if position == len(self._items) and not self._pull():
+                    return
+                item = self._items[position]
+            position += 1
+            yield item
+
+    def _pull(self) -> bool:
+        """Read the next item of the stream, False at its end. Called with the lock held."""
+        if self._exception is not None:
+            raise self._exception
+        if self._done:
+            return False
+        try:
+            self._items.append(next(self._stream))
+        except StopIteration:
+            self._done = True
+            return False
+        except Exception as exc:
+            self._exception = exc
+            raise
+        return True
+
+
+if __name__ == "__main__":
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    _flights = SingleFlight()
+    with ThreadPoolExecutor(max_workers=8) as _pool:
+        _results = list(_pool.map(lambda _: _flights.do("key", time.sleep, 0.1), range(8)))
+    print(_flights.stats())  # noqa: T201
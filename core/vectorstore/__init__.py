@@ -0,0 +1,4 @@
+""".. include:: README.md"""
+
+if __name__ == "__main__":
+    pass
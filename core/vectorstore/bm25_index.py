@@ -0,0 +1,202 @@
+""".. include:: README.md
+
+BM25 lexical index of the chunks, stored as sparse postings.
+
+Embedding similarity sometimes misses exact terms ("EBITDA", "PnL", "ROI"): a lexical index
+retrieves them, and does not need any API call to score a query.
+
+The BM25 weight of every (term, chunk) pair is computed at build time, and the postings of each
+term are stored as a contiguous slice of two arrays (CSR layout): scoring a query is a single
+weighted bincount over the postings of its terms.
+"""
+
+import re
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from core.readers.rag_schema import RagSchema
+from core.vectorstore.search_index import DTYPE, read_source, top_k
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_INDEX_SUFFIX = "_bm25.npz"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+class Bm25Index:
+    """BM25 index with precomputed term weights.
+
+    `row_ids[indptr[t]:indptr[t + 1]]` holds the rows containing the term t, and
+    `weights[indptr[t]:indptr[t + 1]]` its BM25 weight in each of these rows.
+
+    Args:
+        terms (np.ndarray): (n_terms,) vocabulary
+        indptr (np.ndarray): (n_terms + 1,) start of the postings of each term
+        row_ids (np.ndarray): (n_postings,) vector store positions of the postings
+        weights (np.ndarray): (n_postings,) BM25 weights of the postings
+        n_rows (int): number of indexed rows
+
+    Attributes:
+        source (str | None): fingerprint of the vector store the index was built from, saved
+        with it (see store_fingerprint). None if unknown.
+    """
+
+    def __init__(
+        self,
+        terms: np.ndarray,
+        indptr: np.ndarray,
+        row_ids: np.ndarray,
+        weights: np.ndarray,
+        n_rows: int,
+    ) -> None:
+        if len(indptr) != len(terms) + 1 or not indptr[-1] == len(row_ids) == len(weights):
+            msg = "Postings do not match the vocabulary"
+            raise ValueError(msg)
+        self.terms = terms
+        self.vocabulary = {term: idx for idx, term in enumerate(terms.tolist())}
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.row_ids = np.asarray(row_ids, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=DTYPE)
+        self.n_rows = n_rows
+        self.source = None
+
+    @property
+    def size(self) -> int:
+        """Number of rows held by the index."""
+        return self.n_rows
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    @classmethod
+    def build(cls, texts: list[str], k1: float = BM25_K1, b: float = BM25_B) -> "Bm25Index":
+        """Tokenize the texts and compute the BM25 weight of every posting.
+
+        Args:
+            texts (list[str]): indexed texts, rows follow the vector store
+            k1 (float): term frequency saturation
+            b (float): document length normalization
+
+        Returns:
+            Bm25Index: the index
+        """
+        vocabulary = {}
+        posting_terms, posting_rows, posting_counts = [], [], []
+        doc_lengths = np.zeros(len(texts), dtype=DTYPE)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[row] = len(tokens)
+            for term, count in Counter(tokens).items():
+                posting_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                posting_rows.append(row)
+                posting_counts.append(count)
+
+        posting_terms = np.asarray(posting_terms, dtype=np.int64)
+        # group the postings by term, rows stay sorted within a term
+        order = np.argsort(posting_terms, kind="stable")
+        row_ids = np.asarray(posting_rows, dtype=np.int64)[order]
+        frequencies = np.asarray(posting_counts, dtype=DTYPE)[order]
+        document_frequencies = np.bincount(posting_terms, minlength=len(vocabulary))
+        indptr = np.concatenate([[0], np.cumsum(document_frequencies)])
+
+        n_rows = len(texts)
+        idf = np.log1p((n_rows - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        average_length = max(float(doc_lengths.mean()) if n_rows else 0.0, 1.0)
+        length_norm = k1 * (1 - b + b * doc_lengths[row_ids] / average_length)
+        weights = np.repeat(idf, document_frequencies) * frequencies * (k1 + 1)
+        weights /= frequencies + length_norm
+
+        terms = np.array(sorted(vocabulary, key=vocabulary.get), dtype=str)
+        return cls(terms, indptr, row_ids, weights, n_rows)
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every row for a query, 0 for rows without any query term."""
+        term_ids = [self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary]
+        if not term_ids:
+            return np.zeros(self.n_rows, dtype=DTYPE)
+        postings = np.concatenate(
+            [np.arange(self.indptr[term], self.indptr[term + 1]) for term in term_ids]
+        )
+        return np.bincount(
+            self.row_ids[postings], weights=self.weights[postings], minlength=self.n_rows
+        ).astype(DTYPE)
+
+    def search(
+        self, queries: list[str], k: int, rows: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Find the k best scoring rows of each query, among every row or a subset of rows.
+
+        Rows without any query term are never returned: missing results are padded with -1
+        positions and 0 scores.
+
+        Returns:
+            np.ndarray: (n_queries, k) row positions, sorted by decreasing score
+            np.ndarray: (n_queries, k) BM25 scores of these rows
+        """
+        k = min(k, self.n_rows if rows is None else len(rows))
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.zeros((len(queries), k), dtype=DTYPE)
+        for query_idx, query in enumerate(queries):
+            query_scores = self.scores(query)
+            candidates = np.flatnonzero(query_scores) if rows is None else np.asarray(rows)
+            candidates = candidates[query_scores[candidates] > 0]
+            best, best_scores = top_k(query_scores[candidates][None, :], k)
+            indices[query_idx, : best.shape[1]] = candidates[best[0]]
+            scores[query_idx, : best.shape[1]] = best_scores[0]
+        return indices, scores
+
+    def save(self, file_path: str) -> None:
+        """Save the index to a .npz file."""
+        np.savez(
+            file_path,
+            terms=self.terms,
+            indptr=self.indptr,
+            row_ids=self.row_ids,
+            weights=self.weights,
+            n_rows=np.array(self.n_rows),
+            source=np.array(self.source or ""),
+        )
+
+    @classmethod
+    def load(cls, file_path: str) -> "Bm25Index":
+        """Load an index saved with the save method."""
+        with np.load(file_path) as arrays:
+            index = cls(
+                terms=arrays["terms"],
+                indptr=arrays["indptr"],
+                row_ids=arrays["row_ids"],
+                weights=arrays["weights"],
+                n_rows=int(arrays["n_rows"]),
+            )
+            index.source = read_source(arrays)
+        return index
+
+
+def bm25_index_path(vector_store_path: str) -> str:
+    """Path of the BM25 index built next to a vector store."""
+    return f"{vector_store_path}{BM25_INDEX_SUFFIX}"
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def chunk_texts(chunks: pd.DataFrame) -> list[str]:
+    """Indexed text of chunks: their page metadata and text, as in the embedded search column."""
+    return [
+        f"{metadata}\n{chunk}"
+        for metadata, chunk in zip(
+            chunks[RagSchema.PAGE_METADATA], chunks[RagSchema.CHUNK], strict=True
+        )
+    ]
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase alphanumeric tokens of a text."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+if __name__ == "__main__":
+    _index = Bm25Index.build(["The EBITDA margin", "PnL of the company", "ROI and EBITDA"])
+    print(_index.search(["what is the EBITDA?"], k=2))  # noqa: T201
@@ -0,0 +1,324 @@
+""".. include:: README.md
+
+Memory-mapped storage of the RAG vector store.
+
+A vector store is saved as a directory holding:
+- `metadata.parquet`: the slim chunks table (every RagSchema column but the embeddings)
+- `<embedding column>.npy`: one fixed-width (n_chunks, dim) float32 matrix per embedding column
+
+Embeddings are stored L2-normalized since they are only compared with cosine similarities.
+The matrices are memory-mapped at load: only the pages that are read are loaded, and every
+process reading the same store shares them through the OS page cache.
+
+Legacy vector stores (a single parquet file with object embedding columns) can still be read.
+
+Search indexes saved next to a store record its fingerprint (see store_fingerprint) and are
+removed whenever the store is rewritten: an index built from other contents is never reused.
+"""
+
+import hashlib
+import os
+import shutil
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from core.readers.rag_schema import RagSchema
+from core.vectorstore.bm25_index import bm25_index_path
+from core.vectorstore.ivf_index import ivf_index_path
+from core.vectorstore.quantization import QUANTIZATION_MODES, quantized_index_path
+from core.vectorstore.search_index import DTYPE, normalize_rows, stack_embeddings
+
+EMBEDDING_COLUMNS = [
+    RagSchema.CHUNK_EMBEDDING,
+    RagSchema.PAGE_METADATA_EMBEDDING,
+    RagSchema.CHUNK_W_METADATA_EMBEDDING,
+]
+METADATA_FILE = "metadata.parquet"
+# rows copied together when embeddings are appended to a vector store
+COPY_BLOCK_SIZE = 65536
+# rewritten stores are written next to the store, then swapped with it
+STORE_STAGING_SUFFIX = ".store.partial"
+STORE_BACKUP_SUFFIX = ".store.old"
+
+
+# =============================================================================
+# user functions
+# =============================================================================
+def save_vector_store(df: pd.DataFrame, dir_path: str) -> None:
+    """Save a dataframe following the RagSchema as a memory-mappable vector store directory.
+
+    The store is written to a staging directory (dir_path + STORE_STAGING_SUFFIX), then swapped
+    with the current store: readers holding its matrices memory-mapped keep reading the old files.
+    """
+    recover_vector_store(dir_path)
+    remove_indexes(dir_path)
+    staging_path = _make_staging_dir(dir_path)
+    embedding_columns = [column for column in EMBEDDING_COLUMNS if column in df.columns]
+    df.drop(columns=embedding_columns).to_parquet(
+        os.path.join(staging_path, METADATA_FILE), index=False
+    )
+    for column in embedding_columns:
+        matrix = normalize_rows(stack_embeddings(df[column]))
+        np.save(_embeddings_path(staging_path, column), matrix)
+    _swap_store(staging_path, dir_path)
+
+
+def save_vector_store_batches(batches: Iterable[pd.DataFrame], dir_path: str, n_rows: int) -> None:
+    """Save batches of a dataframe following the RagSchema as a vector store directory.
+
+    Only one batch is held in memory: the metadata table is written one row group per batch, and
+    the embeddings are written batch by batch into pre-allocated memory-mapped matrices.
+    Like save_vector_store, the store is written to a staging directory then swapped with the
+    current store, which is never rewritten in place.
+
+    Args:
+        batches (Iterable[pd.DataFrame]): consecutive batches of rows of the vector store
+        dir_path (str): path of the vector store directory
+        n_rows (int): total number of rows of the batches
+    """
+    recover_vector_store(dir_path)
+    remove_indexes(dir_path)
+    staging_path = _make_staging_dir(dir_path)
+    metadata_path = os.path.join(staging_path, METADATA_FILE)
+    write_parquet_batches(_write_embeddings(batches, staging_path, n_rows), metadata_path)
+    n_written = pq.read_metadata(metadata_path).num_rows
+    if n_written != n_rows:
+        msg = f"Expected {n_rows} rows, got {n_written}"
+        raise ValueError(msg)
+    _swap_store(staging_path, dir_path)
+
+
+def append_vector_store(metadata: pd.DataFrame, new_rows: pd.DataFrame, dir_path: str) -> None:
+    """Update the chunks table of a vector store directory and append new rows to it.
+
+    The embeddings of the existing rows are copied as they are: row positions do not change.
+    The search indexes of the store are removed, rebuild them with the new rows.
+
+    The updated store is written to a staging directory (dir_path + STORE_STAGING_SUFFIX), then
+    swapped with the store: a crash leaves the store as it was, never matrices and a chunks table
+    of different lengths.
+
+    Args:
+        metadata (pd.DataFrame): updated chunks table of the existing rows, without embeddings
+        new_rows (pd.DataFrame): rows following the RagSchema, appended after the existing rows
+        dir_path (str): path of the vector store directory
+    """
+    recover_vector_store(dir_path)
+    remove_indexes(dir_path)
+    staging_path = _make_staging_dir(dir_path)
+    for column in EMBEDDING_COLUMNS:
+        embeddings = new_rows[column] if len(new_rows) else None
+        _append_embeddings(dir_path, staging_path, column, embeddings, n_rows=len(metadata))
+    embedding_columns = [column for column in EMBEDDING_COLUMNS if column in new_rows.columns]
+    metadata = pd.concat([metadata, new_rows.drop(columns=embedding_columns)], ignore_index=True)
+    metadata.to_parquet(os.path.join(staging_path, METADATA_FILE), index=False)
+    _swap_store(staging_path, dir_path)
+
+
+def write_parquet_batches(
+    batches: Iterable[pd.DataFrame], file_path: str, compression: str | None = "snappy"
+) -> None:
+    """Write consecutive batches of a dataframe to a parquet file, one row group per batch."""
+    writer = None
+    try:
+        for batch in batches:
+            table = pa.Table.from_pandas(batch, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(file_path, table.schema, compression=compression)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        msg = "No batch to write"
+        raise ValueError(msg)
+
+
+def load_vector_store(
+    file_path: str, embedding_column: str = RagSchema.CHUNK_W_METADATA_EMBEDDING
+) -> tuple[pd.DataFrame, np.ndarray]:
+    """Load the chunks metadata and a single embedding column of a vector store.
+
+    Args:
+        file_path (str): path to a vector store directory, or to a legacy parquet vector store
+        embedding_column (str): embedding column to load
+
+    Returns:
+        pd.DataFrame: chunks table, without embedding columns
+        np.ndarray: (n_chunks, dim) float32 L2-normalized embeddings, read-only memory-mapped
+        when the vector store is a directory
+    """
+    if is_mmap_store(file_path):
+        return load_metadata(file_path), load_embeddings(file_path, embedding_column)
+
+    # legacy parquet store: embeddings are materialized and normalized in memory
+    vector_store = pd.read_parquet(file_path)
+    embeddings = normalize_rows(stack_embeddings(vector_store[embedding_column]))
+    embedding_columns = [column for column in EMBEDDING_COLUMNS if column in vector_store.columns]
+    return vector_store.drop(columns=embedding_columns), embeddings
+
+
+def load_metadata(dir_path: str) -> pd.DataFrame:
+    """Load the chunks table of a vector store directory."""
+    return pd.read_parquet(os.path.join(dir_path, METADATA_FILE))
+
+
+def load_embeddings(dir_path: str, embedding_column: str) -> np.ndarray:
+    """Memory-map an embedding column of a vector store directory (read-only)."""
+    if embedding_column not in EMBEDDING_COLUMNS:
+        msg = f"Invalid embedding column, use only: {EMBEDDING_COLUMNS}"
+        raise ValueError(msg)
+    return np.load(_embeddings_path(dir_path, embedding_column), mmap_mode="r")
+
+
+def is_mmap_store(file_path: str) -> bool:
+    """Check if a vector store is saved in the memory-mappable directory format."""
+    return os.path.isdir(file_path)
+
+
+def recover_vector_store(dir_path: str) -> None:
+    """Put back a vector store left aside by a rewrite interrupted between its two renames.
+
+    A backup left next to an existing store is stale (its removal failed): it is removed.
+    Backups of legacy parquet stores are files, backups of vector store directories are
+    directories.
+    """
+    backup_path = dir_path + STORE_BACKUP_SUFFIX
+    if not os.path.exists(backup_path):
+        return
+    if os.path.exists(dir_path):
+        _remove_path(backup_path)
+    else:
+        os.replace(backup_path, dir_path)
+
+
+def store_fingerprint(file_path: str) -> str:
+    """Fingerprint of the contents of a vector store: names, sizes and mtimes of its files.
+
+    Saved with the search indexes built from the store, and compared at load: any rewrite of the
+    store (even with the same number of rows) changes it.
+    """
+    if is_mmap_store(file_path):
+        paths = [os.path.join(file_path, METADATA_FILE)]
+        paths += [_embeddings_path(file_path, column) for column in EMBEDDING_COLUMNS]
+    else:
+        paths = [file_path]
+    digest = hashlib.sha256()
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}|{stat.st_size}|{stat.st_mtime_ns}|".encode())
+    return digest.hexdigest()
+
+
+def remove_indexes(file_path: str) -> None:
+    """Remove the search indexes (IVF, quantized codes, BM25) saved next to a vector store."""
+    index_paths = [ivf_index_path(file_path), bm25_index_path(file_path)]
+    index_paths += [quantized_index_path(file_path, mode) for mode in QUANTIZATION_MODES]
+    for index_path in index_paths:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _write_embeddings(
+    batches: Iterable[pd.DataFrame], dir_path: str, n_rows: int
+) -> Iterator[pd.DataFrame]:
+    """Write the embeddings of each batch to the memory-mapped matrices, yield the other columns."""
+    matrices = {}
+    start = 0
+    for batch in batches:
+        embedding_columns = [column for column in EMBEDDING_COLUMNS if column in batch.columns]
+        for column in embedding_columns:
+            rows = normalize_rows(stack_embeddings(batch[column]))
+            if column not in matrices:
+                matrices[column] = np.lib.format.open_memmap(
+                    _embeddings_path(dir_path, column),
+                    mode="w+",
+                    dtype=DTYPE,
+                    shape=(n_rows, rows.shape[1]),
+                )
+            matrices[column][start : start + len(batch)] = rows
+        start += len(batch)
+        yield batch.drop(columns=embedding_columns)
+    for matrix in matrices.values():
+        matrix.flush()
+
+
+def _append_embeddings(
+    dir_path: str, staging_path: str, column: str, embeddings: pd.Series | None, n_rows: int
+) -> None:
+    """Write an embedding matrix with new rows appended to the staging directory.
+
+    Without new rows, the staged matrix is a hard link to the current one.
+    """
+    path = _embeddings_path(dir_path, column)
+    staged_path = _embeddings_path(staging_path, column)
+    old_matrix = np.load(path, mmap_mode="r")
+    if len(old_matrix) != n_rows:
+        msg = f"{column} holds {len(old_matrix)} rows, the chunks table {n_rows}"
+        raise ValueError(msg)
+    if embeddings is None:
+        del old_matrix
+        os.link(path, staged_path)
+        return
+    rows = normalize_rows(stack_embeddings(embeddings))
+    matrix = np.lib.format.open_memmap(
+        staged_path, mode="w+", dtype=DTYPE, shape=(n_rows + len(rows), old_matrix.shape[1])
+    )
+    for start in range(0, n_rows, COPY_BLOCK_SIZE):
+        stop = min(start + COPY_BLOCK_SIZE, n_rows)
+        matrix[start:stop] = old_matrix[start:stop]
+    matrix[n_rows:] = rows
+    matrix.flush()
+
+
+def _make_staging_dir(dir_path: str) -> str:
+    """Create an empty staging directory next to a vector store and return its path."""
+    staging_path = dir_path + STORE_STAGING_SUFFIX
+    shutil.rmtree(staging_path, ignore_errors=True)
+    os.makedirs(staging_path)
+    return staging_path
+
+
+def _swap_store(staging_path: str, dir_path: str) -> None:
+    """Replace a vector store (if any) with a staging directory.
+
+    The replaced store is a vector store directory, or a legacy parquet file migrated to the
+    directory format. Files are never rewritten in place: readers holding the old matrices
+    memory-mapped keep reading the removed files.
+    """
+    if not os.path.exists(dir_path):
+        os.replace(staging_path, dir_path)
+        return
+    backup_path = dir_path + STORE_BACKUP_SUFFIX
+    _remove_path(backup_path)
+    os.replace(dir_path, backup_path)
+    os.replace(staging_path, dir_path)
+    _remove_path(backup_path)
+
+
+def _remove_path(path: str) -> None:
+    """Remove a directory tree or a file, if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _embeddings_path(dir_path: str, embedding_column: str) -> str:
+    """Path of the .npy file of an embedding column."""
+    return os.path.join(dir_path, f"{embedding_column}.npy")
+
+
+if __name__ == "__main__":
+    from core.settings.settings import Settings
+
+    _metadata, _embeddings = load_vector_store(Settings().VECTOR_STORE_PATH)
+    print(_metadata, _embeddings.shape)  # noqa: T201
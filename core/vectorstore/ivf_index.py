@@ -0,0 +1,231 @@
+""".. include:: README.md
+
+Inverted-file (IVF) approximate nearest neighbour index, written in pure numpy.
+
+Normalized embeddings are clustered with a spherical k-means (coarse quantizer). Each vector is
+stored in the inverted list of its closest centroid. At query time only the `n_probe` lists
+closest to the query are scored exactly: `n_probe` is the recall/latency knob of the index.
+"""
+
+import logging
+
+import numpy as np
+
+from core.vectorstore.search_index import (
+    DTYPE,
+    SearchIndex,
+    normalize_rows,
+    read_source,
+    search_rows_exact,
+    top_k,
+)
+
+N_PROBE = 8
+KMEANS_ITERATIONS = 20
+# the coarse quantizer is trained on at most this many points per list
+TRAINING_POINTS_PER_LIST = 256
+# vectors are assigned to their list by blocks to bound memory usage
+ASSIGNMENT_BLOCK_SIZE = 16384
+IVF_INDEX_SUFFIX = "_ivf.npz"
+
+
+class IvfIndex(SearchIndex):
+    """IVF index with a spherical k-means coarse quantizer.
+
+    Only the coarse quantizer and the inverted lists are held by the index: list members are
+    scored against the (usually memory-mapped, see embedding_store.py) matrix of the vector store.
+    `row_ids[offsets[i]:offsets[i + 1]]` holds the vector store positions of the rows of list `i`.
+
+    Args:
+        matrix (np.ndarray): (n_rows, dim) float32 L2-normalized embeddings, rows follow the
+        vector store. They can be memory-mapped: only the rows of the probed lists are read.
+        centroids (np.ndarray): (n_lists, dim) normalized centroids
+        row_ids (np.ndarray): (n_rows,) vector store positions, sorted by inverted list
+        offsets (np.ndarray): (n_lists + 1,) start of each inverted list in row_ids
+        n_probe (int): number of inverted lists scored per query
+
+    Attributes:
+        n_probe (int): number of inverted lists scored per query. Higher is slower but more exact.
+        source (str | None): fingerprint of the vector store the index was built from, saved
+        with it (see store_fingerprint). None if unknown.
+    """
+
+    def __init__(
+        self,
+        matrix: np.ndarray,
+        centroids: np.ndarray,
+        row_ids: np.ndarray,
+        offsets: np.ndarray,
+        n_probe: int = N_PROBE,
+    ) -> None:
+        if len(offsets) != len(centroids) + 1 or offsets[-1] != len(row_ids):
+            msg = "Inverted lists offsets do not match the centroids and the row ids"
+            raise ValueError(msg)
+        if len(row_ids) != len(matrix):
+            msg = f"The index holds {len(row_ids)} rows, the embeddings {len(matrix)}"
+            raise ValueError(msg)
+        self.matrix = matrix
+        self.centroids = np.ascontiguousarray(centroids, dtype=DTYPE)
+        self.row_ids = np.asarray(row_ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.n_probe = n_probe
+        self.source = None
+
+    @property
+    def size(self) -> int:
+        """Number of vectors held by the index."""
+        return self.row_ids.shape[0]
+
+    @property
+    def n_lists(self) -> int:
+        """Number of inverted lists."""
+        return self.centroids.shape[0]
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray,
+        n_lists: int | None = None,
+        n_probe: int = N_PROBE,
+        seed: int = 0,
+        normalized: bool = False,
+    ) -> "IvfIndex":
+        """Train the coarse quantizer and fill the inverted lists.
+
+        Args:
+            embeddings (np.ndarray): (n_rows, dim) embeddings, rows follow the vector store
+            n_lists (int | None): number of inverted lists. Defaults to sqrt(n_rows).
+            n_probe (int): number of inverted lists scored per query
+            seed (int): seed of the k-means initialisation and training sample
+            normalized (bool): the embeddings are already a float32 matrix of L2-normalized
+            rows. They are then used as is (no copy), e.g. to keep a memory-mapped matrix shared.
+
+        Returns:
+            IvfIndex: the trained index
+        """
+        matrix = embeddings if normalized else normalize_rows(embeddings)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(matrix)))
+        n_lists = max(1, min(n_lists, len(matrix)))
+
+        centroids = _spherical_kmeans(matrix, n_lists, seed=seed)
+        assignments = _assign(matrix, centroids)
+
+        row_ids = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_lists)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(matrix, centroids, row_ids, offsets, n_probe=n_probe)
+
+    def search(self, query_vectors: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Score each query against the rows of its n_probe closest inverted lists.
+
+        Queries whose probed lists hold less than k rows return fewer results, padded with -1
+        positions and -inf scores.
+        """
+        queries = normalize_rows(np.atleast_2d(query_vectors))
+        if queries.shape[1] != self.matrix.shape[1]:
+            msg = "Embeddings must have the same dimension"
+            raise ValueError(msg)
+        k = min(k, self.size)
+        n_probe = max(1, min(self.n_probe, self.n_lists))
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=DTYPE)
+        probed_lists, _ = top_k(queries @ self.centroids.T, n_probe)
+        for query_idx, (query, lists) in enumerate(zip(queries, probed_lists, strict=True)):
+            candidates = np.concatenate(
+                [self.row_ids[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+            )
+            if len(candidates) == 0:
+                continue
+            # sorted positions make memory-mapped reads sequential
+            candidates = np.sort(candidates)
+            best, best_scores = top_k((self.matrix[candidates] @ query)[None, :], k)
+            indices[query_idx, : best.shape[1]] = candidates[best[0]]
+            scores[query_idx, : best.shape[1]] = best_scores[0]
+        return indices, scores
+
+    def search_rows(
+        self, query_vectors: np.ndarray, k: int, rows: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Score the queries against the subset of rows only, exactly (no list is skipped)."""
+        return search_rows_exact(self.matrix, query_vectors, k, rows)
+
+    def save(self, file_path: str) -> None:
+        """Save the coarse quantizer and the inverted lists (not the embeddings) to a .npz file."""
+        np.savez(
+            file_path,
+            centroids=self.centroids,
+            row_ids=self.row_ids,
+            offsets=self.offsets,
+            source=np.array(self.source or ""),
+        )
+
+    @classmethod
+    def load(cls, file_path: str, matrix: np.ndarray, n_probe: int = N_PROBE) -> "IvfIndex":
+        """Load an index saved with the save method, scoring against the given embeddings."""
+        with np.load(file_path) as arrays:
+            index = cls(
+                matrix,
+                centroids=arrays["centroids"],
+                row_ids=arrays["row_ids"],
+                offsets=arrays["offsets"],
+                n_probe=n_probe,
+            )
+            index.source = read_source(arrays)
+        return index
+
+
+def ivf_index_path(vector_store_path: str) -> str:
+    """Path of the IVF index built next to a vector store."""
+    return f"{vector_store_path}{IVF_INDEX_SUFFIX}"
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _spherical_kmeans(
+    matrix: np.ndarray, n_clusters: int, n_iter: int = KMEANS_ITERATIONS, seed: int = 0
+) -> np.ndarray:
+    """Cluster normalized vectors using cosine similarity and return normalized centroids.
+
+    The centroids are trained on a random sample of the matrix. Empty clusters are re-seeded
+    with random points of the sample.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = min(len(matrix), n_clusters * TRAINING_POINTS_PER_LIST)
+    sample = matrix[rng.choice(len(matrix), size=n_samples, replace=False)]
+    centroids = sample[rng.choice(n_samples, size=n_clusters, replace=False)]
+
+    for _ in range(n_iter):
+        assignments = _assign(sample, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        empty = counts == 0
+        # sum the points of each cluster as contiguous slices of the sorted sample
+        order = np.argsort(assignments, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+        if empty.any():
+            logging.debug("Re-seeding %s empty k-means clusters", empty.sum())
+            sums[empty] = sample[rng.choice(n_samples, size=empty.sum(), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def _assign(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Return the position of the closest centroid of each row, computed by blocks."""
+    assignments = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), ASSIGNMENT_BLOCK_SIZE):
+        block = matrix[start : start + ASSIGNMENT_BLOCK_SIZE]
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+if __name__ == "__main__":
+    _embeddings = np.random.rand(10000, 64)
+    _index = IvfIndex.build(_embeddings)
+    print(_index.search(_embeddings[:2], k=5))  # noqa: T201
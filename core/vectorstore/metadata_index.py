@@ -0,0 +1,114 @@
+""".. include:: README.md
+
+Inverted indexes of the chunks metadata, used to pre-filter the rows of a vector search.
+
+Filters are given as a dictionary keyed by RagSchema columns:
+- RagSchema.DOC_ID: list of accepted document ids
+- RagSchema.PAGE_METADATA: list of accepted chapters
+- RagSchema.PAGE_NUMBER: (first, last) inclusive range of accepted pages
+A row is selected when it matches every given filter.
+"""
+
+import numpy as np
+import pandas as pd
+
+from core.readers.rag_schema import RagSchema
+
+FILTER_COLUMNS = [RagSchema.DOC_ID, RagSchema.PAGE_METADATA, RagSchema.PAGE_NUMBER]
+
+
+class MetadataIndex:
+    """Inverted indexes of the metadata columns of a chunks table.
+
+    - DOC_ID and PAGE_METADATA: one posting list (sorted row positions) per distinct value,
+    each row is held by a single posting list per column
+    - PAGE_NUMBER: row positions sorted by page number, page ranges are found by binary search
+
+    The memory of each index grows with the number of rows, not with the number of distinct
+    values (documents or chapters).
+
+    Args:
+        metadata (pd.DataFrame): chunks table following the RagSchema, rows follow the vector store
+    """
+
+    def __init__(self, metadata: pd.DataFrame) -> None:
+        self.n_rows = len(metadata)
+        self.postings = {
+            column: _postings(metadata[column])
+            for column in (RagSchema.DOC_ID, RagSchema.PAGE_METADATA)
+        }
+        pages = metadata[RagSchema.PAGE_NUMBER].to_numpy()
+        self.page_order = np.argsort(pages, kind="stable")
+        self.sorted_pages = pages[self.page_order]
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def select(self, filters: dict) -> np.ndarray:
+        """Row positions matching every filter.
+
+        Args:
+            filters (dict): accepted values by RagSchema column. list: FILTER_COLUMNS
+
+        Returns:
+            np.ndarray: sorted row positions
+        """
+        invalid = [column for column in filters if column not in FILTER_COLUMNS]
+        if invalid:
+            msg = f"Invalid filter columns {invalid}, use only: {FILTER_COLUMNS}"
+            raise ValueError(msg)
+
+        selected = None
+        for column, postings in self.postings.items():
+            if column not in filters:
+                continue
+            values = filters[column]
+            if np.isscalar(values):
+                values = [values]
+            # the posting lists of a column are disjoint
+            matches = [postings[value] for value in set(values) if value in postings]
+            rows = np.sort(np.concatenate(matches)) if matches else np.empty(0, dtype=np.int64)
+            selected = _intersect(selected, rows)
+        if RagSchema.PAGE_NUMBER in filters:
+            selected = _intersect(selected, self._page_range_rows(*filters[RagSchema.PAGE_NUMBER]))
+        if selected is None:
+            return np.arange(self.n_rows)
+        return selected
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _page_range_rows(self, first: int, last: int) -> np.ndarray:
+        """Sorted positions of the rows whose page number is in [first, last]."""
+        start = np.searchsorted(self.sorted_pages, first, side="left")
+        stop = np.searchsorted(self.sorted_pages, last, side="right")
+        return np.sort(self.page_order[start:stop])
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _postings(column: pd.Series) -> dict:
+    """Sorted positions of the rows holding each distinct value of a column."""
+    codes, values = pd.factorize(column)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.cumsum(np.bincount(codes[codes >= 0], minlength=len(values)))[:-1]
+    # rows of missing values (code -1) come first in the order, they are skipped
+    rows = np.split(order[np.count_nonzero(codes < 0) :], bounds)
+    return dict(zip(values.tolist(), rows, strict=True))
+
+
+def _intersect(selected: np.ndarray | None, rows: np.ndarray) -> np.ndarray:
+    """Intersect sorted unique row positions, None standing for every row."""
+    if selected is None:
+        return rows
+    return np.intersect1d(selected, rows, assume_unique=True)
+
+
+if __name__ == "__main__":
+    from core.settings.settings import Settings
+    from core.vectorstore.embedding_store import load_vector_store
+
+    _metadata, _ = load_vector_store(Settings().VECTOR_STORE_PATH)
+    _index = MetadataIndex(_metadata)
+    print(_index.select({RagSchema.PAGE_NUMBER: (30, 40)}))  # noqa: T201
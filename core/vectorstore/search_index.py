@@ -0,0 +1,252 @@
+""".. include:: README.md
+
+Search indexes used to retrieve the closest chunks of the vector store from a query vector.
+
+Embeddings are stacked once into a contiguous float32 matrix and normalized at build time,
+so that cosine similarities reduce to a single matrix product at query time.
+"""
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+DTYPE = np.float32
+# rank offset of the reciprocal rank fusion, damps the weight of the first ranks
+RRF_K = 60
+# trade-off between relevance (1.0) and diversity (0.0) of the maximal marginal relevance
+MMR_LAMBDA = 0.7
+# cosine similarity above which two chunks are considered duplicates
+DUPLICATE_SIMILARITY = 0.95
+
+
+class SearchIndex(ABC):
+    """Abstract class for search indexes.
+
+    All child must implement the search public method.
+    """
+
+    @abstractmethod
+    def search(self, query_vectors: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Find the k closest rows of the index for each query vector.
+
+        Args:
+            query_vectors (np.ndarray): (dim,) or (n_queries, dim) array of query embeddings
+            k (int): number of rows to return per query
+
+        Returns:
+            np.ndarray: (n_queries, k) row positions, sorted by decreasing similarity
+            np.ndarray: (n_queries, k) cosine similarities of these rows
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def search_rows(
+        self, query_vectors: np.ndarray, k: int, rows: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Find the k closest rows among a subset of rows (e.g. pre-filtered on metadata).
+
+        Only the subset is scored.
+
+        Args:
+            query_vectors (np.ndarray): (dim,) or (n_queries, dim) array of query embeddings
+            k (int): number of rows to return per query
+            rows (np.ndarray): row positions to search
+
+        Returns:
+            np.ndarray: (n_queries, k) row positions, sorted by decreasing similarity
+            np.ndarray: (n_queries, k) cosine similarities of these rows
+        """
+        raise NotImplementedError
+
+    @property
+    @abstractmethod
+    def size(self) -> int:
+        """Number of vectors held by the index."""
+        raise NotImplementedError
+
+
+class ExactSearchIndex(SearchIndex):
+    """Brute-force cosine similarity search.
+
+    Args:
+        embeddings (np.ndarray): (n_rows, dim) matrix of embeddings, rows follow the vector store.
+        normalized (bool): the embeddings are already a float32 matrix of L2-normalized rows.
+        They are then used as is (no copy), e.g. to keep a memory-mapped matrix shared.
+
+    Attributes:
+        matrix (np.ndarray): float32 matrix of L2-normalized embeddings.
+    """
+
+    def __init__(self, embeddings: np.ndarray, normalized: bool = False) -> None:
+        if normalized:
+            if embeddings.dtype != DTYPE or embeddings.ndim != 2:  # noqa: PLR2004
+                msg = "Normalized embeddings must be a 2 dimensional float32 array"
+                raise ValueError(msg)
+            self.matrix = embeddings
+        else:
+            self.matrix = normalize_rows(embeddings)
+
+    @property
+    def size(self) -> int:
+        """Number of vectors held by the index."""
+        return self.matrix.shape[0]
+
+    def search(self, query_vectors: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Score the queries against every row with a single matrix product."""
+        queries = normalize_rows(np.atleast_2d(query_vectors))
+        if queries.shape[1] != self.matrix.shape[1]:
+            msg = "Embeddings must have the same dimension"
+            raise ValueError(msg)
+        scores = queries @ self.matrix.T
+        return top_k(scores, k)
+
+    def search_rows(
+        self, query_vectors: np.ndarray, k: int, rows: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Score the queries against the subset of rows only."""
+        return search_rows_exact(self.matrix, query_vectors, k, rows)
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def stack_embeddings(embeddings: pd.Series | list) -> np.ndarray:
+    """Stack a column of 1d embeddings into a contiguous (n_rows, dim) float32 matrix."""
+    if len(embeddings) == 0:
+        msg = "Embeddings cannot be empty"
+        raise ValueError(msg)
+    try:
+        matrix = np.stack([np.asarray(vector, dtype=DTYPE) for vector in embeddings])
+    except Exception as exc:
+        msg = "Embeddings must be non-null and have the same dimension"
+        raise ValueError(msg) from exc
+    return np.ascontiguousarray(matrix)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Return a C-contiguous float32 copy of the matrix with L2-normalized rows.
+
+    Null rows are left as zeros so that they score 0 against any query.
+    """
+    matrix = np.asarray(matrix, dtype=DTYPE)
+    if matrix.ndim != 2 or matrix.shape[1] == 0:  # noqa: PLR2004
+        msg = "Embeddings must be a non-empty 2 dimensional array"
+        raise ValueError(msg)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms)
+
+
+def top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Select the k best scores of each row with a partial sort.
+
+    Args:
+        scores (np.ndarray): (n_queries, n_rows) similarity scores
+        k (int): number of scores to keep per row, capped to n_rows
+
+    Returns:
+        np.ndarray: (n_queries, k) column positions, sorted by decreasing score
+        np.ndarray: (n_queries, k) matching scores
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(scores.dtype)
+    # partition then sort only the k best candidates of each row
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    indices = np.take_along_axis(candidates, order, axis=1)
+    return indices, np.take_along_axis(candidate_scores, order, axis=1)
+
+
+def search_rows_exact(
+    matrix: np.ndarray, query_vectors: np.ndarray, k: int, rows: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Brute-force search restricted to some rows of a normalized matrix.
+
+    Returns:
+        np.ndarray: (n_queries, k) positions in the matrix, sorted by decreasing similarity
+        np.ndarray: (n_queries, k) cosine similarities of these rows
+    """
+    queries = normalize_rows(np.atleast_2d(query_vectors))
+    if queries.shape[1] != matrix.shape[1]:
+        msg = "Embeddings must have the same dimension"
+        raise ValueError(msg)
+    # sorted positions make memory-mapped reads sequential
+    rows = np.sort(np.asarray(rows, dtype=np.int64))
+    best, best_scores = top_k(queries @ matrix[rows].T, k)
+    return rows[best], best_scores
+
+
+def reciprocal_rank_fusion(rankings: list[np.ndarray], k: int, rrf_k: int = RRF_K) -> np.ndarray:
+    """Fuse rankings of row positions into a single ranking.
+
+    Each row scores sum(1 / (rrf_k + rank)) over the rankings holding it. The fusion only uses
+    ranks, so rankings of scores on different scales (e.g. cosine and BM25) can be fused.
+
+    Args:
+        rankings (list[np.ndarray]): row positions, best first
+        k (int): number of fused rows to return
+        rrf_k (int): rank offset
+
+    Returns:
+        np.ndarray: (k,) row positions, best first. Ties keep the order of the first rankings.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking.tolist(), start=1):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (rrf_k + rank)
+    best = sorted(fused, key=fused.get, reverse=True)[:k]
+    return np.array(best, dtype=np.int64)
+
+
+def maximal_marginal_relevance(
+    vectors: np.ndarray,
+    relevance: np.ndarray,
+    mmr_lambda: float = MMR_LAMBDA,
+    duplicate_similarity: float = DUPLICATE_SIMILARITY,
+) -> np.ndarray:
+    """Order candidates by maximal marginal relevance, dropping near-duplicates.
+
+    Each step selects the candidate maximizing
+    mmr_lambda * relevance - (1 - mmr_lambda) * (max similarity to the selected candidates).
+    Candidates whose similarity to a selected candidate exceeds duplicate_similarity are dropped.
+
+    Args:
+        vectors (np.ndarray): (n_candidates, dim) L2-normalized embeddings of the candidates
+        relevance (np.ndarray): (n_candidates,) relevance of the candidates to the query
+        mmr_lambda (float): relevance weight, 1.0 keeps the relevance order
+        duplicate_similarity (float): cosine similarity of near-duplicates
+
+    Returns:
+        np.ndarray: positions of the kept candidates, in selection order
+    """
+    similarities = vectors @ vectors.T
+    relevance = np.asarray(relevance, dtype=DTYPE)
+    max_similarity = np.full(len(relevance), -np.inf, dtype=DTYPE)
+    available = np.ones(len(relevance), dtype=bool)
+    selected = []
+    while available.any():
+        redundancy = np.where(np.isfinite(max_similarity), max_similarity, 0.0)
+        mmr_scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        best = int(np.argmax(np.where(available, mmr_scores, -np.inf)))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, similarities[best])
+        available &= max_similarity <= duplicate_similarity
+    return np.array(selected, dtype=np.int64)
+
+
+def read_source(arrays: np.lib.npyio.NpzFile) -> str | None:
+    """Source fingerprint saved with an index, None for the indexes saved without it."""
+    if "source" not in arrays:
+        return None
+    return str(arrays["source"]) or None
+
+
+if __name__ == "__main__":
+    _embeddings = np.random.rand(1000, 64)
+    _index = ExactSearchIndex(_embeddings)
+    print(_index.search(_embeddings[:2], k=5))  # noqa: T201
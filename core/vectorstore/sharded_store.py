@@ -0,0 +1,203 @@
+""".. include:: README.md
+
+Multi-document vector store, holding one shard per document.
+
+A sharded vector store is a directory holding a `manifest.json` file and one vector store
+directory (see embedding_store.py) per document. Each shard has its own chunks table, embedding
+matrices and search indexes, so that documents are added, re-ingested or removed without
+rewriting the other ones.
+
+At search time, every shard is searched in parallel and the per-shard top-k are merged.
+"""
+
+import json
+import os
+import shutil
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from core.vectorstore.search_index import SearchIndex, top_k
+
+MANIFEST_FILE = "manifest.json"
+# shards are searched by threads: numpy releases the GIL in matrix products
+MAX_SEARCH_WORKERS = 8
+
+
+class ShardedVectorStore:
+    """Manifest of the documents of a sharded vector store.
+
+    Args:
+        root_path (str): path of the sharded vector store directory, created if needed
+
+    Attributes:
+        documents (dict[int, dict]): name and shard directory of each document, by DOC_ID
+    """
+
+    def __init__(self, root_path: str) -> None:
+        self.root_path = root_path
+        os.makedirs(root_path, exist_ok=True)
+        manifest_path = os.path.join(root_path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+        else:
+            manifest = {"next_doc_id": 0, "documents": {}}
+        self.next_doc_id = manifest["next_doc_id"]
+        self.documents = {int(doc_id): doc for doc_id, doc in manifest["documents"].items()}
+
+    # =============================================================================
+    # user functions
+    # =============================================================================
+    def new_shard(self) -> tuple[int, str]:
+        """Reserve the DOC_ID and the shard directory of a new document.
+
+        The document is only part of the store once the shard is written and added with
+        add_document.
+
+        Returns:
+            int: DOC_ID of the new document
+            str: path of its shard directory
+        """
+        doc_id = self.next_doc_id
+        self.next_doc_id += 1
+        self._save_manifest()
+        return doc_id, self.shard_path(doc_id)
+
+    def add_document(self, doc_id: int, name: str) -> None:
+        """Add a written shard to the store."""
+        if not os.path.isdir(self.shard_path(doc_id)):
+            msg = f"Shard of document {doc_id} was not written"
+            raise ValueError(msg)
+        self.documents[doc_id] = {"name": name, "shard": _shard_name(doc_id)}
+        self._save_manifest()
+
+    def remove_document(self, doc_id: int) -> None:
+        """Remove a document and delete its shard, the other shards are left untouched."""
+        if doc_id not in self.documents:
+            msg = f"Unknown document {doc_id}, use only: {list(self.documents)}"
+            raise ValueError(msg)
+        del self.documents[doc_id]
+        self._save_manifest()
+        shard_path = self.shard_path(doc_id)
+        shutil.rmtree(shard_path, ignore_errors=True)
+        # search indexes are saved next to their shard, as <shard>_<index>.npz
+        shard_name = _shard_name(doc_id) + "_"
+        for file_name in os.listdir(self.root_path):
+            if file_name.startswith(shard_name):
+                os.remove(os.path.join(self.root_path, file_name))
+
+    def shard_path(self, doc_id: int) -> str:
+        """Path of the vector store directory of a document."""
+        return os.path.join(self.root_path, _shard_name(doc_id))
+
+    def shard_paths(self) -> list[str]:
+        """Paths of the shards of every document, by increasing DOC_ID."""
+        return [self.shard_path(doc_id) for doc_id in sorted(self.documents)]
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _save_manifest(self) -> None:
+        """Write the manifest atomically: readers never see a partially written manifest."""
+        manifest = {
+            "next_doc_id": self.next_doc_id,
+            "documents": {str(doc_id): doc for doc_id, doc in sorted(self.documents.items())},
+        }
+        manifest_path = os.path.join(self.root_path, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+
+class ShardedSearchIndex(SearchIndex):
+    """Search index over the shards of a vector store, searched in parallel.
+
+    Row positions are global: the rows of each shard follow the rows of the previous shards.
+
+    Args:
+        indexes (list[SearchIndex]): search index of each shard, in the rows order
+        max_workers (int): maximum number of shards searched at the same time
+    """
+
+    def __init__(self, indexes: list[SearchIndex], max_workers: int = MAX_SEARCH_WORKERS) -> None:
+        self.indexes = indexes
+        self.offsets = np.cumsum([0] + [index.size for index in indexes])[:-1]
+        self.max_workers = max_workers
+
+    @property
+    def size(self) -> int:
+        """Number of vectors held by the index."""
+        return int(sum(index.size for index in self.indexes))
+
+    def search(self, query_vectors: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Search the top k rows of each shard in parallel, then merge them into a global top k.
+
+        Missing results (e.g. from approximate shard indexes) are padded with -1 positions.
+        """
+        searches = [
+            (offset, partial(index.search, query_vectors, k))
+            for index, offset in zip(self.indexes, self.offsets, strict=True)
+        ]
+        return self._merge(searches, np.atleast_2d(query_vectors).shape[0], k)
+
+    def search_rows(
+        self, query_vectors: np.ndarray, k: int, rows: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Search the subset of rows of each shard in parallel, shards without rows are skipped."""
+        rows = np.asarray(rows, dtype=np.int64)
+        searches = []
+        for index, offset in zip(self.indexes, self.offsets, strict=True):
+            shard_rows = rows[(rows >= offset) & (rows < offset + index.size)] - offset
+            if len(shard_rows):
+                searches.append((offset, partial(index.search_rows, query_vectors, k, shard_rows)))
+        return self._merge(searches, np.atleast_2d(query_vectors).shape[0], k)
+
+    # =============================================================================
+    # internal functions
+    # =============================================================================
+    def _merge(
+        self, searches: list[tuple[int, Callable]], n_queries: int, k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Run the (row offset, shard search) pairs in parallel and merge their top k."""
+        if len(searches) <= 1 or self.max_workers <= 1:
+            results = [search() for _, search in searches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(searches))) as pool:
+                results = list(pool.map(lambda search: search(), [s for _, s in searches]))
+
+        if not results:
+            return np.empty((n_queries, 0), dtype=np.int64), np.empty((n_queries, 0))
+        indices = np.concatenate(
+            [
+                np.where(shard_indices >= 0, shard_indices + offset, -1)
+                for (shard_indices, _), (offset, _) in zip(results, searches, strict=True)
+            ],
+            axis=1,
+        )
+        scores = np.concatenate([shard_scores for _, shard_scores in results], axis=1)
+        scores = np.where(indices >= 0, scores, -np.inf)
+        best, best_scores = top_k(scores, k)
+        return np.take_along_axis(indices, best, axis=1), best_scores
+
+
+def is_sharded_store(file_path: str) -> bool:
+    """Check if a vector store is a sharded, multi-document vector store."""
+    return os.path.isfile(os.path.join(file_path, MANIFEST_FILE))
+
+
+# =============================================================================
+# support functions
+# =============================================================================
+def _shard_name(doc_id: int) -> str:
+    """Directory name of the shard of a document."""
+    return f"doc_{doc_id:05d}"
+
+
+if __name__ == "__main__":
+    from core.settings.settings import Settings
+
+    _store = ShardedVectorStore(Settings().VECTOR_STORE_PATH)
+    print(_store.documents)  # noqa: T201
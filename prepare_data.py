@@ -2,12 +2,20 @@
 
 Run this script once to prepare the data for RAG.
 """
-from core.llmbackend.embedder_backend import AdaBackend
-from core.readers.pdf_readers import pdf_ingestion_pipeline
+
+from core.llmbackend.async_embedder_backend import AsyncAdaBackend
+from core.llmbackend.embedding_cache import CachedEmbedder
+from core.readers.pdf_readers import pdf_streaming_ingestion_pipeline
 from core.settings.settings import Settings
 
 if __name__ == "__main__":
     save_path = r"data/ada3_1200len"
     pdf_path = r"data/book.pdf"
-    ada3 = AdaBackend(settings=Settings())
-    pdf_ingestion_pipeline(file_path=pdf_path, save_path=save_path, embedder=ada3, max_len=1200)
+    # chunks embedded by a previous run are read from the cache, others are sent concurrently
+    ada3 = CachedEmbedder(
+        AsyncAdaBackend(settings=Settings()), cache_path=Settings().EMBEDDINGS_CACHE_PATH
+    )
+    # batches are committed as they are embedded: rerun this script to resume after a failure
+    pdf_streaming_ingestion_pipeline(
+        file_path=pdf_path, save_path=save_path, embedder=ada3, max_len=1200, build_ivf_index=True
+    )
@@ -10,10 +10,7 @@ import logging
 
 import streamlit as st
 
-from core.llmbackend.llm_backend import GptBackend
-from core.services.db_query_service import DbQueryEngine
-from core.services.pipelines import OrderData, run_system
-from core.settings.settings import Settings
+from core.services.pipelines import DB_QUERY_ENGINE, OrderData, run_system
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,15 +18,17 @@ logger = logging.getLogger(__name__)
 
 # Initialize the chatbot
 def chatbot_response(query: str) -> OrderData:
-    """Call the generic pipeline from a user query."""
-    resp = run_system(query=query)
+    """Call the generic pipeline from a user query, llm responses are streamed."""
+    resp = run_system(query=query, stream=True)
     return resp
 
 
 def display_sidebar() -> None:
-    """Display the schema of dataframes."""
-    _llm = GptBackend(settings=Settings())
-    engine = DbQueryEngine(_llm)
+    """Display the schema of dataframes.
+
+    The engine of the pipelines is reused: reruns create no backend nor connection.
+    """
+    engine = DB_QUERY_ENGINE
     st.sidebar.write("You may request simple dataviz, forecast, data fetches and simple RAG...")
     st.sidebar.header("Your data schema")
     dataframes = engine.table_router
@@ -45,8 +44,10 @@ user_input = st.text_input("You:")
 # Chatbot response
 if user_input:
     response = chatbot_response(user_input)
-    if response.llm_response:
-        st.write("LLM response:", response.llm_response)
+    if response.llm_stream is not None or response.llm_response:
+        st.write("LLM response:")
+        # tokens are rendered as they arrive
+        st.write_stream(response.stream_response())
     if response.figure is not None:
         for fig in response.figure:
             st.pyplot(fig=fig)
@@ -0,0 +1,125 @@
+""".. include:: README.md
+
+Tests of the async embedder backend against a local HTTP stub of the embeddings API.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import openai
+import pytest
+
+from core.llmbackend import embedder_backend
+from core.llmbackend.async_embedder_backend import AsyncAdaBackend
+from core.llmbackend.rate_limiter import AsyncRateLimiter
+from core.settings.settings import Settings
+
+
+class EmbeddingsStub(BaseHTTPRequestHandler):
+    """Answers any POST with one [len(input), 1.0] embedding per input, after a short delay"""
+
+    in_flight = 0
+    max_in_flight = 0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self) -> None:
+        """Embeddings endpoint"""
+        cls = type(self)
+        with cls.lock:
+            cls.requests += 1
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        inputs = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["input"]
+        time.sleep(0.05)
+        body = json.dumps(
+            {
+                "object": "list",
+                "model": "stub",
+                "data": [
+                    {"object": "embedding", "index": idx, "embedding": [float(len(text)), 1.0]}
+                    for idx, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": 1, "total_tokens": 1},
+            }
+        ).encode()
+        with cls.lock:
+            cls.in_flight -= 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        """Silence the stub"""
+
+
+@pytest.fixture()
+def stub_url() -> Iterator[str]:
+    """Run the embeddings stub on a free local port"""
+    EmbeddingsStub.requests = EmbeddingsStub.max_in_flight = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EmbeddingsStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def _backend(stub_url: str, max_concurrency: int) -> AsyncAdaBackend:
+    """Async backend calling the stub"""
+    settings = Settings()
+    backend = AsyncAdaBackend(settings=settings, max_concurrency=max_concurrency)
+    backend.client = openai.AsyncAzureOpenAI(
+        api_key="stub", api_version=settings.OPENAI_API_VERSION, azure_endpoint=stub_url
+    )
+    return backend
+
+
+def test_async_encode_list_bounds_concurrency(
+    stub_url: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Batches are sent concurrently, never more than max_concurrency at once"""
+    monkeypatch.setattr(embedder_backend, "MAX_BATCH_SIZE", 1)
+    backend = _backend(stub_url, max_concurrency=3)
+    strings = ["a" * length for length in range(1, 11)]
+
+    embeddings = backend.encode_list([*strings, "", None])
+
+    assert EmbeddingsStub.requests == len(strings)  # noqa: S101
+    assert 1 < EmbeddingsStub.max_in_flight <= 3  # noqa: S101, PLR2004
+    assert [int(vector[0]) for vector in embeddings[:10]] == list(range(1, 11))  # noqa: S101
+    assert embeddings[10:] == [None, None]  # noqa: S101
+
+
+def test_async_encode_from_another_event_loop(stub_url: str) -> None:
+    """The coroutines can be awaited from any event loop, after synchronous calls"""
+    backend = _backend(stub_url, max_concurrency=2)
+
+    sync_embedding = backend.encode("abc")
+    async_embedding = asyncio.run(backend.aencode("abc"))
+
+    assert np.array_equal(sync_embedding, async_embedding)  # noqa: S101
+
+
+def test_rate_limiter_spaces_requests() -> None:
+    """Once the bucket is empty, requests are released at the per-minute rate"""
+    limiter = AsyncRateLimiter(requests_per_minute=600, tokens_per_minute=1_000_000)
+
+    async def _acquire_all() -> float:
+        start = time.monotonic()
+        for _ in range(605):
+            await limiter.acquire(tokens=1)
+        return time.monotonic() - start
+
+    # 600 requests are available at once, the next 5 wait 0.1s each
+    elapsed = asyncio.run(_acquire_all())
+    assert 0.4 < elapsed < 1.5  # noqa: S101, PLR2004
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
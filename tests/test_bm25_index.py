@@ -0,0 +1,66 @@
+""".. include:: README.md
+
+Tests of the BM25 lexical index and of the rank fusion.
+"""
+
+import numpy as np
+import pytest
+
+from core.vectorstore.bm25_index import Bm25Index, tokenize
+from core.vectorstore.search_index import reciprocal_rank_fusion
+
+TEXTS = [
+    "The EBITDA margin of the company",
+    "PnL of the company and of its subsidiaries",
+    "ROI, EBITDA and EBITDA growth",
+    "Cash flow statement",
+]
+
+
+def _naive_bm25(texts: list[str], query: str, k1: float = 1.5, b: float = 0.75) -> np.ndarray:
+    """Reference BM25 scores computed document by document"""
+    documents = [tokenize(text) for text in texts]
+    average_length = np.mean([len(document) for document in documents])
+    scores = np.zeros(len(documents))
+    for term in tokenize(query):
+        n_docs = sum(term in document for document in documents)
+        idf = np.log(1 + (len(documents) - n_docs + 0.5) / (n_docs + 0.5))
+        for idx, document in enumerate(documents):
+            frequency = document.count(term)
+            norm = k1 * (1 - b + b * len(document) / average_length)
+            scores[idx] += idf * frequency * (k1 + 1) / (frequency + norm)
+    return scores
+
+
+def test_bm25_scores_match_naive_bm25(tmp_path: str) -> None:
+    """Precomputed postings weights give the textbook BM25 scores, after a save/load"""
+    file_path = f"{tmp_path}/bm25.npz"
+    Bm25Index.build(TEXTS).save(file_path)
+    index = Bm25Index.load(file_path)
+
+    for query in ["EBITDA of the company", "pnl", "unknown term"]:
+        assert np.allclose(index.scores(query), _naive_bm25(TEXTS, query), atol=1e-5)  # noqa: S101
+
+
+def test_bm25_search_skips_rows_without_query_terms() -> None:
+    """Only rows holding a query term are returned, in the given subset of rows"""
+    index = Bm25Index.build(TEXTS)
+
+    indices, _ = index.search(["EBITDA", "cash", "nothing"], k=3)
+    subset_indices, _ = index.search(["EBITDA"], k=3, rows=np.array([0, 1]))
+
+    assert list(indices[0]) == [2, 0, -1]  # noqa: S101
+    assert list(indices[1]) == [3, -1, -1]  # noqa: S101
+    assert list(indices[2]) == [-1, -1, -1]  # noqa: S101
+    assert list(subset_indices[0]) == [0, -1]  # noqa: S101
+
+
+def test_reciprocal_rank_fusion() -> None:
+    """Rows ranked well by both rankings come first"""
+    fused = reciprocal_rank_fusion([np.array([1, 2, 3]), np.array([3, 1, 4])], k=3)
+
+    assert list(fused) == [1, 3, 2]  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
@@ -0,0 +1,119 @@
+""".. include:: README.md
+
+Tests of the llm completions cache.
+"""
+
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+from core.llmbackend.completion_cache import (
+    CachedLlm,
+    CompletionStore,
+    DiskCompletionCache,
+    MemoryCompletionCache,
+)
+from core.llmbackend.llm_backend import LlmBackend
+from core.utils import read_tooled_response
+
+
+class CountingLlm(LlmBackend):
+    """Answers the query in upper case, or with a tool call, and records every call"""
+
+    model = "counting-model"
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def get_completion(self, query: str, primer_prompt: str, tools: dict | None = None) -> str:  # noqa: D102, ARG002
+        self.calls.append(query)
+        if tools:
+            return Function(name="plot_timeseries", arguments='{"columns": ["all"]}')
+        return query.upper()
+
+
+@pytest.fixture(params=["memory", "disk"])
+def store(request: pytest.FixtureRequest, tmp_path: str) -> CompletionStore:
+    """Both completion stores, holding at most 2 entries"""
+    if request.param == "memory":
+        return MemoryCompletionCache(max_entries=2)
+    return DiskCompletionCache(f"{tmp_path}/cache.sqlite", max_entries=2)
+
+
+def test_disk_store_is_created_on_first_use(tmp_path: Path) -> None:
+    """Creating a disk store does not touch the disk"""
+    store = DiskCompletionCache(f"{tmp_path}/cache.sqlite")
+    assert not (tmp_path / "cache.sqlite").exists()  # noqa: S101
+
+    store.put("key", "value")
+
+    assert (tmp_path / "cache.sqlite").exists()  # noqa: S101
+    assert store.get("key") == "value"  # noqa: S101
+
+
+def test_cache_hits_normalized_queries(store: CompletionStore) -> None:
+    """Case and whitespace variants of a query are answered from the cache"""
+    llm = CountingLlm()
+    cached = CachedLlm(llm, store)
+
+    first = cached.get_completion("total  profits 2023", "primer")
+    second = cached.get_completion("Total profits 2023 ", "primer")
+    other_primer = cached.get_completion("total profits 2023", "other primer")
+
+    assert first == second == "TOTAL  PROFITS 2023"  # noqa: S101
+    assert other_primer == "TOTAL PROFITS 2023"  # noqa: S101
+    assert len(llm.calls) == 2  # noqa: S101, PLR2004
+    assert cached.stats()["hits"] == 1  # noqa: S101
+    assert cached.stats()["hit_rate"] == pytest.approx(1 / 3)  # noqa: S101
+
+
+def test_tool_calls_are_cached_faithfully(store: CompletionStore) -> None:
+    """Function responses are read back as Function objects"""
+    llm = CountingLlm()
+    cached = CachedLlm(llm, store)
+    tools = [{"type": "function", "function": {"name": "plot_timeseries"}}]
+
+    first = cached.get_completion("plot profits", "primer", tools=tools)
+    second = cached.get_completion("plot profits", "primer", tools=tools)
+    text = cached.get_completion("plot profits", "primer")
+
+    assert isinstance(second, Function)  # noqa: S101
+    assert read_tooled_response(second) == read_tooled_response(first)  # noqa: S101
+    assert text == "PLOT PROFITS"  # noqa: S101
+    assert len(llm.calls) == 2  # noqa: S101, PLR2004
+
+
+def test_cache_evicts_and_expires_entries(store: CompletionStore) -> None:
+    """Least recently used entries are evicted beyond max_entries, expired ones are missed"""
+    llm = CountingLlm()
+    cached = CachedLlm(llm, store)
+    for query in ["a", "b", "a", "c", "a"]:
+        cached.get_completion(query, "primer")
+    store.ttl_seconds = 0.01
+    cached.get_completion("d", "primer")
+    time.sleep(0.02)
+    cached.get_completion("d", "primer")
+
+    assert llm.calls == ["a", "b", "c", "d", "d"]  # noqa: S101
+    assert cached.stats()["evictions"] == 2  # noqa: S101, PLR2004
+    assert cached.stats()["expirations"] == 1  # noqa: S101
+    assert cached.stats()["size"] == 2  # noqa: S101, PLR2004
+
+
+def test_streamed_and_async_completions_share_the_cache(store: CompletionStore) -> None:
+    """Streamed completions are cached once consumed, async calls read the same entries"""
+    llm = CountingLlm()
+    cached = CachedLlm(llm, store)
+
+    streamed = "".join(cached.stream_completion("hello", "primer"))
+    awaited = asyncio.run(cached.aget_completion("hello", "primer"))
+
+    assert streamed == awaited == "HELLO"  # noqa: S101
+    assert llm.calls == ["hello"]  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
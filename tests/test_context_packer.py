@@ -0,0 +1,43 @@
+""".. include:: README.md
+
+Tests of the token-budget aware packing of the RAG prompts.
+"""
+
+import numpy as np
+import pytest
+
+from core.llmbackend.tokenizer import count_tokens
+from core.services.context_packer import MIN_TRUNCATED_TOKENS, ContextPacker
+
+
+def test_chunks_are_ordered_by_score_and_deduplicated() -> None:
+    """Identical texts and near-duplicate vectors of a better chunk are dropped"""
+    chunks = ["Cash flow", "PnL of the  company", "pnl of the company", "ROI definition"]
+    vectors = np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 0.0], [0.999, 0.04]])
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    packed = ContextPacker(token_budget=1000).pack(chunks, np.array([3, 4, 2, 1]), vectors)
+
+    assert packed.positions == [1, 0]  # noqa: S101
+    assert packed.chunks == ["PnL of the  company", "Cash flow"]  # noqa: S101
+    assert not packed.truncated  # noqa: S101
+
+
+def test_chunks_are_truncated_to_the_budget() -> None:
+    """The first chunk that does not fit is truncated, the following ones are dropped"""
+    chunks = ["EBITDA " * 50, "margin " * 100, "ROI"]
+    budget = count_tokens(chunks[0]) + MIN_TRUNCATED_TOKENS
+
+    packed = ContextPacker(token_budget=budget).pack(chunks, np.array([3, 2, 1]))
+    small = ContextPacker(token_budget=MIN_TRUNCATED_TOKENS - 1).pack(chunks, np.array([3, 2, 1]))
+
+    assert packed.positions == [0, 1]  # noqa: S101
+    assert packed.truncated  # noqa: S101
+    assert packed.n_tokens <= budget  # noqa: S101
+    assert chunks[1].startswith(packed.chunks[1])  # noqa: S101
+    assert small.positions == []  # noqa: S101
+    assert small.truncated  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
@@ -0,0 +1,94 @@
+""".. include:: README.md
+
+Tests of the embedder backends, using an in-memory client in place of the OpenAI API.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from core.llmbackend import embedder_backend
+from core.llmbackend.embedder_backend import AdaBackend
+from core.settings.settings import Settings
+
+
+class FakeEmbeddingsClient:
+    """Mimics client.embeddings.create: embeds a string as [len(string), 1.0]"""
+
+    def __init__(self, failing_calls: tuple[int, ...] = ()) -> None:
+        self.embeddings = self
+        self.inputs = []
+        self.failing_calls = failing_calls
+
+    def create(self, model: str, input: list[str]) -> SimpleNamespace:  # noqa: A002, ARG002
+        """Return embeddings in reverse order, as the API does not guarantee ordering"""
+        self.inputs.append(list(input))
+        if len(self.inputs) - 1 in self.failing_calls:
+            msg = "API unavailable"
+            raise RuntimeError(msg)
+        data = [
+            SimpleNamespace(index=idx, embedding=[float(len(string)), 1.0])
+            for idx, string in enumerate(input)
+        ]
+        return SimpleNamespace(data=data[::-1])
+
+
+@pytest.fixture()
+def ada() -> AdaBackend:
+    """Ada backend calling the fake client"""
+    backend = AdaBackend(settings=Settings())
+    backend.client = FakeEmbeddingsClient()
+    return backend
+
+
+def test_encode_list_batches_and_keeps_order(
+    ada: AdaBackend, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Strings are sent by batches, results keep the input order and invalid inputs are None"""
+    monkeypatch.setattr(embedder_backend, "MAX_BATCH_SIZE", 2)
+    strings = ["a", "", "abc", None, "ab", "abcd"]
+
+    embeddings = ada.encode_list(strings)
+
+    assert ada.client.inputs == [["a", "abc"], ["ab", "abcd"]]  # noqa: S101
+    assert embeddings[1] is None  # noqa: S101
+    assert embeddings[3] is None  # noqa: S101
+    lengths = [int(vector[0]) for vector in embeddings if vector is not None]
+    assert lengths == [1, 3, 2, 4]  # noqa: S101
+
+
+def test_encode_list_respects_token_budget(
+    ada: AdaBackend, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """A batch is closed before it exceeds the token budget"""
+    monkeypatch.setattr(embedder_backend, "MAX_BATCH_TOKENS", 10)
+    strings = ["x" * 20, "x" * 20, "x" * 20]
+
+    ada.encode_list(strings)
+
+    assert [len(batch) for batch in ada.client.inputs] == [1, 1, 1]  # noqa: S101
+
+
+def test_encode_list_only_retries_failed_batches(
+    ada: AdaBackend, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """A failing batch is retried alone, the other batches are sent once"""
+    monkeypatch.setattr(embedder_backend, "MAX_BATCH_SIZE", 1)
+    monkeypatch.setattr(embedder_backend, "TIME_TO_RETRY", 0)
+    ada.client = FakeEmbeddingsClient(failing_calls=(1,))
+
+    embeddings = ada.encode_list(["a", "ab", "abc"])
+
+    assert ada.client.inputs == [["a"], ["ab"], ["ab"], ["abc"]]  # noqa: S101
+    assert np.array_equal(embeddings[1], [2.0, 1.0])  # noqa: S101
+
+
+def test_encode_single_string(ada: AdaBackend) -> None:
+    """A single string is embedded as a single vector, or None for empty inputs"""
+    assert np.array_equal(ada.encode("abc"), [3.0, 1.0])  # noqa: S101
+    assert ada.encode("") is None  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
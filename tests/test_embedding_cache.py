@@ -0,0 +1,79 @@
+""".. include:: README.md
+
+Tests of the persistent embedding cache.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from core.llmbackend.embedder_backend import EmbedderBackend
+from core.llmbackend.embedding_cache import CachedEmbedder
+
+
+class CountingEmbedder(EmbedderBackend):
+    """Embeds a string as [len(string), 1.0] and records every embedded string"""
+
+    model = "counting-model"
+
+    def __init__(self) -> None:
+        self.embedded = []
+
+    def encode(self, query: str) -> np.ndarray | None:  # noqa: D102
+        return self.encode_list([query])[0]
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        self.embedded.extend(strings)
+        return [np.array([float(len(string)), 1.0]) for string in strings]
+
+
+def test_cache_only_embeds_new_texts(tmp_path: Path) -> None:
+    """Cached texts are not embedded again, also by a new cache instance on the same file"""
+    embedder = CountingEmbedder()
+    cache = CachedEmbedder(embedder, cache_path=f"{tmp_path}/cache.sqlite")
+    # the database is created on first use
+    assert not (tmp_path / "cache.sqlite").exists()  # noqa: S101
+
+    first = cache.encode_list(["a", "bb", "a", ""])
+    cache.close()
+    cache = CachedEmbedder(embedder, cache_path=f"{tmp_path}/cache.sqlite")
+    second = cache.encode_list(["bb", "ccc"])
+
+    assert embedder.embedded == ["a", "bb", "ccc"]  # noqa: S101
+    assert first[3] is None  # noqa: S101
+    assert np.array_equal(first[1], second[0])  # noqa: S101
+    assert cache.stats()["hits"] == 1  # noqa: S101
+    assert cache.stats()["misses"] == 1  # noqa: S101
+    assert cache.stats()["size"] == 3  # noqa: S101, PLR2004
+
+
+def test_cache_evicts_least_recently_used() -> None:
+    """Beyond max_entries, the least recently used embeddings are evicted"""
+    embedder = CountingEmbedder()
+    cache = CachedEmbedder(embedder, cache_path=":memory:", max_entries=2)
+
+    cache.encode("a")
+    cache.encode("b")
+    cache.encode("a")  # "b" is now the least recently used
+    cache.encode("c")
+    cache.encode_list(["a", "b"])
+
+    assert embedder.embedded == ["a", "b", "c", "b"]  # noqa: S101
+    assert cache.stats()["evictions"] == 2  # noqa: S101, PLR2004
+
+
+def test_cache_is_keyed_by_model() -> None:
+    """The same text embedded by another model is a cache miss"""
+    embedder = CountingEmbedder()
+    cache = CachedEmbedder(embedder, cache_path=":memory:")
+    other_model = CachedEmbedder(embedder, cache_path=":memory:", model="other-model")
+
+    cache.encode("a")
+    other_model.encode("a")
+
+    assert embedder.embedded == ["a", "a"]  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
@@ -0,0 +1,115 @@
+""".. include:: README.md
+
+Tests of the shared HTTP clients against a local keep-alive HTTP stub of the embeddings API.
+"""
+
+import asyncio
+import json
+import threading
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from core.llmbackend.embedder_backend import AdaBackend
+from core.llmbackend.http_clients import HTTP2_AVAILABLE, HttpClientRegistry
+from core.llmbackend.llm_backend import GptBackend
+from core.settings.settings import Settings
+
+
+class KeepAliveStub(BaseHTTPRequestHandler):
+    """Answers any POST with one [1.0] embedding per input, keeping the connection open"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        """Embeddings endpoint"""
+        inputs = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["input"]
+        body = json.dumps(
+            {
+                "object": "list",
+                "model": "stub",
+                "data": [
+                    {"object": "embedding", "index": idx, "embedding": [1.0]}
+                    for idx in range(len(inputs))
+                ],
+                "usage": {"prompt_tokens": 1, "total_tokens": 1},
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        """Silence the stub"""
+
+
+@pytest.fixture()
+def stub_settings() -> Iterator[SimpleNamespace]:
+    """Credentials of the stub, running on a free local port"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield SimpleNamespace(
+        OPENAI_API_ENDPOINT=f"http://127.0.0.1:{server.server_port}",
+        OPENAI_API_VERSION=Settings().OPENAI_API_VERSION,
+        OPENAI_API_KEY="stub",
+    )
+    server.shutdown()
+
+
+def test_sync_requests_reuse_one_connection(stub_settings: SimpleNamespace) -> None:
+    """Clients of the same credentials are shared, their requests reuse the connection"""
+    registry = HttpClientRegistry(http2=False)
+    client = registry.azure_openai(stub_settings)
+
+    for _ in range(5):
+        registry.azure_openai(stub_settings).embeddings.create(model="stub", input=["a"])
+    stats = registry.stats()["sync"]
+
+    assert registry.azure_openai(stub_settings) is client  # noqa: S101
+    assert stats["requests"] == 5  # noqa: S101, PLR2004
+    assert stats["new_connections"] == 1  # noqa: S101
+    assert stats["reuse_rate"] == pytest.approx(0.8)  # noqa: S101
+    assert stats["open_connections"] == stats["idle_connections"] == 1  # noqa: S101
+
+
+def test_async_requests_run_on_the_registry_loop(stub_settings: SimpleNamespace) -> None:
+    """Async requests awaited from several event loops share the async pool"""
+    registry = HttpClientRegistry(http2=False)
+    client = registry.async_azure_openai(stub_settings)
+
+    async def _embed() -> list[float]:
+        embeddings = await client.embeddings.create(model="stub", input=["a"])
+        return embeddings.data[0].embedding
+
+    async def _embed_on_registry_loop() -> list[float]:
+        return await asyncio.wrap_future(registry.submit(_embed()))
+
+    results = [asyncio.run(_embed_on_registry_loop()) for _ in range(3)]
+    results.append(registry.submit(_embed()).result())
+
+    assert results == [[1.0]] * 4  # noqa: S101
+    assert registry.stats()["async"]["requests"] == 4  # noqa: S101, PLR2004
+    assert registry.stats()["async"]["new_connections"] == 1  # noqa: S101
+
+
+def test_backends_share_the_process_clients() -> None:
+    """Llm and embedder backends created separately share a single client"""
+    gpt_client = GptBackend(settings=Settings()).client
+
+    assert GptBackend(settings=Settings()).client is gpt_client  # noqa: S101
+    assert AdaBackend(settings=Settings()).client is gpt_client  # noqa: S101
+
+
+@pytest.mark.skipif(HTTP2_AVAILABLE, reason="h2 is installed")
+def test_http2_requires_h2() -> None:
+    """HTTP/2 cannot be forced without the h2 package"""
+    with pytest.raises(ValueError, match="h2"):
+        HttpClientRegistry(http2=True)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
@@ -0,0 +1,132 @@
+""".. include:: README.md
+
+Tests of the llm backends, using an in-memory client in place of the OpenAI API.
+"""
+
+import asyncio
+import time
+from collections.abc import AsyncIterator
+from types import SimpleNamespace
+
+import pytest
+
+from core.llmbackend.async_llm_backend import AsyncGptBackend
+from core.llmbackend.llm_backend import GptBackend
+from core.settings.settings import Settings
+
+
+class FakeChatClient:
+    """Mimics client.chat.completions.create: answers the query in upper case"""
+
+    def __init__(self, failing_calls: tuple[int, ...] = ()) -> None:
+        self.chat = SimpleNamespace(completions=self)
+        self.calls = []
+        self.requests = []
+        self.failing_calls = failing_calls
+
+    def create(self, messages: list[dict], stream: bool = False, **kwargs) -> SimpleNamespace:  # noqa: D102
+        self.calls.append(messages)
+        self.requests.append({"messages": messages, "stream": stream, **kwargs})
+        if len(self.calls) - 1 in self.failing_calls:
+            msg = "API unavailable"
+            raise RuntimeError(msg)
+        answer = messages[-1]["content"].upper()
+        if stream:
+            return iter(
+                [SimpleNamespace(choices=[])]
+                + [
+                    SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))])
+                    for word in answer.split(" ")
+                ]
+            )
+        message = SimpleNamespace(content=answer, tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class FakeAsyncChatClient(FakeChatClient):
+    """Mimics the async client.chat.completions.create, answering after a short delay"""
+
+    async def create(self, messages: list[dict], stream: bool = False, **kwargs) -> SimpleNamespace:  # noqa: D102
+        await asyncio.sleep(0.05)
+        response = super().create(messages, stream, **kwargs)
+        if stream:
+            return _aiter(response)
+        return response
+
+
+async def _aiter(chunks: list) -> AsyncIterator:
+    """Async iterator over the chunks of a streamed response"""
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.fixture()
+def gpt() -> GptBackend:
+    """Gpt backend calling the fake client"""
+    backend = GptBackend(settings=Settings(), llm_model="gpt-4")
+    backend.client = FakeChatClient()
+    return backend
+
+
+def test_stream_completion_yields_the_tokens(gpt: GptBackend) -> None:
+    """Streamed tokens make up the completion, chunks without choices are skipped"""
+    tokens = list(gpt.stream_completion(query="hello world", primer_prompt="primer"))
+
+    assert tokens == ["HELLO", "WORLD"]  # noqa: S101
+    assert gpt.get_completion(query="hello world", primer_prompt="primer") == "HELLO WORLD"  # noqa: S101
+
+
+def test_stream_completion_retries_before_the_first_token(gpt: GptBackend) -> None:
+    """Failed calls are retried as long as no token was yielded"""
+    gpt.client = FakeChatClient(failing_calls=(0,))
+
+    tokens = list(gpt.stream_completion(query="hello", primer_prompt="primer"))
+
+    assert tokens == ["HELLO"]  # noqa: S101
+    assert len(gpt.client.calls) == 2  # noqa: S101, PLR2004
+    assert gpt.prompt_token_budget == 8192 - 500  # noqa: S101
+
+
+def test_async_gpt_backend_sends_concurrent_requests() -> None:
+    """Awaited completions overlap, sync and streamed completions give the same answer"""
+    gpt = AsyncGptBackend(settings=Settings(), llm_model="gpt-4")
+    gpt.client = FakeAsyncChatClient()
+    queries = [f"query {idx}" for idx in range(10)]
+
+    async def _complete_all() -> list[str]:
+        return await asyncio.gather(
+            *[gpt.aget_completion(query=query, primer_prompt="primer") for query in queries]
+        )
+
+    async def _stream() -> list[str]:
+        return [token async for token in gpt.astream_completion("hello world", "primer")]
+
+    start = time.perf_counter()
+    answers = asyncio.run(_complete_all())
+    elapsed = time.perf_counter() - start
+
+    assert answers == [query.upper() for query in queries]  # noqa: S101
+    assert elapsed < 0.3  # noqa: S101, PLR2004
+    assert gpt.get_completion(query="hello world", primer_prompt="primer") == "HELLO WORLD"  # noqa: S101
+    assert list(gpt.stream_completion("hello world", "primer")) == ["HELLO", "WORLD"]  # noqa: S101
+    assert asyncio.run(_stream()) == ["HELLO", "WORLD"]  # noqa: S101
+
+
+def test_sync_and_async_backends_send_the_same_requests() -> None:
+    """Both backends build the same requests and retry a failed call the same way"""
+    sync_gpt = GptBackend(settings=Settings(), llm_model="gpt-4")
+    sync_gpt.client = FakeChatClient(failing_calls=(0,))
+    async_gpt = AsyncGptBackend(settings=Settings(), llm_model="gpt-4")
+    async_gpt.client = FakeAsyncChatClient(failing_calls=(0,))
+
+    for gpt in (sync_gpt, async_gpt):
+        gpt.get_completion(query="hello", primer_prompt="primer")
+        list(gpt.stream_completion(query="hello", primer_prompt="primer"))
+
+    assert sync_gpt.client.requests == async_gpt.client.requests  # noqa: S101
+    # the first call failed and was retried
+    assert sync_gpt.client.requests[0] == sync_gpt.client.requests[1]  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
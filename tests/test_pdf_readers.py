@@ -0,0 +1,410 @@
+""".. include:: README.md
+
+Tests of the pdf ingestion pipeline steps.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pymupdf
+import pytest
+
+from core.llmbackend.embedder_backend import EmbedderBackend
+from core.readers import pdf_readers
+from core.readers.pdf_readers import (
+    BOOK_TITLE,
+    NEW_CHAPTER_MARK,
+    STAGING_SUFFIX,
+    _embed_chunks,
+    _parse_pages,
+    add_pdf_document,
+    load_df,
+    pdf_incremental_ingestion_pipeline,
+    pdf_ingestion_pipeline,
+    pdf_streaming_ingestion_pipeline,
+)
+from core.readers.rag_schema import RagSchema
+from core.vectorstore.embedding_store import (
+    EMBEDDING_COLUMNS,
+    METADATA_FILE,
+    append_vector_store,
+    load_embeddings,
+    load_metadata,
+)
+from core.vectorstore.sharded_store import ShardedVectorStore
+
+
+class CountingEmbedder(EmbedderBackend):
+    """Embeds a string as [len(string), 1.0] and records every embedded string"""
+
+    def __init__(self) -> None:
+        self.model = "counting"
+        self.embedded = []
+
+    def encode(self, query: str) -> np.ndarray | None:  # noqa: D102
+        self.embedded.append(query)
+        return np.array([float(len(query)), 1.0]) if query else None
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        return [self.encode(string) for string in strings]
+
+
+class ThrottledEmbedder(CountingEmbedder):
+    """Fails every call after the first n_calls, as a throttled API"""
+
+    def __init__(self, n_calls: int) -> None:
+        super().__init__()
+        self.n_calls = n_calls
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        if self.n_calls == 0:
+            return [None] * len(strings)
+        self.n_calls -= 1
+        return super().encode_list(strings)
+
+
+class PartlyThrottledEmbedder(ThrottledEmbedder):
+    """Once throttled, only embeds the chunk + metadata texts (the ones holding a new line)"""
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        if self.n_calls == 0:
+            return [self.encode(string) if "\n" in string else None for string in strings]
+        return super().encode_list(strings)
+
+
+@pytest.fixture()
+def chunks() -> pd.DataFrame:
+    """Chunks sharing chapter titles, as produced by _chunk_pages"""
+    texts = ["first chunk", "second chunk", "first chunk", "third"]
+    return pd.DataFrame(
+        {
+            RagSchema.DOC_ID: [0] * 4,
+            RagSchema.PAGE_METADATA: ["chapter a", "chapter a", "chapter b", "chapter b"],
+            RagSchema.PAGE_NUMBER: [1, 1, 2, 3],
+            RagSchema.CHUNK: texts,
+            RagSchema.CHUNK_LENGTH: [len(text) for text in texts],
+        }
+    )
+
+
+def test_embed_chunks_embeds_each_distinct_text_once(chunks: pd.DataFrame) -> None:
+    """Chapter titles and repeated chunks are embedded once and scattered to every row"""
+    embedder = CountingEmbedder()
+
+    output = _embed_chunks(chunks, embedder)
+
+    assert len(embedder.embedded) == len(set(embedder.embedded))  # noqa: S101
+    # 3 distinct chunks, 2 distinct chapters, 4 distinct chapter+chunk texts
+    assert len(embedder.embedded) == 9  # noqa: S101, PLR2004
+    assert output[RagSchema.CHUNK_ID].to_list() == [0, 1, 2, 3]  # noqa: S101
+    for _, row in output.iterrows():
+        chunk_w_metadata = row[RagSchema.PAGE_METADATA] + "\n" + row[RagSchema.CHUNK]
+        assert row[RagSchema.CHUNK_EMBEDDING][0] == len(row[RagSchema.CHUNK])  # noqa: S101
+        assert row[RagSchema.PAGE_METADATA_EMBEDDING][0] == len(row[RagSchema.PAGE_METADATA])  # noqa: S101
+        assert row[RagSchema.CHUNK_W_METADATA_EMBEDDING][0] == len(chunk_w_metadata)  # noqa: S101
+
+
+def write_book(file_path: str, edits: dict[int, list[str]] | None = None) -> str:
+    """Write a 40 pages book with headers, chapter openings and dropped pages"""
+    edits = edits or {}
+    with pymupdf.open() as doc:
+        for idx in range(40):
+            if idx in edits:
+                lines = edits[idx]
+            elif idx % 9 == 3:  # noqa: PLR2004
+                lines = ["1", f"Chapter {idx}", "Title", NEW_CHAPTER_MARK, f"opening {idx}"]
+            elif idx % 11 == 5:  # noqa: PLR2004
+                lines = [BOOK_TITLE, f"TABLE {idx}"]
+            else:
+                lines = [BOOK_TITLE, f"page {idx} content", "more text"]
+            page = doc.new_page()
+            page.insert_text((50, 72), "\n".join(lines), fontsize=10)
+        doc.save(file_path)
+    return file_path
+
+
+@pytest.fixture()
+def book_path(tmp_path: Path) -> str:
+    """Path of the generated book"""
+    return write_book(str(tmp_path / "book.pdf"))
+
+
+def test_parallel_parsing_matches_sequential_parsing(book_path: str) -> None:
+    """Sharded parsing keeps chapters that started in a previous shard"""
+    sequential = _parse_pages(book_path, n_workers=1, page_start=2, page_end=37)
+    parallel = _parse_pages(book_path, n_workers=3, page_start=2, page_end=37)
+
+    pd.testing.assert_frame_equal(sequential, parallel)
+    assert sequential[RagSchema.PAGE_NUMBER].to_list()[0] == 2  # noqa: S101, PLR2004
+    assert sequential[RagSchema.PAGE_NUMBER].to_list()[-1] == 37  # noqa: S101, PLR2004
+    # pages 5, 16 and 27 contain a table, the book title is removed from every page
+    assert 16 not in sequential[RagSchema.PAGE_NUMBER].to_list()  # noqa: S101, PLR2004
+    assert not sequential[RagSchema.PAGE].str.contains(BOOK_TITLE).any()  # noqa: S101
+    chapters = dict(
+        zip(sequential[RagSchema.PAGE_NUMBER], sequential[RagSchema.PAGE_METADATA], strict=True)
+    )
+    assert chapters[3] == "chapter 3 title"  # noqa: S101
+    assert chapters[20] == "chapter 12 title"  # noqa: S101
+
+
+@pytest.mark.parametrize("store_format", ["mmap", "parquet"])
+def test_streaming_ingestion_resumes_after_failure(
+    book_path: str, tmp_path: Path, store_format: str
+) -> None:
+    """A failed streaming ingestion resumes after its last committed batch"""
+    options = {"min_len": 5, "max_len": 20, "n_workers": 1, "store_format": store_format}
+    reference = pdf_ingestion_pipeline(
+        book_path, str(tmp_path / "reference"), CountingEmbedder(), **options
+    )
+    save_path = str(tmp_path / "store")
+
+    with pytest.raises(RuntimeError, match="resume"):
+        pdf_streaming_ingestion_pipeline(
+            book_path, save_path, ThrottledEmbedder(n_calls=2), batch_size=4, **options
+        )
+    embedder = CountingEmbedder()
+    n_chunks = pdf_streaming_ingestion_pipeline(
+        book_path, save_path, embedder, batch_size=4, **options
+    )
+
+    assert n_chunks == len(reference)  # noqa: S101
+    # the 2 committed batches of 4 chunks are not embedded again
+    assert embedder.embedded[0] == reference[RagSchema.CHUNK].iloc[8]  # noqa: S101
+    assert not Path(save_path + STAGING_SUFFIX).exists()  # noqa: S101
+    expected = load_df(str(tmp_path / "reference"))
+    pd.testing.assert_frame_equal(load_df(save_path), expected)
+
+
+def test_streaming_ingestion_resumes_parsing_at_the_checkpointed_page(
+    book_path: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """A resumed ingestion does not parse the pages before its last committed chunk again"""
+    options = {"min_len": 5, "max_len": 20, "n_workers": 1, "batch_size": 4}
+    save_path = str(tmp_path / "store")
+    with pytest.raises(RuntimeError, match="resume"):
+        pdf_streaming_ingestion_pipeline(
+            book_path, save_path, ThrottledEmbedder(n_calls=2), **options
+        )
+    committed = pd.read_parquet(Path(save_path + STAGING_SUFFIX) / "part-00001.parquet")
+    extracted = []
+    extract_texts = pdf_readers._extract_texts  # noqa: SLF001
+
+    def recording_extract_texts(file_path: str, first: int, last: int) -> list[str]:
+        extracted.extend(range(first, last))
+        return extract_texts(file_path, first, last)
+
+    monkeypatch.setattr(pdf_readers, "_extract_texts", recording_extract_texts)
+    pdf_streaming_ingestion_pipeline(book_path, save_path, CountingEmbedder(), **options)
+
+    # parsing restarts at the page of the last committed chunk
+    assert extracted[0] > pdf_readers.PAGE_START  # noqa: S101
+    assert extracted[0] == committed[RagSchema.PAGE_NUMBER].iloc[-1]  # noqa: S101
+    pdf_ingestion_pipeline(
+        book_path, str(tmp_path / "reference"), CountingEmbedder(), min_len=5, max_len=20
+    )
+    pd.testing.assert_frame_equal(load_df(save_path), load_df(str(tmp_path / "reference")))
+
+
+def test_streaming_ingestion_without_chunks_raises(tmp_path: Path) -> None:
+    """A page range holding only dropped pages raises instead of writing an empty store"""
+    edits = {idx: [BOOK_TITLE, f"FIGURE {idx}"] for idx in range(40)}
+    book_path = write_book(str(tmp_path / "book.pdf"), edits)
+    save_path = str(tmp_path / "store")
+
+    with pytest.raises(ValueError, match="No chunk found"):
+        pdf_streaming_ingestion_pipeline(book_path, save_path, CountingEmbedder(), n_workers=1)
+
+    assert not Path(save_path).exists()  # noqa: S101
+    assert not Path(save_path + STAGING_SUFFIX).exists()  # noqa: S101
+
+
+def test_streaming_ingestion_never_commits_missing_embeddings(
+    book_path: str, tmp_path: Path
+) -> None:
+    """A batch missing the embeddings of its chunks or metadata is not committed"""
+    options = {"min_len": 5, "max_len": 20, "n_workers": 1}
+    save_path = str(tmp_path / "store")
+
+    with pytest.raises(RuntimeError, match="resume"):
+        pdf_streaming_ingestion_pipeline(
+            book_path, save_path, PartlyThrottledEmbedder(n_calls=2), batch_size=4, **options
+        )
+    pdf_streaming_ingestion_pipeline(book_path, save_path, CountingEmbedder(), **options)
+
+    stored = load_df(save_path)
+    for column in EMBEDDING_COLUMNS:
+        assert np.isfinite(np.stack(stored[column])).all()  # noqa: S101
+
+
+def test_ingestion_stops_at_the_first_failed_batch(
+    book_path: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """A failed embedding stops the ingestion before the next batches are embedded"""
+    monkeypatch.setattr(pdf_readers, "BATCH_SIZE", 4)
+    embedder = PartlyThrottledEmbedder(n_calls=1)
+    save_path = tmp_path / "store"
+
+    with pytest.raises(RuntimeError, match="after 4 of"):
+        pdf_ingestion_pipeline(
+            book_path, str(save_path), embedder, min_len=5, max_len=20, n_workers=1
+        )
+
+    assert embedder.n_calls == 0  # noqa: S101
+    # 2 batches of 4 chunks, texts of chunk, chapter and both
+    assert len(embedder.embedded) <= 2 * 4 * 3  # noqa: S101
+    assert not save_path.exists()  # noqa: S101
+
+
+def test_parquet_store_cannot_overwrite_a_directory_store(book_path: str, tmp_path: Path) -> None:
+    """Saving a parquet store over a vector store directory is rejected before embedding"""
+    options = {"min_len": 5, "max_len": 40, "n_workers": 1}
+    save_path = str(tmp_path / "store")
+    pdf_ingestion_pipeline(book_path, save_path, CountingEmbedder(), **options)
+    embedder = CountingEmbedder()
+
+    with pytest.raises(ValueError, match="mmap format"):
+        pdf_ingestion_pipeline(book_path, save_path, embedder, store_format="parquet", **options)
+
+    assert embedder.embedded == []  # noqa: S101
+    assert Path(save_path).is_dir()  # noqa: S101
+
+
+def test_incremental_ingestion_only_embeds_changed_chunks(book_path: str, tmp_path: Path) -> None:
+    """Unchanged chunks keep their id, changed ones are tombstoned and appended"""
+    save_path = str(tmp_path / "store")
+    options = {"min_len": 5, "max_len": 40, "n_workers": 1}
+    before = pdf_incremental_ingestion_pipeline(book_path, save_path, CountingEmbedder(), **options)
+    # page 28 is edited, page 29 is removed
+    edited_path = write_book(
+        str(tmp_path / "edited.pdf"),
+        edits={28: [BOOK_TITLE, "page 28 new content"], 29: [BOOK_TITLE, "TABLE"]},
+    )
+
+    embedder = CountingEmbedder()
+    after = pdf_incremental_ingestion_pipeline(edited_path, save_path, embedder, **options)
+
+    assert "page 28 new content" in embedder.embedded  # noqa: S101
+    assert "page 31 content\nmore text" not in embedder.embedded  # noqa: S101
+    assert after[RagSchema.CHUNK_ID].iloc[: len(before)].equals(before[RagSchema.CHUNK_ID])  # noqa: S101
+    deleted = after[after[RagSchema.DELETED]]
+    assert sorted(deleted[RagSchema.PAGE_NUMBER]) == [28, 29]  # noqa: S101
+    live = after[~after[RagSchema.DELETED]]
+    assert live[RagSchema.CHUNK_ID].is_unique  # noqa: S101
+    assert live[RagSchema.CHUNK_ID].max() == len(after) - 1  # noqa: S101
+    # the store now matches a full ingestion of the edited book, up to the chunks order
+    reference = pdf_ingestion_pipeline(edited_path, str(tmp_path / "ref"), embedder, **options)
+    columns = [RagSchema.PAGE_NUMBER, RagSchema.CHUNK]
+    live_chunks = live[columns].sort_values(columns).reset_index(drop=True)
+    reference_chunks = reference[columns].sort_values(columns).reset_index(drop=True)
+    pd.testing.assert_frame_equal(live_chunks, reference_chunks)
+    stored = load_df(save_path)
+    for _, row in stored.iterrows():
+        chunk_w_metadata = row[RagSchema.PAGE_METADATA] + "\n" + row[RagSchema.CHUNK]
+        norm = np.hypot(len(chunk_w_metadata), 1.0)
+        assert row[RagSchema.CHUNK_W_METADATA_EMBEDDING][1] == pytest.approx(1 / norm)  # noqa: S101
+
+
+def test_incremental_ingestion_only_matches_chunks_of_its_document(
+    book_path: str, tmp_path: Path
+) -> None:
+    """Chunks of another document sharing the store are never matched nor tombstoned"""
+    save_path = str(tmp_path / "store")
+    options = {"min_len": 5, "max_len": 40, "n_workers": 1}
+    first = pdf_incremental_ingestion_pipeline(book_path, save_path, CountingEmbedder(), **options)
+    edited_path = write_book(
+        str(tmp_path / "edited.pdf"), edits={28: [BOOK_TITLE, "page 28 new content"]}
+    )
+
+    embedder = CountingEmbedder()
+    after = pdf_incremental_ingestion_pipeline(
+        edited_path, save_path, embedder, doc_id=1, **options
+    )
+
+    assert not after[RagSchema.DELETED].any()  # noqa: S101
+    assert after.iloc[: len(first)][RagSchema.DOC_ID].eq(0).all()  # noqa: S101
+    second = after[after[RagSchema.DOC_ID] == 1]
+    reference = pdf_ingestion_pipeline(edited_path, str(tmp_path / "ref"), embedder, **options)
+    assert second[RagSchema.CHUNK].to_list() == reference[RagSchema.CHUNK].to_list()  # noqa: S101
+    assert "page 31 content\nmore text" in embedder.embedded  # noqa: S101
+
+
+def test_incremental_ingestion_never_appends_missing_embeddings(
+    book_path: str, tmp_path: Path
+) -> None:
+    """New chunks missing the embeddings of their text or metadata leave the store unchanged"""
+    save_path = str(tmp_path / "store")
+    options = {"min_len": 5, "max_len": 40, "n_workers": 1}
+    before = pdf_incremental_ingestion_pipeline(book_path, save_path, CountingEmbedder(), **options)
+    edited_path = write_book(
+        str(tmp_path / "edited.pdf"), edits={28: [BOOK_TITLE, "page 28 new content"]}
+    )
+
+    with pytest.raises(RuntimeError, match="not updated"):
+        pdf_incremental_ingestion_pipeline(
+            edited_path, save_path, PartlyThrottledEmbedder(n_calls=0), **options
+        )
+
+    pd.testing.assert_frame_equal(load_metadata(save_path), before)
+
+
+def test_incremental_ingestion_into_an_empty_store(book_path: str, tmp_path: Path) -> None:
+    """Chunks ingested into a store without rows are numbered from 0"""
+    save_path = tmp_path / "store"
+    save_path.mkdir()
+    options = {"min_len": 5, "max_len": 40, "n_workers": 1}
+    reference = pdf_ingestion_pipeline(
+        book_path, str(tmp_path / "ref"), CountingEmbedder(), **options
+    )
+    empty = reference.drop(columns=EMBEDDING_COLUMNS).iloc[:0]
+    empty.to_parquet(save_path / METADATA_FILE, index=False)
+    for column in EMBEDDING_COLUMNS:
+        np.save(save_path / f"{column}.npy", np.zeros((0, 2), dtype=np.float32))
+
+    after = pdf_incremental_ingestion_pipeline(
+        book_path, str(save_path), CountingEmbedder(), **options
+    )
+
+    assert after[RagSchema.CHUNK_ID].to_list() == list(range(len(reference)))  # noqa: S101
+
+
+def test_interrupted_append_leaves_the_store_unchanged(
+    book_path: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """A crash while appending keeps the previous store, its matrices match its chunks table"""
+    save_path = str(tmp_path / "store")
+    options = {"min_len": 5, "max_len": 40, "n_workers": 1}
+    before = pdf_incremental_ingestion_pipeline(book_path, save_path, CountingEmbedder(), **options)
+    new_rows = load_df(save_path).iloc[:3]
+
+    def _crash(*_: object, **__: object) -> None:
+        msg = "disk full"
+        raise OSError(msg)
+
+    monkeypatch.setattr(pd.DataFrame, "to_parquet", _crash)
+    with pytest.raises(OSError, match="disk full"):
+        append_vector_store(before, new_rows, save_path)
+    monkeypatch.undo()
+
+    stored = load_df(save_path)
+    pd.testing.assert_frame_equal(stored.drop(columns=EMBEDDING_COLUMNS), before)
+    for column in EMBEDDING_COLUMNS:
+        assert len(load_embeddings(save_path, column)) == len(before)  # noqa: S101
+
+
+def test_pdf_documents_are_ingested_into_their_own_shard(book_path: str, tmp_path: Path) -> None:
+    """Each document gets its DOC_ID and shard"""
+    store = ShardedVectorStore(str(tmp_path / "store"))
+    options = {"min_len": 5, "max_len": 40, "n_workers": 1}
+
+    first = add_pdf_document(book_path, store, CountingEmbedder(), **options)
+    second = add_pdf_document(book_path, store, CountingEmbedder(), name="copy", **options)
+
+    assert (first, second) == (0, 1)  # noqa: S101
+    assert store.documents[0]["name"] == "book.pdf"  # noqa: S101
+    assert store.documents[1]["name"] == "copy"  # noqa: S101
+    assert set(load_metadata(store.shard_path(1))[RagSchema.DOC_ID]) == {1}  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
@@ -0,0 +1,263 @@
+""".. include:: README.md
+
+Tests of the pipelines payload and dispatch, without llm calls.
+"""
+
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+from core.llmbackend.coalesced_llm import CoalescedLlm
+from core.llmbackend.completion_cache import MemoryCompletionCache
+from core.llmbackend.embedder_backend import EmbedderBackend
+from core.llmbackend.embedding_cache import CachedEmbedder
+from core.llmbackend.llm_backend import LlmBackend
+from core.llmbackend.prompts.dataeng_prompt import DATAENG_PROMPT, DATAENG_TOOLS
+from core.services import pipelines
+from core.services.pipelines import OrderData, arun_system, call_pipeline, run_system
+from core.services.query_cache import SemanticQueryCache
+from core.utils.single_flight import SingleFlight
+
+
+class ConstantEmbedder(EmbedderBackend):
+    """Embedder giving the same vector to every query"""
+
+    def encode(self, query: str) -> np.ndarray | None:  # noqa: D102, ARG002
+        return np.ones(4)
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        return [self.encode(string) for string in strings]
+
+
+class SlowRouterLlm(LlmBackend):
+    """Llm routing every query to the spam pipeline after a short delay"""
+
+    def get_completion(self, query: str, primer_prompt: str, tools: dict | None = None) -> str:  # noqa: D102, ARG002
+        time.sleep(0.1)
+        return "spam"
+
+    async def aget_completion(  # noqa: D102
+        self,
+        query: str,  # noqa: ARG002
+        primer_prompt: str,  # noqa: ARG002
+        tools: dict | None = None,  # noqa: ARG002
+    ) -> str:
+        await asyncio.sleep(0.1)
+        return "spam"
+
+
+class SpeculationLlm(LlmBackend):
+    """Llm routing queries to a pipeline and answering data requests, after a short delay each.
+
+    Records the start of the calls of each prompt, and the cancelled data requests.
+    """
+
+    def __init__(self, route: str) -> None:
+        self.route = route
+        self.starts = {}
+        self.cancelled = 0
+
+    def get_completion(self, query: str, primer_prompt: str, tools: dict | None = None) -> str:  # noqa: D102
+        raise NotImplementedError
+
+    async def aget_completion(  # noqa: D102
+        self,
+        query: str,  # noqa: ARG002
+        primer_prompt: str,
+        tools: dict | None = None,  # noqa: ARG002
+    ) -> str | Function:
+        is_data_request = primer_prompt == DATAENG_PROMPT
+        self.starts["data" if is_data_request else "route"] = time.perf_counter()
+        try:
+            await asyncio.sleep(0.2)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if not is_data_request:
+            return self.route
+        arguments = {"table_name": "Profit_Centers_Table", "columns": ["all"]}
+        return Function(name="request_data", arguments=json.dumps(arguments))
+
+
+@pytest.fixture(autouse=True)
+def _memory_caches(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Replace the disk caches of the pipelines by in-memory ones, nothing is written to data/"""
+    monkeypatch.setattr(pipelines.LLM, "store", MemoryCompletionCache())
+    embedder = CachedEmbedder(pipelines.EMBEDDER.embedder, cache_path=":memory:")
+    monkeypatch.setattr(pipelines, "EMBEDDER", embedder)
+    monkeypatch.setattr(pipelines, "QUERY_CACHE", SemanticQueryCache(ConstantEmbedder(), {}))
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_spam_pipeline_response(stream: bool) -> None:
+    """Streamed and plain responses end up in llm_response"""
+    order_data = call_pipeline(OrderData(user_query="WAZAAAA", pipeline_name="spam"), stream)
+
+    assert (order_data.llm_stream is not None) == stream  # noqa: S101
+    assert "".join(order_data.stream_response()) == "Please do not spam me"  # noqa: S101
+    assert order_data.llm_response == "Please do not spam me"  # noqa: S101
+    assert order_data.llm_stream is None  # noqa: S101
+
+
+def test_arun_system_serves_concurrent_queries(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Concurrent queries await their llm calls on a single thread"""
+    monkeypatch.setattr(pipelines, "LLM", SlowRouterLlm())
+
+    async def _run_all() -> list[OrderData]:
+        return await asyncio.gather(*[arun_system(f"query {idx}") for idx in range(10)])
+
+    start = time.perf_counter()
+    responses = asyncio.run(_run_all())
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 0.5  # noqa: S101, PLR2004
+    assert [response.llm_response for response in responses] == ["Please do not spam me"] * 10  # noqa: S101
+    assert run_system("query").pipeline_name == "spam"  # noqa: S101
+
+    async def _run_sync_in_loop() -> OrderData:
+        return run_system("query")
+
+    # the synchronous wrapper also runs inside an event loop (e.g. a notebook)
+    assert asyncio.run(_run_sync_in_loop()).pipeline_name == "spam"  # noqa: S101
+
+
+def test_run_system_caches_streamed_responses(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Streamed responses are cached once consumed, then served without routing"""
+    router_llm = SlowRouterLlm()
+    monkeypatch.setattr(pipelines, "LLM", router_llm)
+    monkeypatch.setattr(pipelines, "CACHED_PIPELINES", {"spam": []})
+    monkeypatch.setattr(
+        pipelines, "QUERY_CACHE", SemanticQueryCache(ConstantEmbedder(), {"spam": []})
+    )
+
+    first = run_system("total profits", stream=True)
+    assert run_system("total profits", stream=True).llm_stream is not None  # noqa: S101
+    assert "".join(first.stream_response()) == "Please do not spam me"  # noqa: S101
+
+    start = time.perf_counter()
+    cached = run_system("Total profits?", stream=True)
+
+    assert time.perf_counter() - start < 0.1  # noqa: S101, PLR2004
+    assert cached.user_query == "Total profits?"  # noqa: S101
+    assert cached.llm_stream is None  # noqa: S101
+    assert "".join(cached.stream_response()) == "Please do not spam me"  # noqa: S101
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_identical_concurrent_queries_share_one_run(
+    monkeypatch: pytest.MonkeyPatch, stream: bool
+) -> None:
+    """Identical concurrent queries are routed once, each caller reads the whole response"""
+    router_llm = SlowRouterLlm()
+    monkeypatch.setattr(pipelines, "LLM", router_llm)
+    monkeypatch.setattr(pipelines, "RUN_FLIGHTS", SingleFlight())
+
+    async def _run_all() -> list[OrderData]:
+        queries = ["WAZAAAA", "wazaaaa", "other"]
+        return await asyncio.gather(*[arun_system(query, stream) for query in queries])
+
+    responses = asyncio.run(_run_all())
+
+    assert [response.user_query for response in responses] == ["WAZAAAA", "wazaaaa", "other"]  # noqa: S101
+    for response in responses:
+        assert "".join(response.stream_response()) == "Please do not spam me"  # noqa: S101
+    assert pipelines.RUN_FLIGHTS.stats()["executions"] == 2  # noqa: S101, PLR2004
+
+
+def test_speculative_data_request_is_opt_in() -> None:
+    """The committed settings route the queries before sending any data request"""
+    assert pipelines.SPECULATIVE_DATA_REQUEST is False  # noqa: S101
+
+
+def test_data_request_is_sent_while_routing(monkeypatch: pytest.MonkeyPatch) -> None:
+    """The data request runs concurrently with the routing llm call"""
+    llm = SpeculationLlm(route="Data Engineering")
+    monkeypatch.setattr(pipelines, "LLM", llm)
+    monkeypatch.setattr(pipelines, "SPECULATIVE_DATA_REQUEST", True)
+
+    response = run_system("WAZAAAA")
+
+    assert response.table_name == "Profit_Centers_Table"  # noqa: S101
+    assert not response.table.empty  # noqa: S101
+    assert abs(llm.starts["data"] - llm.starts["route"]) < 0.1  # noqa: S101, PLR2004
+
+
+def test_data_request_is_cancelled_for_other_pipelines(monkeypatch: pytest.MonkeyPatch) -> None:
+    """The speculative data request is discarded when the query is not tabular"""
+    llm = SpeculationLlm(route="Spam")
+    monkeypatch.setattr(pipelines, "LLM", llm)
+    monkeypatch.setattr(pipelines, "SPECULATIVE_DATA_REQUEST", True)
+
+    assert run_system("WAZAAAA").llm_response == "Please do not spam me"  # noqa: S101
+    assert llm.cancelled == 1  # noqa: S101
+
+    llm.starts.clear()
+    monkeypatch.setattr(pipelines, "SPECULATIVE_DATA_REQUEST", False)
+    run_system("WAZAAAA")
+    assert "data" not in llm.starts  # noqa: S101
+
+
+def test_discarded_data_request_still_answers_identical_requests(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """A discarded speculative request goes on while an identical coalesced request waits"""
+    llm = CoalescedLlm(SpeculationLlm(route="Spam"))
+    monkeypatch.setattr(pipelines, "LLM", llm)
+    monkeypatch.setattr(pipelines, "SPECULATIVE_DATA_REQUEST", True)
+
+    async def _run_all() -> tuple[OrderData, Function]:
+        response = asyncio.ensure_future(arun_system("WAZAAAA"))
+        await asyncio.sleep(0.05)
+        data = await llm.aget_completion("WAZAAAA", DATAENG_PROMPT, tools=DATAENG_TOOLS)
+        return await response, data
+
+    response, data = asyncio.run(_run_all())
+
+    assert response.llm_response == "Please do not spam me"  # noqa: S101
+    assert data.name == "request_data"  # noqa: S101
+    assert llm.llm.cancelled == 0  # noqa: S101
+    assert llm.stats()["coalesced"] == 1  # noqa: S101
+
+
+class CountingRagService:
+    """RAG service answering the query, counting its instances"""
+
+    instances = 0
+
+    def __init__(self, **_: object) -> None:
+        CountingRagService.instances += 1
+        self.metrics = {"adaptive": {"answers": 0}}
+
+    async def arag_tunnel(self, query: str) -> str:  # noqa: D102
+        self.metrics["adaptive"]["answers"] += 1
+        return query
+
+
+def test_rag_service_is_shared_until_the_store_changes(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """RAG queries reuse a single service and its metrics, reloaded when the store changes"""
+    monkeypatch.setattr(pipelines, "RagService", CountingRagService)
+    monkeypatch.setattr(pipelines, "CACHED_PIPELINES", {"financial consulting": [str(tmp_path)]})
+    monkeypatch.setattr(pipelines, "_RAG_SERVICE", None)
+    monkeypatch.setattr(CountingRagService, "instances", 0)
+    order_data = OrderData(user_query="What is the ROI?", pipeline_name="financial consulting")
+
+    for _ in range(3):
+        assert call_pipeline(order_data).llm_response == "What is the ROI?"  # noqa: S101
+    assert CountingRagService.instances == 1  # noqa: S101
+
+    (tmp_path / "metadata.parquet").write_text("new chunks")
+    call_pipeline(order_data)
+
+    assert CountingRagService.instances == 2  # noqa: S101, PLR2004
+    assert pipelines.get_rag_service().metrics["adaptive"]["answers"] == 4  # noqa: S101, PLR2004
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
@@ -0,0 +1,103 @@
+""".. include:: README.md
+
+Tests of the semantic cache of the pipelines responses.
+"""
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from core.llmbackend.embedder_backend import EmbedderBackend
+from core.services.query_cache import SemanticQueryCache
+
+VOCABULARY = ["total", "profits", "credit", "card", "costs", "our", "what", "were"]
+
+
+class WordsEmbedder(EmbedderBackend):
+    """Embedder counting the vocabulary words of the queries, numbers are ignored"""
+
+    def encode(self, query: str) -> np.ndarray | None:  # noqa: D102
+        words = re.findall(r"[a-z]+", query.lower())
+        vector = np.array([words.count(word) for word in VOCABULARY], dtype=float)
+        return vector if vector.any() else None
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        return [self.encode(string) for string in strings]
+
+
+def _cache_query(cache: SemanticQueryCache, query: str, response: object, scope: str) -> None:
+    cache.add(query, cache.embed(query), response, scope)
+
+
+def _lookup(cache: SemanticQueryCache, query: str) -> object | None:
+    return cache.lookup(query, cache.embed(query))
+
+
+def test_similar_query_returns_a_copy() -> None:
+    """Similar queries share a response, each hit gets its own copy"""
+    cache = SemanticQueryCache(WordsEmbedder(), {"data engineering": []})
+    _cache_query(cache, "total profits 2023", pd.DataFrame({"profits": [1, 2]}), "data engineering")
+
+    first = _lookup(cache, "Total  profits, 2023?")
+    first.loc[0, "profits"] = 100
+    second = _lookup(cache, "total profits in 2023")
+
+    assert second["profits"].tolist() == [1, 2]  # noqa: S101
+    assert cache.stats()["hits"] == 2  # noqa: S101, PLR2004
+
+
+def test_different_queries_miss() -> None:
+    """Queries about other data, other numbers or without embedding are not answered"""
+    cache = SemanticQueryCache(WordsEmbedder(), {"data engineering": []})
+    _cache_query(cache, "total profits 2023", "profits", "data engineering")
+
+    assert _lookup(cache, "credit card costs 2023") is None  # noqa: S101
+    assert _lookup(cache, "total profits 2022") is None  # noqa: S101
+    assert _lookup(cache, "2023") is None  # noqa: S101
+    assert cache.stats()["misses"] == 2  # noqa: S101, PLR2004
+
+
+def test_only_known_scopes_are_cached() -> None:
+    """Responses of scopes without data sources entry are not cached"""
+    cache = SemanticQueryCache(WordsEmbedder(), {"data engineering": []})
+    _cache_query(cache, "total profits", "spam", "spam")
+
+    assert _lookup(cache, "total profits") is None  # noqa: S101
+
+
+def test_source_change_invalidates_its_scope(tmp_path: str) -> None:
+    """Changing a data source empties the cache of the pipelines using it, only"""
+    xlsx_path = os.path.join(tmp_path, "pnl.xlsx")
+    store_path = os.path.join(tmp_path, "store")
+    os.makedirs(store_path)
+    for path in [xlsx_path, os.path.join(store_path, "metadata.parquet")]:
+        with open(path, "w") as file:
+            file.write("v1")
+    cache = SemanticQueryCache(WordsEmbedder(), {"analyst": [xlsx_path], "rag": [store_path]})
+    _cache_query(cache, "total profits", "forecast", "analyst")
+    _cache_query(cache, "credit card costs", "definition", "rag")
+
+    with open(os.path.join(store_path, "metadata.parquet"), "w") as file:
+        file.write("version 2")
+
+    assert _lookup(cache, "total profits") == "forecast"  # noqa: S101
+    assert _lookup(cache, "credit card costs") is None  # noqa: S101
+    assert cache.stats()["invalidations"] == 1  # noqa: S101
+
+
+def test_oldest_entries_are_evicted() -> None:
+    """Each scope keeps its max_entries most recent responses"""
+    cache = SemanticQueryCache(WordsEmbedder(), {"rag": []}, max_entries=1)
+    _cache_query(cache, "total profits", "profits", "rag")
+    _cache_query(cache, "credit card costs", "costs", "rag")
+
+    assert _lookup(cache, "total profits") is None  # noqa: S101
+    assert _lookup(cache, "credit card costs") == "costs"  # noqa: S101
+    assert cache.stats()["size"] == {"rag": 1}  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
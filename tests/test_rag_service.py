@@ -0,0 +1,416 @@
+""".. include:: README.md
+
+Tests of the RAG retrieval, using an in-memory embedder and a small vector store.
+"""
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from core.llmbackend.embedder_backend import EmbedderBackend
+from core.llmbackend.llm_backend import LlmBackend
+from core.llmbackend.prompts.rag_prompt import SUMMARY_PRIMER, SUMMARY_QUERY
+from core.llmbackend.tokenizer import count_tokens
+from core.readers.pdf_readers import load_df, save_df
+from core.readers.rag_schema import RagSchema
+from core.services.rag_service import RagService
+from core.vectorstore.embedding_store import (
+    EMBEDDING_COLUMNS,
+    load_vector_store,
+    save_vector_store,
+    save_vector_store_batches,
+    store_fingerprint,
+)
+from core.vectorstore.ivf_index import ivf_index_path
+from core.vectorstore.metadata_index import MetadataIndex
+
+N_CHUNKS = 50
+DIM = 16
+
+
+class LookupEmbedder(EmbedderBackend):
+    """Embedder returning the stored vector of "chunk <idx>" queries"""
+
+    def __init__(self, vectors: np.ndarray) -> None:
+        self.vectors = vectors
+        self.calls = 0
+
+    def encode(self, query: str) -> np.ndarray | None:  # noqa: D102
+        self.calls += 1
+        if not query:
+            return None
+        return self.vectors[int(query.split()[-1])]
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        self.calls += 1
+        return [self.vectors[int(s.split()[-1])] if s else None for s in strings]
+
+
+class SlowEmbedder(LookupEmbedder):
+    """Embedder answering after the timeout of the tests"""
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        time.sleep(0.5)
+        return super().encode_list(strings)
+
+
+class RecordingLlm(LlmBackend):
+    """Llm recording the prompts it receives"""
+
+    def __init__(self) -> None:
+        self.prompts = []
+
+    def get_completion(self, query: str, primer_prompt: str, tools: dict | None = None) -> str:  # noqa: D102, ARG002
+        self.prompts.append((query, primer_prompt))
+        return "answer"
+
+
+@pytest.fixture()
+def vectors() -> np.ndarray:
+    """Random chunk embeddings"""
+    return np.random.default_rng(0).normal(size=(N_CHUNKS, DIM))
+
+
+@pytest.fixture(params=["mmap", "parquet"])
+def vector_store_path(request: pytest.FixtureRequest, tmp_path: str, vectors: np.ndarray) -> str:
+    """Write a small vector store following the RagSchema, in both storage formats"""
+    vector_store = pd.DataFrame(
+        {
+            RagSchema.DOC_ID: [0] * N_CHUNKS,
+            RagSchema.PAGE_METADATA: [f"chapter {idx % 5}" for idx in range(N_CHUNKS)],
+            RagSchema.PAGE_NUMBER: list(range(N_CHUNKS)),
+            RagSchema.CHUNK_ID: list(range(N_CHUNKS)),
+            RagSchema.CHUNK: [f"chunk {idx}" for idx in range(N_CHUNKS)],
+            RagSchema.CHUNK_LENGTH: [7] * N_CHUNKS,
+            RagSchema.CHUNK_EMBEDDING: list(vectors),
+            RagSchema.PAGE_METADATA_EMBEDDING: list(vectors),
+            RagSchema.CHUNK_W_METADATA_EMBEDDING: list(vectors),
+        }
+    )
+    path = f"{tmp_path}/vector_store"
+    if request.param == "mmap":
+        save_vector_store(df=vector_store, dir_path=path)
+    else:
+        save_df(df=vector_store, file_path=path)
+    return path
+
+
+def test_fetch_top_k_chunks_returns_closest_chunk_first(
+    vectors: np.ndarray, vector_store_path: str
+) -> None:
+    """A query identical to a stored chunk must retrieve this chunk first"""
+    rag = RagService(LookupEmbedder(vectors), llm=None, vector_store_path=vector_store_path)
+
+    chunks, sources, page_numbers = rag._fetch_top_k_chunks("chunk 7", k=5)  # noqa: SLF001
+
+    assert len(chunks) == 5  # noqa: S101, PLR2004
+    assert chunks[0] == "chunk 7"  # noqa: S101
+    assert 7 in page_numbers  # noqa: S101, PLR2004
+    assert "chapter 2" in sources  # noqa: S101
+
+
+def test_fetch_top_k_batch_matches_single_queries(
+    vectors: np.ndarray, vector_store_path: str
+) -> None:
+    """Batched retrieval uses one embedder call and matches query-by-query retrieval"""
+    embedder = LookupEmbedder(vectors)
+    rag = RagService(embedder, llm=None, vector_store_path=vector_store_path)
+    queries = ["chunk 3", "", "chunk 42"]
+
+    results = rag.fetch_top_k_batch(queries, k=4)
+
+    assert embedder.calls == 1  # noqa: S101
+    assert results[1] == ([], [], [])  # noqa: S101
+    for query, result in zip(queries, results, strict=True):
+        if query:
+            assert result == rag._fetch_top_k_chunks(query, k=4)  # noqa: S101, SLF001
+
+
+@pytest.mark.parametrize("search_mode", ["exact", "ivf", "int8"])
+def test_tombstoned_chunks_are_never_retrieved(
+    vectors: np.ndarray, vector_store_path: str, search_mode: str
+) -> None:
+    """Tombstoned chunks stay in the store but are skipped, k live chunks are still returned"""
+    metadata = load_df(vector_store_path)
+    metadata[RagSchema.DELETED] = metadata[RagSchema.CHUNK].isin(["chunk 7", "chunk 8"])
+    save_vector_store(df=metadata, dir_path=vector_store_path + "_tombstones")
+    rag = RagService(
+        LookupEmbedder(vectors),
+        llm=None,
+        vector_store_path=vector_store_path + "_tombstones",
+        search_mode=search_mode,
+    )
+
+    chunks, _, _ = rag._fetch_top_k_chunks("chunk 7", k=5)  # noqa: SLF001
+
+    assert len(chunks) == 5  # noqa: S101, PLR2004
+    assert "chunk 7" not in chunks  # noqa: S101
+    assert "chunk 8" not in chunks  # noqa: S101
+
+
+def test_filters_restrict_retrieval_to_matching_chunks(
+    vectors: np.ndarray, vector_store_path: str
+) -> None:
+    """Only chunks matching every metadata filter are retrieved"""
+    rag = RagService(LookupEmbedder(vectors), llm=None, vector_store_path=vector_store_path)
+    filters = {RagSchema.PAGE_METADATA: ["chapter 1", "chapter 3"], RagSchema.PAGE_NUMBER: (10, 30)}
+
+    chunks, sources, page_numbers = rag._fetch_top_k_chunks("chunk 7", k=50, filters=filters)  # noqa: SLF001
+
+    expected = [idx for idx in range(10, 31) if idx % 5 in (1, 3)]
+    assert sorted(page_numbers) == expected  # noqa: S101
+    assert sorted(sources) == ["chapter 1", "chapter 3"]  # noqa: S101
+    assert len(chunks) == len(expected)  # noqa: S101
+    assert rag.fetch_top_k_batch(["chunk 11"], k=3, filters=filters)[0][0][0] == "chunk 11"  # noqa: S101
+    no_match = rag._fetch_top_k_chunks("chunk 7", filters={RagSchema.DOC_ID: [1]})  # noqa: SLF001
+    assert no_match == ([], [], [])  # noqa: S101
+    with pytest.raises(ValueError, match="Invalid filter"):
+        rag._fetch_top_k_chunks("chunk 7", filters={RagSchema.CHUNK: ["chunk 7"]})  # noqa: SLF001
+
+
+def test_filters_accept_numpy_scalars(vector_store_path: str) -> None:
+    """Single filter values read from a dataframe (numpy scalars) select their rows"""
+    metadata, _ = load_vector_store(vector_store_path)
+    index = MetadataIndex(metadata)
+
+    assert len(index.select({RagSchema.DOC_ID: metadata[RagSchema.DOC_ID].iloc[0]})) == N_CHUNKS  # noqa: S101
+    chapter_rows = index.select({RagSchema.PAGE_METADATA: np.str_("chapter 1")})
+    assert chapter_rows.tolist() == list(range(1, N_CHUNKS, 5))  # noqa: S101
+
+
+def test_metadata_index_matches_dataframe_masks() -> None:
+    """Posting lists select the same rows as masks of the chunks table, with many documents"""
+    rng = np.random.default_rng(0)
+    n_rows = 1000
+    metadata = pd.DataFrame(
+        {
+            RagSchema.DOC_ID: rng.integers(200, size=n_rows),
+            RagSchema.PAGE_METADATA: [f"chapter {idx}" for idx in rng.integers(50, size=n_rows)],
+            RagSchema.PAGE_NUMBER: rng.integers(500, size=n_rows),
+        }
+    )
+    filters = {
+        RagSchema.DOC_ID: [3, 7, 7, 150, 999],
+        RagSchema.PAGE_METADATA: [f"chapter {idx}" for idx in range(25)],
+        RagSchema.PAGE_NUMBER: (100, 400),
+    }
+    index = MetadataIndex(metadata)
+
+    rows = index.select(filters)
+
+    expected = (
+        metadata[RagSchema.DOC_ID].isin(filters[RagSchema.DOC_ID])
+        & metadata[RagSchema.PAGE_METADATA].isin(filters[RagSchema.PAGE_METADATA])
+        & metadata[RagSchema.PAGE_NUMBER].between(100, 400)
+    )
+    assert rows.tolist() == np.flatnonzero(expected).tolist()  # noqa: S101
+    assert index.select({}).tolist() == list(range(n_rows))  # noqa: S101
+    for postings in index.postings.values():
+        assert sum(len(rows) for rows in postings.values()) == n_rows  # noqa: S101
+
+
+def test_lexical_retrieval_does_not_call_the_embedder(
+    vectors: np.ndarray, vector_store_path: str
+) -> None:
+    """Lexical mode scores queries with the BM25 index only"""
+    embedder = LookupEmbedder(vectors)
+    rag = RagService(embedder, None, vector_store_path, retrieval_mode="lexical")
+
+    chunks, _, _ = rag._fetch_top_k_chunks("chunk 7", k=3)  # noqa: SLF001
+
+    assert embedder.calls == 0  # noqa: S101
+    assert chunks[0] == "chunk 7"  # noqa: S101
+    assert os.path.exists(vector_store_path + "_bm25.npz")  # noqa: S101
+
+
+def test_hybrid_retrieval_falls_back_to_lexical_scores(
+    vectors: np.ndarray, vector_store_path: str
+) -> None:
+    """Hybrid mode fuses both rankings, and scores lexically the queries without embedding"""
+    rag = RagService(LookupEmbedder(vectors), None, vector_store_path, retrieval_mode="hybrid")
+    slow_rag = RagService(
+        SlowEmbedder(vectors),
+        None,
+        vector_store_path,
+        retrieval_mode="hybrid",
+        embedding_timeout=0.05,
+    )
+
+    results = rag.fetch_top_k_batch(["chunk 7", ""], k=5)
+    start = time.perf_counter()
+    slow_chunks, _, _ = slow_rag._fetch_top_k_chunks("chunk 12", k=5)  # noqa: SLF001
+
+    assert results[0][0][0] == "chunk 7"  # noqa: S101
+    assert len(results[0][0]) == 5  # noqa: S101, PLR2004
+    assert results[1] == ([], [], [])  # noqa: S101
+    assert slow_chunks[0] == "chunk 12"  # noqa: S101
+    assert time.perf_counter() - start < 0.4  # noqa: S101, PLR2004
+
+
+@pytest.mark.parametrize(
+    ("answer_strategy", "context_token_budget", "n_llm_calls"),
+    [
+        ("summary", 1000, 2),
+        ("direct", 1000, 1),
+        ("direct", 10, 1),
+        ("adaptive", 1000, 1),
+        ("adaptive", 10, 2),
+    ],
+)
+def test_answer_strategies(
+    vectors: np.ndarray,
+    vector_store_path: str,
+    answer_strategy: str,
+    context_token_budget: int,
+    n_llm_calls: int,
+) -> None:
+    """Only "summary" and over-budget "adaptive" answers summarize the chunks first"""
+    llm = RecordingLlm()
+    rag = RagService(
+        LookupEmbedder(vectors),
+        llm,
+        vector_store_path,
+        answer_strategy=answer_strategy,
+        context_token_budget=context_token_budget,
+    )
+
+    answer = rag.rag_tunnel("chunk 7")
+
+    assert answer.startswith("answer")  # noqa: S101
+    assert len(llm.prompts) == n_llm_calls  # noqa: S101
+    answer_primer = llm.prompts[-1][1]
+    if n_llm_calls == 1:
+        # the closest chunk is kept first, and the context fits the budget
+        assert "- chunk 7\n" in answer_primer  # noqa: S101
+        n_chunks = answer_primer.count("chunk ")
+        assert 1 < n_chunks <= context_token_budget // 2  # noqa: S101
+    stats = rag.stats()[answer_strategy]
+    assert stats["answers"] == 1  # noqa: S101
+    assert stats["llm_calls"] == n_llm_calls  # noqa: S101
+    assert stats["prompt_tokens"] > 0  # noqa: S101
+
+
+@pytest.mark.parametrize("answer_strategy", ["summary", "direct"])
+def test_rag_stream_matches_rag_tunnel(
+    vectors: np.ndarray, vector_store_path: str, answer_strategy: str
+) -> None:
+    """Streamed tokens and sources make up the rag_tunnel answer"""
+    llm = RecordingLlm()
+    rag = RagService(
+        LookupEmbedder(vectors), llm, vector_store_path, answer_strategy=answer_strategy
+    )
+
+    tokens = list(rag.rag_stream("chunk 7"))
+
+    assert "".join(tokens) == rag.rag_tunnel("chunk 7")  # noqa: S101
+    assert tokens[0] == "answer"  # noqa: S101
+    assert rag.stats()[answer_strategy]["streamed_answers"] == 1  # noqa: S101
+    assert rag.stats()[answer_strategy]["answers"] == 2  # noqa: S101, PLR2004
+
+
+def test_summary_prompt_fits_the_model_budget(vectors: np.ndarray, vector_store_path: str) -> None:
+    """Chunks of the summary prompt are packed into the prompt budget of the llm"""
+    llm = RecordingLlm()
+    rag = RagService(LookupEmbedder(vectors), llm, vector_store_path)
+    rag.rag_tunnel("chunk 7")
+    llm.prompt_token_budget = count_tokens("chunk 7" + SUMMARY_QUERY + SUMMARY_PRIMER) + 10
+    rag.rag_tunnel("chunk 7")
+
+    assert llm.prompts[0][0].count("chunk ") == 21  # noqa: S101, PLR2004
+    assert 1 < llm.prompts[2][0].count("chunk ") <= 6  # noqa: S101, PLR2004
+
+
+def test_mmap_vector_store_round_trip(vector_store_path: str) -> None:
+    """Both storage formats load to the same chunks and normalized embeddings"""
+    metadata, embeddings = load_vector_store(vector_store_path)
+    full_store = load_df(vector_store_path)
+
+    assert RagSchema.CHUNK_W_METADATA_EMBEDDING not in metadata.columns  # noqa: S101
+    assert embeddings.dtype == np.float32  # noqa: S101
+    assert np.allclose(np.linalg.norm(embeddings, axis=1), 1.0)  # noqa: S101
+    assert metadata[RagSchema.CHUNK].to_list() == full_store[RagSchema.CHUNK].to_list()  # noqa: S101
+    assert len(full_store[RagSchema.CHUNK_EMBEDDING][0]) == DIM  # noqa: S101
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_rewriting_a_store_keeps_mapped_matrices_intact(
+    vector_store_path: str, batched: bool
+) -> None:
+    """A reader holding the embeddings memory-mapped keeps reading them after a rewrite"""
+    if not os.path.isdir(vector_store_path):
+        pytest.skip("only directory stores are memory-mapped")
+    _, mapped = load_vector_store(vector_store_path)
+    before = np.array(mapped)
+    store = load_df(vector_store_path)
+    for column in EMBEDDING_COLUMNS:
+        store[column] = store[column].to_list()[::-1]
+
+    if batched:
+        batches = (store.iloc[start : start + 20] for start in range(0, N_CHUNKS, 20))
+        save_vector_store_batches(batches, dir_path=vector_store_path, n_rows=N_CHUNKS)
+    else:
+        save_vector_store(df=store, dir_path=vector_store_path)
+
+    _, rewritten = load_vector_store(vector_store_path)
+    assert np.array_equal(mapped, before)  # noqa: S101
+    assert np.allclose(rewritten, before[::-1])  # noqa: S101
+    assert os.listdir(os.path.dirname(vector_store_path)) == ["vector_store"]  # noqa: S101
+
+
+def test_legacy_parquet_store_is_migrated_to_a_directory(vector_store_path: str) -> None:
+    """A directory store saved over a parquet store replaces it, and can be saved again"""
+    if os.path.isdir(vector_store_path):
+        pytest.skip("the store is already a directory")
+    store = load_df(vector_store_path)
+
+    for _ in range(2):
+        save_vector_store(df=store, dir_path=vector_store_path)
+
+    assert os.path.isdir(vector_store_path)  # noqa: S101
+    assert os.listdir(os.path.dirname(vector_store_path)) == ["vector_store"]  # noqa: S101
+    metadata, _ = load_vector_store(vector_store_path)
+    assert metadata[RagSchema.CHUNK].to_list() == store[RagSchema.CHUNK].to_list()  # noqa: S101
+
+
+@pytest.mark.parametrize("search_mode", ["ivf", "int8"])
+def test_indexes_of_a_rewritten_store_are_rebuilt(
+    vectors: np.ndarray, vector_store_path: str, search_mode: str
+) -> None:
+    """Indexes saved next to a store are not reused once it is rewritten, even at equal size"""
+    RagService(
+        LookupEmbedder(vectors),
+        llm=None,
+        vector_store_path=vector_store_path,
+        search_mode=search_mode,
+        retrieval_mode="hybrid",
+    )
+    # same rows, other contents: row idx now holds the embedding of chunk N_CHUNKS - 1 - idx
+    store = load_df(vector_store_path)
+    for column in EMBEDDING_COLUMNS:
+        store[column] = store[column].to_list()[::-1]
+    time.sleep(0.01)  # file modification times have a coarse resolution
+    if os.path.isdir(vector_store_path):
+        save_vector_store(df=store, dir_path=vector_store_path)
+        assert not os.path.exists(ivf_index_path(vector_store_path))  # noqa: S101
+    else:
+        save_df(df=store, file_path=vector_store_path)
+    rag = RagService(
+        LookupEmbedder(vectors),
+        llm=None,
+        vector_store_path=vector_store_path,
+        search_mode=search_mode,
+        retrieval_mode="hybrid",
+    )
+
+    indices, _ = rag.search_index.search(vectors[7], k=1)
+
+    assert indices[0, 0] == N_CHUNKS - 1 - 7  # noqa: S101
+    assert rag.search_index.source == store_fingerprint(vector_store_path)  # noqa: S101
+    assert rag.bm25_index.source == store_fingerprint(vector_store_path)  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
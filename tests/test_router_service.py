@@ -0,0 +1,95 @@
+""".. include:: README.md
+
+Tests of the tiered router: keyword fast path, then routing llm.
+"""
+
+import asyncio
+
+import pytest
+
+from benchmarks.router_accuracy import labelled_queries, run_benchmark
+from core.llmbackend.llm_backend import LlmBackend
+from core.services.keyword_router import KeywordRouter
+from core.services.router_service import RouterService
+
+# every query is routed by the keyword router, or none
+ALL_QUERIES = 1.0
+NO_QUERY = 0.0
+# share of the routing prompt examples routed by the keyword router
+MIN_PROMPT_COVERAGE = 0.8
+
+
+class SpamLlm(LlmBackend):
+    """Llm routing every query to the spam pipeline, recording the queries"""
+
+    def __init__(self) -> None:
+        self.queries = []
+
+    def get_completion(self, query: str, primer_prompt: str, tools: dict | None = None) -> str:  # noqa: D102, ARG002
+        self.queries.append(query)
+        return "Spam"
+
+
+@pytest.mark.parametrize(
+    ("query", "pipeline"),
+    [
+        ("need a forrcasting of enterprise revenue", "Analyst"),
+        ("histogram of our profits in 2023", "Data Visualization"),
+        ("What does EBITDA mean ?", "Financial Consulting"),
+        ("What was our gross income in 2023 ?", "Data Engineering"),
+    ],
+)
+def test_obvious_queries_bypass_the_llm(query: str, pipeline: str) -> None:
+    """Confident keyword routes are returned without llm call, from sync and async code"""
+    llm = SpamLlm()
+    router = RouterService(llm, fast_router=KeywordRouter())
+
+    assert router.route(query) == pipeline  # noqa: S101
+    assert asyncio.run(router.aroute(query)) == pipeline  # noqa: S101
+    assert llm.queries == []  # noqa: S101
+    assert router.fast_router.stats()["hit_rate"] == ALL_QUERIES  # noqa: S101
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "How much does ice cream cost ?",
+        "What time is it ?",
+        "Show me the forecast trend of our profits",
+        "how much money should we invest in our retirement?",
+        # labelled Data Visualization in the test queries, Data Engineering in the prompt
+        "Show me the transactions number from march to june 2024 in the Small business sector",
+    ],
+)
+def test_unsure_queries_are_sent_to_the_llm(query: str) -> None:
+    """Spam, personal finance, measures without scope, data to show and mixed intents go to llm"""
+    llm = SpamLlm()
+    router = RouterService(llm, fast_router=KeywordRouter())
+
+    assert router.route(query) == "Spam"  # noqa: S101
+    assert llm.queries == [query]  # noqa: S101
+
+
+def test_without_fast_router_every_query_goes_to_the_llm() -> None:
+    """The llm routes every query by default"""
+    llm = SpamLlm()
+
+    assert RouterService(llm).route("histogram of our profits in 2023") == "Spam"  # noqa: S101
+    assert len(llm.queries) == 1  # noqa: S101
+
+
+def test_keyword_routes_of_the_labelled_queries() -> None:
+    """The fast path routes most prompt examples, and never routes a labelled query wrongly"""
+    results = {
+        row["query_set"]: row
+        for row in run_benchmark(labelled_queries(), KeywordRouter(), n_repeats=1)
+    }
+
+    for row in results.values():
+        assert row["fast_accuracy"] in (None, ALL_QUERIES)  # noqa: S101
+    assert results["routing_prompt"]["coverage"] >= MIN_PROMPT_COVERAGE  # noqa: S101
+    assert results["test_queries/Spam"]["coverage"] == NO_QUERY  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
@@ -0,0 +1,184 @@
+""".. include:: README.md
+
+Tests of the vector store search indexes.
+"""
+
+import numpy as np
+import pytest
+
+from core.vectorstore.ivf_index import IvfIndex
+from core.vectorstore.quantization import QuantizedIndex, quantize_binary, quantize_int8
+from core.vectorstore.search_index import (
+    ExactSearchIndex,
+    maximal_marginal_relevance,
+    normalize_rows,
+    stack_embeddings,
+    top_k,
+)
+from core.vectorstore.sharded_store import ShardedSearchIndex
+
+
+def _naive_cosine_ranking(embeddings: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Reference ranking computed row by row"""
+    scores = [
+        np.dot(row, query) / (np.linalg.norm(row) * np.linalg.norm(query)) for row in embeddings
+    ]
+    return np.argsort(scores)[::-1]
+
+
+def test_exact_search_matches_naive_ranking() -> None:
+    """The vectorized search must rank rows like the row-by-row cosine similarity"""
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(500, 32))
+    query = rng.normal(size=32)
+    index = ExactSearchIndex(embeddings)
+
+    indices, scores = index.search(query, k=10)
+
+    assert indices.shape == (1, 10)  # noqa: S101
+    assert list(indices[0]) == list(_naive_cosine_ranking(embeddings, query)[:10])  # noqa: S101
+    assert np.all(np.diff(scores[0]) <= 0)  # noqa: S101
+
+
+def test_exact_search_batch_and_small_store() -> None:
+    """Batched queries return one row per query and k is capped to the store size"""
+    embeddings = np.eye(3)
+    index = ExactSearchIndex(embeddings)
+
+    indices, scores = index.search(np.eye(3), k=5)
+
+    assert indices.shape == (3, 3)  # noqa: S101
+    assert list(indices[:, 0]) == [0, 1, 2]  # noqa: S101
+    assert np.allclose(scores[:, 0], 1.0)  # noqa: S101
+
+
+def test_stack_embeddings_rejects_ragged_vectors() -> None:
+    """Embeddings of different dimensions cannot be stacked"""
+    with pytest.raises(ValueError, match="same dimension"):
+        stack_embeddings([np.zeros(3), np.zeros(4)])
+
+
+def test_top_k_with_zero_k() -> None:
+    """Asking for no result returns empty arrays"""
+    indices, scores = top_k(np.ones((2, 4)), k=0)
+    assert indices.shape == (2, 0)  # noqa: S101
+    assert scores.shape == (2, 0)  # noqa: S101
+
+
+def test_ivf_search_probing_all_lists_is_exact(tmp_path: str) -> None:
+    """Probing every inverted list must give the exact results, also after a save/load"""
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(2000, 16))
+    queries = rng.normal(size=(20, 16))
+    exact_indices, _ = ExactSearchIndex(embeddings).search(queries, k=10)
+
+    index = IvfIndex.build(embeddings, n_lists=16)
+    index.save(f"{tmp_path}/index.npz")
+    loaded = IvfIndex.load(f"{tmp_path}/index.npz", normalize_rows(embeddings), n_probe=16)
+    ivf_indices, _ = loaded.search(queries, k=10)
+
+    assert loaded.size == len(embeddings)  # noqa: S101
+    with np.load(f"{tmp_path}/index.npz") as arrays:
+        assert "matrix" not in arrays  # noqa: S101
+    assert np.array_equal(ivf_indices, exact_indices)  # noqa: S101
+
+
+def test_ivf_search_pads_missing_results() -> None:
+    """Queries whose probed lists are too small are padded with negative positions"""
+    embeddings = np.concatenate([np.eye(4)[[0] * 3], np.eye(4)[[1] * 3]])
+    index = IvfIndex.build(embeddings, n_lists=2, n_probe=1)
+
+    indices, scores = index.search(np.eye(4)[0], k=5)
+
+    assert sorted(indices[0][:3]) == [0, 1, 2]  # noqa: S101
+    assert list(indices[0][3:]) == [-1, -1]  # noqa: S101
+    assert np.all(np.isinf(scores[0][3:]))  # noqa: S101
+
+
+@pytest.mark.parametrize("mode", ["int8", "binary"])
+def test_quantized_search_with_full_rescoring_is_exact(mode: str, tmp_path: str) -> None:
+    """Rescoring every row must give the exact results, also after a save/load"""
+    rng = np.random.default_rng(0)
+    embeddings = normalize_rows(rng.normal(size=(300, 32)))
+    queries = rng.normal(size=(5, 32))
+    exact_indices, _ = ExactSearchIndex(embeddings).search(queries, k=10)
+
+    QuantizedIndex.build(embeddings, mode).save(f"{tmp_path}/codes.npz")
+    index = QuantizedIndex.load(f"{tmp_path}/codes.npz", embeddings, rescore_factor=30)
+    indices, _ = index.search(queries, k=10)
+
+    assert index.mode == mode  # noqa: S101
+    assert np.array_equal(indices, exact_indices)  # noqa: S101
+
+
+def test_quantization_codes() -> None:
+    """int8 codes approximate the vectors and binary codes pack the sign bits"""
+    rng = np.random.default_rng(0)
+    embeddings = normalize_rows(rng.normal(size=(100, 20)))
+
+    codes, scale = quantize_int8(embeddings)
+    bits = quantize_binary(embeddings)
+
+    assert codes.dtype == np.int8  # noqa: S101
+    assert np.abs(codes * scale - embeddings).max() <= scale.max()  # noqa: S101
+    assert bits.shape == (100, 3)  # noqa: S101
+    assert np.array_equal(np.unpackbits(bits, axis=1)[:, :20], embeddings > 0)  # noqa: S101
+
+
+@pytest.mark.parametrize("mode", ["int8", "binary"])
+def test_quantized_scores_of_a_query_batch_match_single_queries(mode: str) -> None:
+    """Queries scanned together score like queries scanned one by one"""
+    rng = np.random.default_rng(0)
+    embeddings = normalize_rows(rng.normal(size=(100, 20)))
+    queries = normalize_rows(rng.normal(size=(4, 20)))
+    index = QuantizedIndex.build(embeddings, mode)
+
+    scores = index._approximate_scores(queries, index.codes)  # noqa: SLF001
+
+    for query, query_scores in zip(queries, scores, strict=True):
+        single_scores = index._approximate_scores(query[None, :], index.codes)  # noqa: SLF001
+        assert np.allclose(query_scores, single_scores[0], atol=1e-6)  # noqa: S101
+    if mode == "binary":
+        signs = np.unpackbits(quantize_binary(embeddings), axis=1)
+        query_signs = np.unpackbits(quantize_binary(queries), axis=1)
+        hamming = (signs[None, :, :] != query_signs[:, None, :]).sum(axis=2)
+        assert np.array_equal(scores, -hamming)  # noqa: S101
+
+
+@pytest.mark.parametrize("index_type", ["exact", "ivf", "int8", "binary", "sharded"])
+def test_search_rows_only_returns_the_subset(index_type: str) -> None:
+    """Searching a subset of rows ranks it like an exact search on the subset alone"""
+    rng = np.random.default_rng(0)
+    embeddings = normalize_rows(rng.normal(size=(400, 16)))
+    rows = rng.choice(400, size=60, replace=False)
+    queries = rng.normal(size=(3, 16))
+    indexes = {
+        "exact": lambda: ExactSearchIndex(embeddings, normalized=True),
+        "ivf": lambda: IvfIndex.build(embeddings, n_lists=20, n_probe=1),
+        "int8": lambda: QuantizedIndex.build(embeddings, "int8", rescore_factor=100),
+        "binary": lambda: QuantizedIndex.build(embeddings, "binary", rescore_factor=100),
+        "sharded": lambda: ShardedSearchIndex(
+            [ExactSearchIndex(embeddings[:150]), IvfIndex.build(embeddings[150:], n_probe=1)]
+        ),
+    }
+
+    indices, scores = indexes[index_type]().search_rows(queries, k=10, rows=rows)
+
+    expected, expected_scores = ExactSearchIndex(embeddings[rows]).search(queries, k=10)
+    assert np.array_equal(indices, rows[expected])  # noqa: S101
+    assert np.allclose(scores, expected_scores, atol=1e-6)  # noqa: S101
+
+
+def test_maximal_marginal_relevance_drops_duplicates_and_diversifies() -> None:
+    """Near-duplicates are dropped, and a diverse candidate is preferred to a redundant one"""
+    vectors = normalize_rows(
+        np.array([[1.0, 0.0, 0.0], [1.0, 0.01, 0.0], [1.0, 0.5, 0.0], [0.0, 0.0, 1.0]])
+    )
+    relevance = np.array([1.0, 0.9, 0.8, 0.7])
+
+    assert list(maximal_marginal_relevance(vectors, relevance)) == [0, 3, 2]  # noqa: S101
+    assert list(maximal_marginal_relevance(vectors, relevance, mmr_lambda=1.0)) == [0, 2, 3]  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
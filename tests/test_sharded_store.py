@@ -0,0 +1,133 @@
+""".. include:: README.md
+
+Tests of the multi-document sharded vector store and of its retrieval by the RagService.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from core.llmbackend.embedder_backend import EmbedderBackend
+from core.readers.rag_schema import RagSchema
+from core.services.rag_service import RagService
+from core.vectorstore.embedding_store import save_vector_store
+from core.vectorstore.search_index import ExactSearchIndex
+from core.vectorstore.sharded_store import ShardedSearchIndex, ShardedVectorStore
+
+N_CHUNKS = 60
+N_DOCUMENTS = 3
+DIM = 16
+
+
+class LookupEmbedder(EmbedderBackend):
+    """Embedder returning the stored vector of "chunk <idx>" queries"""
+
+    def __init__(self, vectors: np.ndarray) -> None:
+        self.vectors = vectors
+
+    def encode(self, query: str) -> np.ndarray | None:  # noqa: D102
+        return self.vectors[int(query.split()[-1])]
+
+    def encode_list(self, strings: list[str]) -> list[np.ndarray | None]:  # noqa: D102
+        return [self.encode(string) for string in strings]
+
+
+@pytest.fixture()
+def vectors() -> np.ndarray:
+    """Random chunk embeddings"""
+    return np.random.default_rng(0).normal(size=(N_CHUNKS, DIM))
+
+
+def make_store(doc_id: int, chunk_idx: range, vectors: np.ndarray) -> pd.DataFrame:
+    """Chunks table of a document following the RagSchema"""
+    return pd.DataFrame(
+        {
+            RagSchema.DOC_ID: [doc_id] * len(chunk_idx),
+            RagSchema.PAGE_METADATA: [f"document {doc_id}"] * len(chunk_idx),
+            RagSchema.PAGE_NUMBER: list(chunk_idx),
+            RagSchema.CHUNK_ID: list(range(len(chunk_idx))),
+            RagSchema.CHUNK: [f"chunk {idx}" for idx in chunk_idx],
+            RagSchema.CHUNK_LENGTH: [7] * len(chunk_idx),
+            RagSchema.CHUNK_EMBEDDING: list(vectors[chunk_idx]),
+            RagSchema.PAGE_METADATA_EMBEDDING: list(vectors[chunk_idx]),
+            RagSchema.CHUNK_W_METADATA_EMBEDDING: list(vectors[chunk_idx]),
+        }
+    )
+
+
+@pytest.fixture()
+def store(tmp_path: str, vectors: np.ndarray) -> ShardedVectorStore:
+    """Sharded store of 3 documents, and the single store holding the same chunks"""
+    store = ShardedVectorStore(f"{tmp_path}/sharded")
+    shard_size = N_CHUNKS // N_DOCUMENTS
+    for _ in range(N_DOCUMENTS):
+        doc_id, shard_path = store.new_shard()
+        chunk_idx = range(doc_id * shard_size, (doc_id + 1) * shard_size)
+        save_vector_store(make_store(doc_id, chunk_idx, vectors), shard_path)
+        store.add_document(doc_id, name=f"document {doc_id}")
+    save_vector_store(make_store(0, range(N_CHUNKS), vectors), f"{tmp_path}/single")
+    return store
+
+
+@pytest.mark.parametrize("search_mode", ["exact", "ivf", "binary"])
+def test_sharded_retrieval_matches_single_store(
+    vectors: np.ndarray, store: ShardedVectorStore, tmp_path: str, search_mode: str
+) -> None:
+    """Merged per-shard top-k are the top-k of the whole corpus"""
+    embedder = LookupEmbedder(vectors)
+    sharded = RagService(embedder, None, store.root_path, search_mode=search_mode)
+    single = RagService(embedder, None, f"{tmp_path}/single")
+    queries = [f"chunk {idx}" for idx in range(0, N_CHUNKS, 7)]
+
+    assert isinstance(sharded.search_index, ShardedSearchIndex)  # noqa: S101
+    assert len(sharded.vector_store) == N_CHUNKS  # noqa: S101
+    for sharded_result, single_result in zip(
+        sharded.fetch_top_k_batch(queries, k=5),
+        single.fetch_top_k_batch(queries, k=5),
+        strict=True,
+    ):
+        assert sharded_result[0] == single_result[0]  # noqa: S101
+
+
+def test_documents_are_added_and_removed_without_rewriting_other_shards(
+    vectors: np.ndarray, store: ShardedVectorStore
+) -> None:
+    """Removing a document only deletes its shard, and is persisted in the manifest"""
+    RagService(LookupEmbedder(vectors), None, store.root_path, search_mode="ivf")
+    kept_files = [
+        os.path.join(store.shard_path(doc_id), file_name)
+        for doc_id in (0, 2)
+        for file_name in os.listdir(store.shard_path(doc_id))
+    ]
+    modified = [os.path.getmtime(file_path) for file_path in kept_files]
+
+    store.remove_document(1)
+
+    reloaded = ShardedVectorStore(store.root_path)
+    assert sorted(reloaded.documents) == [0, 2]  # noqa: S101
+    assert not os.path.exists(store.shard_path(1))  # noqa: S101
+    assert not os.path.exists(store.shard_path(1) + "_ivf.npz")  # noqa: S101
+    assert [os.path.getmtime(file_path) for file_path in kept_files] == modified  # noqa: S101
+    assert reloaded.new_shard()[0] == N_DOCUMENTS  # noqa: S101
+    rag = RagService(LookupEmbedder(vectors), None, store.root_path)
+    chunks, sources, _ = rag._fetch_top_k_chunks("chunk 25", k=5)  # noqa: SLF001
+    assert "chunk 25" not in chunks  # noqa: S101
+    assert "document 1" not in sources  # noqa: S101
+
+
+def test_sharded_search_index_merges_shards(vectors: np.ndarray) -> None:
+    """Global positions follow the shards order, results are sorted across shards"""
+    index = ShardedSearchIndex([ExactSearchIndex(vectors[:2]), ExactSearchIndex(vectors[2:4])])
+
+    indices, scores = index.search(vectors[3], k=6)
+
+    assert indices[0, 0] == 3  # noqa: S101, PLR2004
+    assert sorted(indices[0, :4]) == [0, 1, 2, 3]  # noqa: S101
+    assert index.size == 4  # noqa: S101, PLR2004
+    assert np.all(np.diff(scores[0, :4]) <= 0)  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()
@@ -0,0 +1,171 @@
+""".. include:: README.md
+
+Tests of the single-flight coalescing of concurrent calls.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from core.llmbackend.coalesced_llm import CoalescedLlm
+from core.llmbackend.llm_backend import LlmBackend
+from core.utils.single_flight import SharedStream, SingleFlight
+
+
+class SlowCountingLlm(LlmBackend):
+    """Llm answering the query uppercased after a short delay, counting its calls"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def get_completion(self, query: str, primer_prompt: str, tools: dict | None = None) -> str:  # noqa: D102, ARG002
+        self.calls += 1
+        time.sleep(0.1)
+        return query.upper()
+
+
+def test_concurrent_calls_share_one_execution() -> None:
+    """Threads calling the same key while it runs get the result of the running call"""
+    flights = SingleFlight()
+    calls = []
+
+    def _slow_call(key: str) -> str:
+        calls.append(key)
+        time.sleep(0.1)
+        return key
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda idx: flights.do(idx % 2, _slow_call, idx % 2), range(8)))
+
+    assert results == [0, 1] * 4  # noqa: S101
+    assert sorted(calls) == [0, 1]  # noqa: S101
+    assert flights.stats()["coalesced"] == 6  # noqa: S101, PLR2004
+    assert flights.stats()["in_flight"] == {}  # noqa: S101
+    # a later call starts a new execution
+    flights.do(0, _slow_call, 0)
+    assert flights.executions == 3  # noqa: S101, PLR2004
+
+
+def test_waiters_are_counted_per_key() -> None:
+    """Waiter counts of the keys in flight include the running call"""
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def _blocked_call() -> str:
+        started.set()
+        release.wait()
+        return "done"
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = [pool.submit(flights.do, "key", _blocked_call)]
+        started.wait()
+        futures += [pool.submit(flights.do, "key", _blocked_call) for _ in range(2)]
+        while flights.waiters() != {"key": 3}:
+            time.sleep(0.01)
+        release.set()
+        assert [future.result() for future in futures] == ["done"] * 3  # noqa: S101
+
+    assert flights.max_waiters == 3  # noqa: S101, PLR2004
+
+
+def test_exceptions_reach_every_waiter() -> None:
+    """Waiters get the exception of the running call"""
+    flights = SingleFlight()
+
+    async def _failing_call() -> None:
+        await asyncio.sleep(0.1)
+        msg = "failed"
+        raise ValueError(msg)
+
+    async def _run_all() -> list:
+        calls = [flights.ado("key", _failing_call) for _ in range(3)]
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    errors = asyncio.run(_run_all())
+
+    assert [str(error) for error in errors] == ["failed"] * 3  # noqa: S101
+    assert flights.executions == 1  # noqa: S101
+
+
+def test_cancelled_leader_does_not_cancel_the_waiters() -> None:
+    """Waiters get the result of a flight whose leader was cancelled"""
+    flights = SingleFlight()
+    calls = []
+
+    async def _slow_call() -> str:
+        calls.append("call")
+        await asyncio.sleep(0.1)
+        return "done"
+
+    async def _run_all() -> str:
+        leader = asyncio.ensure_future(flights.ado("key", _slow_call))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(flights.ado("key", _slow_call))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(_run_all()) == "done"  # noqa: S101
+    assert calls == ["call"]  # noqa: S101
+
+
+def test_cancelled_flight_without_waiters_is_abandoned() -> None:
+    """A leader cancelled alone cancels its call, the next call starts a new flight"""
+    flights = SingleFlight()
+    cancelled = []
+
+    async def _slow_call() -> str:
+        try:
+            await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            cancelled.append("call")
+            raise
+        return "done"
+
+    async def _run_all() -> str:
+        leader = asyncio.ensure_future(flights.ado("key", _slow_call))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await flights.ado("key", _slow_call)
+
+    assert asyncio.run(_run_all()) == "done"  # noqa: S101
+    assert cancelled == ["call"]  # noqa: S101
+    assert flights.executions == 2  # noqa: S101, PLR2004
+
+
+def test_async_calls_are_shared_across_event_loops() -> None:
+    """Calls running on the event loops of different threads share one execution"""
+    llm = CoalescedLlm(SlowCountingLlm())
+
+    def _run_in_own_loop() -> str:
+        return asyncio.run(llm.aget_completion("query", "primer"))
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda _: _run_in_own_loop(), range(4)))
+    results.append(llm.get_completion("query", "primer"))
+
+    assert results == ["QUERY"] * 5  # noqa: S101
+    assert llm.llm.calls == 2  # noqa: S101, PLR2004
+    assert llm.stats()["coalesced"] == 3  # noqa: S101, PLR2004
+
+
+def test_shared_stream_yields_every_item_to_each_reader() -> None:
+    """Readers started before or after the end of the stream read all of it"""
+    stream = SharedStream(iter(["a", "b", "c"]))
+    first = iter(stream)
+
+    assert next(first) == "a"  # noqa: S101
+    assert list(stream) == ["a", "b", "c"]  # noqa: S101
+    assert list(first) == ["b", "c"]  # noqa: S101
+    assert list(stream) == ["a", "b", "c"]  # noqa: S101
+
+
+if __name__ == "__main__":  # pragma: no cover
+    pytest.main()